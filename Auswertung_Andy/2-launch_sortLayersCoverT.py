@@ -1,25 +1,33 @@
-import os
 import sys
-import subprocess
+
+from invasion_assay import use_headless
+# only clickpoints.DataFile is needed, the clickpoints GUI parts are not loaded (see invasion_assay/__init__.py)
+use_headless()
+from invasion_assay.database_builder import build_databases, print_build_summary
 
 # Folder which contains pos folders with tif. images
 rootdir = r'H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_U87\CNTRL'
+# number of databases that are built at the same time (None: number of CPUs)
+workers = None
+# skip positions whose sorted.cdb is newer than all of their images
+resume = False
+# update existing databases instead of rebuilding them, markers in the databases are kept
+sync = False
 
-# code that searches for all pos folders
-pos_folder_list = []
-print('Searching for pos folders')
-for subdir, dirs, files in os.walk(rootdir):
-    if "pos" in os.path.split(subdir)[1]:
-        print(subdir)
-        pos_folder_list.append(subdir)
-print('\n -> ' + str(len(pos_folder_list)) + ' position folders found')
-
-
+# usage: python 2-launch_sortLayersCoverT.py [rootdir] [workers] [--resume] [--sync]
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+if len(args) > 0:
+    rootdir = args[0]
+if len(args) > 1:
+    workers = int(args[1])
+resume = resume or "--resume" in sys.argv
+sync = sync or "--sync" in sys.argv
 
 
-# launch other script, pass src_path as argument
-for pos in pos_folder_list:
-    process = subprocess.Popen(['python','sortLayersCoverT.py',pos], shell=True)
-    process.wait()
+if __name__ == "__main__":
+    # the databases are built in a pool of worker processes, see invasion_assay/database_builder.py
+    summaries = build_databases(rootdir, workers=workers, channels=['modeBF','modeFluo5'], resume=resume,
+                                sync=sync)
+    print_build_summary(summaries)
 
-print('Finished!')
\ No newline at end of file
+    print('Finished!')
@@ -7,6 +7,9 @@ import csv
 import matplotlib.pyplot as plt
 import os
 from collections import defaultdict
+from invasion_assay.statistics import invasion_depth_curve
+from invasion_assay.results_store import load_results
+from invasion_assay.bootstrap import condition_bands
 
 # Insert key facts here ------------------------------------------------------------
 
@@ -27,39 +30,29 @@ z_slice_thickness=5*1.33    # in um
 
 old_date = ''
 old_pos = ''
-#files2=["a.txt","b.txt"]
-#files=[os.path.join(folder,x) for x in files2]
-files={"condition1":
-        [r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos00\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos01\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos02\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos03\xyz_positions.txt"],
-       "condition2":
-      [r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Alginat\pos00\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Alginat\pos01\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Alginat\pos02\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Alginat\pos03\xyz_positions.txt"],
-       "condition3":[
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\HA\pos00\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\HA\pos01\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\HA\pos02\xyz_positions.txt",
-       r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\HA\pos03\xyz_positions.txt"]} # list of text files
+# results of the plate, gathered by 3-finding_z_postion_of_sharp_cells.py (see invasion_assay/results_store.py)
+results_file=r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\results.npz"
+# conditions (=names of the condition folders in the plate folder)
+conditions=["Ctrl","Alginat","HA"]
 
 lables=defaultdict(lambda: "")
-lables["condition1"] = "Ctrl"
-lables["condition2"] = "Alg"
-lables["condition3"] = "HA"
-#lables["condition1"]=["pos00", "pos01", "pos02", "pos03", "pos04", "pos05"]
-
-for cond, files in files.items():
-    for f in files:
-        raw=[]
-        with open(f, 'r') as txt_file:
-            next(txt_file)
-            for l in txt_file.readlines():
-                raw.append(float(l.strip().split(" ")[-1]))
+lables["Ctrl"] = "Ctrl"
+lables["Alginat"] = "Alg"
+lables["HA"] = "HA"
+
+# bootstrap confidence bands of the curves (see invasion_assay/bootstrap.py)
+n_resamples = 10000
+confidence = 0.95
+# resample whole positions (includes the variation between positions) instead of single cells
+by_position = False
+
+results=load_results(results_file,condition=conditions)
+for cond in conditions:
+    in_cond = results["condition"] == cond
+    for pos in np.unique(results["position"][in_cond]):
+        raw = results["z"][in_cond & (results["position"] == pos)]
         # projecting cells above the gel surface to the gel surface
-        raw = np.array([z if z <= 100 else 100 for z in raw])
+        raw = np.minimum(raw, 100)
         # adding to dat dictionary
         data[cond].append(np.sort(raw))
 
@@ -67,21 +60,20 @@ for cond, files in files.items():
 
 colors = [p['color'] for p in plt.rcParams['axes.prop_cycle']]
 
-for i,(cond, data_list) in enumerate(data.items()):
+data_um = {cond: [-(d - 100) * z_slice_thickness  for d in data_list] for cond, data_list in data.items()}  # micrometers
+# confidence bands of P(depth >= D) for each condition and of the differences to the first condition
+bands, differences = condition_bands(data_um, confidence=confidence, reference=conditions[0],
+                                     by_position=by_position, n_resamples=n_resamples)
 
-    data_list=[-(d - 100) * z_slice_thickness  for d in data_list]  # micrometers
-    all=np.array((np.concatenate(data_list)))
+for i,(cond, data_list) in enumerate(data_um.items()):
 
-    p = np.linspace(1, 0, len(all))
-    ps = p * 100 # percentiles
-    pooled_ps = np.array([np.percentile(all, i, interpolation="nearest") for i in ps])
+    all=np.array((np.concatenate(data_list)))
 
-    split_ps = np.array([[np.percentile(d, i, interpolation="nearest") for i in ps] for d in data_list])
-    stds = np.std(split_ps, axis=0)
+    # probability (0 to 1) and the "nearest" percentiles of the invasion depth, all in one vectorized call
+    p, pooled_ps = invasion_depth_curve(all)
 
-    #plt.plot(ps/100,stds)
-    plt.plot(p[::-1], pooled_ps, label=lables[cond], color=colors[i])
-    plt.fill_between(p[::-1], pooled_ps-stds, pooled_ps+stds, color=colors[i],alpha=0.25)  # rgb(249,164,1
+    plt.plot(p, pooled_ps, label=lables[cond], color=colors[i])
+    plt.fill_between(bands[cond]["p"], bands[cond]["lower"], bands[cond]["upper"], color=colors[i],alpha=0.25)  # rgb(249,164,1
 
 plt.axhline(0, c='k', lw=1)
 plt.grid()
@@ -99,4 +91,24 @@ plt.tight_layout()
 #plt.show()
 plt.savefig(os.path.join(output_folder, img_file_name), dpi=300)
 
+# differences of the invasion depth to the first condition, with confidence band
+plt.figure()
+for i, cond in enumerate(data_um):
+    if cond not in differences:
+        continue
+    diff = differences[cond]
+    plt.plot(diff["p"], diff["difference"], label="%s - %s" % (lables[cond], lables[conditions[0]]), color=colors[i])
+    plt.fill_between(diff["p"], diff["lower"], diff["upper"], color=colors[i], alpha=0.25)
+plt.axhline(0, c='k', lw=1)
+plt.grid()
+plt.xlim([10**0, 10**-4])
+plt.title(celltype)
+plt.gca().spines["right"].set_visible(False)
+plt.gca().spines["top"].set_visible(False)
+plt.ylabel('Difference of invasion depth D [µm]')
+plt.xlabel('Probability of (Invasion depth$\mathregular{\geq}$D)')
+plt.legend(loc='lower left')
+plt.tight_layout()
+plt.savefig(os.path.join(output_folder, celltype + '-differences.png'), dpi=300)
+
 ### merging all
\ No newline at end of file
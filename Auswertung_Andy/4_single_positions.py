@@ -7,6 +7,8 @@ import csv
 import matplotlib.pyplot as plt
 import os
 from collections import defaultdict
+from invasion_assay.statistics import invasion_depth_curve
+from invasion_assay.results_store import load_results
 
 
 # Insert key facts here ------------------------------------------------------------
@@ -24,44 +26,33 @@ data = []
 dates = []
 dist_to_gel=20  # in um
 z_slice_thickness=5*1.33
-# Searches for the indices txt file
-files = glob(folder+'/*/*/' + celltype + '_' + cond + '*.txt')
+# results of the plate, gathered by 3-finding_z_postion_of_sharp_cells.py (see invasion_assay/results_store.py)
+results_file=r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\results.npz"
 
 old_date = ''
 old_pos = ''
-#files2=["a.txt","b.txt"]
-#files=[os.path.join(folder,x) for x in files2]
-files = [r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos00\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos01\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos02\xyz_positions.txt",
-         r"H:\Experiment_data\B01_AnWi_Invasion_2020-03-04\Platte2_HTB26\Ctrl\pos03\xyz_positions.txt"]
-
-
-lables=["pos00", "pos01", "pos02", "pos03", "pos04", "pos05", "pos06", "pos07", "pos08", "pos09"]
-
-for f in files:
-    raw=[]
-    with open(f, 'r') as txt_file:
-        next(txt_file)
-        for l in txt_file.readlines():
-            raw.append(float(l.strip().split(" ")[-1]))
+
+# all positions of the condition (cond = name of the condition folder in the plate folder)
+results=load_results(results_file,condition=cond)
+lables=list(np.unique(results["position"]))
+
+for pos in lables:
+    raw = results["z"][results["position"] == pos]
     # projecting cells above the gel surface to the gel surface
-    raw = np.array([z if z <= 100 else 100 for z in raw])
+    raw = np.minimum(raw, 100)
     # adding to dat dictionary
     data.append(np.sort(raw))
 
 
 
 
-
 colors = [p['color'] for p in plt.rcParams['axes.prop_cycle']]
 
 for i,(d, label) in enumerate(zip(data,lables)):
     d = -(d - 100) * z_slice_thickness
-    p = np.linspace(1, 0, len(d))
-    ps = p * 100 # percentiles
-    pooled_ps = np.array([np.percentile(d, i, interpolation="nearest") for i in ps])
-    plt.plot(p[::-1], pooled_ps, label=label, color=colors[i])
+    # probability (0 to 1) and the "nearest" percentiles of the invasion depth, all in one vectorized call
+    p, pooled_ps = invasion_depth_curve(d)
+    plt.plot(p, pooled_ps, label=label, color=colors[i])
 
 plt.axhline(0, c='k', lw=1)
 plt.grid()
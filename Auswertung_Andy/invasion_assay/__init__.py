@@ -0,0 +1,40 @@
+# Helper package for the invasion assay evaluation scripts in this folder.
+# The numbered scripts (1-..., 2-..., 3-..., 4_...) import their building blocks from here.
+#
+# Submodules are imported when they are first used (import invasion_assay.pipeline, or invasion_assay.pipeline after
+# import invasion_assay), importing the package itself costs nothing.
+# Headless mode: on import, clickpoints also imports its Qt based Addon class, which loads Qt and matplotlib.pyplot and
+# takes several seconds - in every worker process. The evaluation only needs clickpoints.DataFile, so the entry points
+# (numbered scripts, command line tools) and the worker processes of the pools call use_headless() before clickpoints
+# is imported, which blocks the Addon import (clickpoints skips it if it fails). Importing the package or a submodule
+# doesn't change the clickpoints import. Set the environment variable INVASION_ASSAY_HEADLESS=0 to keep the clickpoints
+# GUI parts (clickpoints.Addon, clickpoints.load) in the entry points as well.
+
+import os
+import sys
+import importlib
+
+submodules = ["artifact_cache", "batch", "bootstrap", "database_builder", "detection_3d", "dog_filter", "experiment",
+              "file_router", "focus_profile", "pipeline", "profiling", "projection", "projection_store",
+              "results_store", "stack_reader", "statistics", "sweep", "synthetic_stacks", "watch"]
+
+
+def use_headless():
+    '''
+    Blocking the import of clickpoints.Addon (see the top of this file). Has to be called before clickpoints is
+    imported, is also used as initializer of the worker processes.
+    :return: boolean; True if the Addon import is blocked
+    '''
+    if os.environ.get("INVASION_ASSAY_HEADLESS", "1") != "0" and "clickpoints" not in sys.modules:
+        sys.modules.setdefault("clickpoints.Addon", None)
+    return "clickpoints.Addon" in sys.modules and sys.modules["clickpoints.Addon"] is None
+
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module("invasion_assay." + name)
+    raise AttributeError("module 'invasion_assay' has no attribute '%s'" % name)
+
+
+def __dir__():
+    return sorted(list(globals()) + submodules)
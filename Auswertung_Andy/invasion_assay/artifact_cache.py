@@ -0,0 +1,81 @@
+# Cache for intermediate results of a position (projections, masks, labels). Every stage is stored as an .npz file in a
+# folder next to sorted.cdb, together with a key made from everything the result depends on: the image files (names,
+# sizes and modification times) and the parameters of the stage and of all stages before. A stage is only recomputed
+# if its key changed.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def make_key(*parts):
+    '''
+    Hash of the parts (anything that can be written as json, e.g. file lists, parameter dictionaries, other keys).
+    :return: string
+    '''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def files_key(files):
+    '''
+    Key of a list of input files, changes if a file is added, removed or modified.
+    :param files: list of paths
+    :return: string
+    '''
+    return make_key([(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files])
+
+
+class ArtifactCache:
+    '''
+    Stage results of one position, stored as <folder>/<stage>.npz.
+    '''
+
+    def __init__(self, folder, enabled=True):
+        '''
+        :param folder: folder of the cache files (created when the first result is saved)
+        :param enabled: boolean; If False, nothing is loaded or saved and every stage is computed.
+        '''
+        self.folder = folder
+        self.enabled = enabled
+
+    def _path(self, stage):
+        return os.path.join(self.folder, stage + ".npz")
+
+    def load(self, stage, key):
+        '''
+        :return: dictionary of arrays, or None if the stage is not cached or the key doesn't match
+        '''
+        path = self._path(stage)
+        if not self.enabled or not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if str(data["_key"]) != key:
+                return None
+            return {name: data[name] for name in data.files if name != "_key"}
+
+    def save(self, stage, key, arrays):
+        '''
+        :param arrays: dictionary of np.ndarrays
+        '''
+        if not self.enabled:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        # writing to a temporary file first, so that an interrupted run doesn't leave a broken cache file
+        tmp_path = self._path(stage) + ".tmp.npz"
+        np.savez(tmp_path, _key=key, **arrays)
+        os.replace(tmp_path, self._path(stage))
+
+    def get(self, stage, key, compute):
+        '''
+        Loading the result of a stage, or computing and saving it if it's not cached.
+        :param stage: name of the stage
+        :param key: key of the stage (see make_key)
+        :param compute: function without arguments that returns a dictionary of np.ndarrays
+        :return: dictionary of np.ndarrays
+        '''
+        arrays = self.load(stage, key)
+        if arrays is None:
+            arrays = compute()
+            self.save(stage, key, arrays)
+        return arrays
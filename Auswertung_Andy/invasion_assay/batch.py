@@ -0,0 +1,110 @@
+# Batch runner for the z-position pipeline. Searches an experiment folder for position folders (pos00, pos01, ...)
+# and evaluates their sorted.cdb databases in a pool of worker processes. Every worker opens its own database.
+# A failing position is reported in the summary, the remaining positions are still processed.
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from invasion_assay import use_headless
+from invasion_assay.profiling import StageProfiler, optional_cprofile
+from invasion_assay.file_router import pos_folder_pattern
+
+
+def find_positions(rootdir, db_name="sorted.cdb"):
+    '''
+    Searching for position folders in rootdir (all sub folders are searched).
+    :param rootdir: experiment folder
+    :param db_name: name of the database file in each position folder
+    :return: list of paths to the databases, sorted by path
+    '''
+    db_paths = []
+    for dir, subdirs, files in os.walk(rootdir):
+        if pos_folder_pattern.search(os.path.split(dir)[1]):
+            db_paths.append(os.path.join(dir, db_name))
+    return sorted(db_paths)
+
+
+def run_position(db_path, kwargs, profile=None):
+    '''
+    Evaluating one position and catching all errors, so that a bad position doesn't stop the batch (used by run_batch,
+    watch and experiment).
+    :param db_path: path to the sorted.cdb database of the position
+    :param kwargs: dictionary of arguments for process_position
+    :param profile: name of a position folder (e.g. "pos03"); this position is run with cProfile and the statistics are
+    saved as profile.prof in the position folder
+    :return: summary dictionary of the position, with the stage records of the profiler in "stages"
+    '''
+    # imported here: the main process only distributes the positions and doesn't need the image processing libraries
+    from invasion_assay.pipeline import process_position
+    t_start = time.time()
+    folder = os.path.split(db_path)[0]
+    summary = {"position": folder, "cells": None, "runtime": None, "error": None, "stages": None}
+    profiler = StageProfiler(folder)
+    try:
+        if not os.path.exists(db_path):
+            raise FileNotFoundError("no database found: %s" % db_path)
+        cprofile_path = os.path.join(folder, "profile.prof") if profile and \
+            os.path.split(folder)[1] == profile else None
+        with optional_cprofile(cprofile_path):
+            summary["cells"] = process_position(db_path, profiler=profiler, **kwargs)
+    except Exception:
+        summary["error"] = traceback.format_exc()
+    summary["runtime"] = time.time() - t_start
+    summary["stages"] = profiler.records
+    return summary
+
+
+def run_batch(rootdir, workers=None, db_name="sorted.cdb", profile=None, **kwargs):
+    '''
+    Evaluating all positions in rootdir in parallel.
+    :param rootdir: experiment folder
+    :param workers: int; number of worker processes. Defaults to the number of CPUs. With 1 worker all positions are
+    evaluated in this process (useful for debugging).
+    :param db_name: name of the database file in each position folder
+    :param profile: name of a position folder (e.g. "pos03") that is run with cProfile (see run_position)
+    :param kwargs: additional arguments for process_position (layer, marker_type_name)
+    :return: list of summary dictionaries (keys "position", "cells", "runtime", "error" and "stages", see
+    profiling.py), sorted by position
+    '''
+    db_paths = find_positions(rootdir, db_name=db_name)
+    print("%d position folders found in %s" % (len(db_paths), rootdir))
+    workers = workers or os.cpu_count()
+
+    summaries = []
+    if workers == 1:
+        for db_path in db_paths:
+            summaries.append(run_position(db_path, kwargs, profile))
+            print_summary_line(summaries[-1])
+    else:
+        kwargs.setdefault("progress", False)
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_headless) as executor:
+            futures = [executor.submit(run_position, db_path, kwargs, profile) for db_path in db_paths]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                print_summary_line(summaries[-1])
+    return sorted(summaries, key=lambda s: s["position"])
+
+
+def print_summary_line(summary):
+    if summary["error"] is None:
+        print("%s: %d cells (%.1f s)" % (summary["position"], summary["cells"], summary["runtime"]))
+    else:
+        print("%s: failed (%.1f s)\n%s" % (summary["position"], summary["runtime"], summary["error"]))
+
+
+def print_summary(summaries):
+    '''
+    Printing a table of all evaluated positions.
+    :param summaries: list of summary dictionaries from run_batch
+    :return:
+    '''
+    failed = [s for s in summaries if s["error"] is not None]
+    print("\n%-60s %8s %10s" % ("position", "cells", "time [s]"))
+    for s in summaries:
+        cells = "failed" if s["error"] is not None else str(s["cells"])
+        print("%-60s %8s %10.1f" % (s["position"], cells, s["runtime"]))
+    print("\n%d positions, %d failed, %d cells, %.1f s total processing time" % (
+        len(summaries), len(failed), sum(s["cells"] for s in summaries if s["cells"] is not None),
+        sum(s["runtime"] for s in summaries)))
@@ -0,0 +1,2 @@
+# Benchmarks for the invasion assay evaluation. Run them from the Auswertung_Andy folder, e.g.:
+# python -m invasion_assay.benchmarks.projection
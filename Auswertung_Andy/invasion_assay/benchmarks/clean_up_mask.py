@@ -0,0 +1,74 @@
+# Benchmark of clean_up_mask: the previous version (deepcopy, regionprops and remove_small_objects) against the version
+# in pipeline.py, on DoG masks of synthetic projections. The cleaned masks and the labels have to be the same.
+# Usage: python -m invasion_assay.benchmarks.clean_up_mask --size 2048 --cells 1500
+
+import argparse
+import copy
+import time
+import numpy as np
+from scipy.ndimage import binary_fill_holes, binary_dilation, binary_erosion
+from skimage.measure import label as measure_label, regionprops
+from skimage.morphology import remove_small_objects
+
+from invasion_assay.pipeline import clean_up_mask, detect_dog
+from invasion_assay.synthetic_stacks import synthetic_cells, render_slice
+
+
+def legacy_clean_up_mask(mask, closing_iterations=4, area_factor=1.5):
+    '''
+    clean_up_mask before the rewrite.
+    '''
+    mask_clean = copy.deepcopy(mask)
+    mask_clean = binary_dilation(mask_clean, iterations=closing_iterations)
+    mask_clean = binary_erosion(mask_clean, iterations=closing_iterations)
+    mask_clean = binary_fill_holes(mask_clean)
+    labeled = measure_label(mask_clean)
+    regions = regionprops(labeled)
+    areas = [r.area for r in regions]
+    mu = np.mean(areas)
+    std = np.std(areas, ddof=1)
+    return remove_small_objects(mask_clean, mu - area_factor * std)
+
+
+def synthetic_mask(size, n_cells, n_slices=40, seed=0):
+    '''
+    DoG mask of the maximum projection of a synthetic stack (every 4th slice).
+    '''
+    cells = synthetic_cells(n_cells, size, n_slices, seed=seed)
+    projection = np.max([render_slice(cells, z, size) for z in range(0, n_slices, 4)], axis=0)
+    return detect_dog(projection)[0]
+
+
+def timed(function, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - t)
+    return np.min(times), result
+
+
+def run(size=2048, n_cells=1500, closing_iterations=4, area_factor=1, repeats=3):
+    mask = synthetic_mask(size, n_cells)
+    t_legacy, legacy = timed(legacy_clean_up_mask, mask, closing_iterations, area_factor, repeats=repeats)
+    t_new, new = timed(clean_up_mask, mask, closing_iterations, area_factor, repeats=repeats)
+    print("mask: %dx%d pixels, %d objects" % (size, size, measure_label(mask).max()))
+    print("previous clean_up_mask: %.3f s, %d cells" % (t_legacy, measure_label(legacy).max()))
+    print("clean_up_mask:          %.3f s, %d cells (x%.1f)" % (t_new, measure_label(new).max(), t_legacy / t_new))
+    print("differing pixels: %d" % np.sum(legacy != new))
+    mask_clean, labeled = clean_up_mask(mask, closing_iterations, area_factor, return_labels=True)
+    if np.any(legacy != new) or not np.array_equal(labeled, measure_label(mask_clean)):
+        print("!!! clean_up_mask differs from the previous version")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of clean_up_mask.")
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--cells", type=int, default=1500)
+    parser.add_argument("--closing-iterations", type=int, default=4)
+    parser.add_argument("--area-factor", type=float, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(args.size, args.cells, args.closing_iterations, args.area_factor, args.repeats)
@@ -0,0 +1,73 @@
+# Benchmark of writing cell markers to a clickpoints database: one setTrack + setMarker call per cell (previous
+# write_to_db) against the bulk insert of write_to_db.
+# Usage: python -m invasion_assay.benchmarks.db_write --cells 2000
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import clickpoints
+
+from invasion_assay.pipeline import write_to_db, flag_variation
+
+
+def legacy_write_to_db(db, max_indices_list, pos_list, index_variation, var_flags, layer="modeFluo5",
+                       marker_type_name="cells"):
+    '''
+    write_to_db before the bulk insert: one track and one marker per call.
+    '''
+    db.setMarkerType(marker_type_name, color="#1fff00", mode=4)
+    for ind, pos, var, var_flag in zip(max_indices_list, pos_list, index_variation, var_flags):
+        frame = int(np.round(ind))
+        new_track = db.setTrack(marker_type_name)
+        db.setMarker(frame=frame, layer=layer, x=pos[1], y=pos[0], text=var_flag, track=new_track)
+
+
+def empty_database(filename, n_slices, layer="modeFluo5"):
+    '''
+    Database with n_slices images in one layer. The image files don't need to exist for writing markers.
+    '''
+    db = clickpoints.DataFile(filename, "w")
+    c = db.setLayer(layer)
+    p = db.setPath(".")
+    for z in range(n_slices):
+        db.setImage("slice_z%03d.tif" % z, p, layer=c, sort_index=z)
+    return db
+
+
+def synthetic_cells(n_cells, n_slices, size=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    max_indices_list = rng.uniform(0, n_slices - 1, n_cells)
+    pos_list = [tuple(p) for p in rng.uniform(0, size, (n_cells, 2))]
+    index_variation = rng.exponential(1, n_cells)
+    return max_indices_list, pos_list, index_variation, flag_variation(index_variation)
+
+
+def run(n_cells=2000, n_slices=200):
+    data = synthetic_cells(n_cells, n_slices)
+    with tempfile.TemporaryDirectory() as folder:
+        results = {}
+        for name, function in [("one call per cell", legacy_write_to_db), ("bulk insert", write_to_db)]:
+            db = empty_database(os.path.join(folder, name.replace(" ", "_") + ".cdb"), n_slices)
+            t = time.perf_counter()
+            function(db, *data, layer="modeFluo5", marker_type_name="cells")
+            results[name] = time.perf_counter() - t
+            n_markers = db.table_marker.select().count()
+            n_tracks = db.getTracks(type="cells").count()
+            db.db.close()
+            if n_markers != n_cells or n_tracks != n_cells:
+                raise AssertionError("%s: %d markers, %d tracks written for %d cells" % (name, n_markers, n_tracks,
+                                                                                       n_cells))
+
+    print("%d cells in a stack with %d slices" % (n_cells, n_slices))
+    for name, t in results.items():
+        print("%-18s %8.3f s  %10.0f markers/s" % (name, t, n_cells / t))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of writing markers to the database.")
+    parser.add_argument("--cells", type=int, default=2000)
+    parser.add_argument("--slices", type=int, default=200)
+    args = parser.parse_args()
+    run(args.cells, args.slices)
@@ -0,0 +1,105 @@
+# Benchmark of the 3-D detection (detection_3d.py) against the detection in the maximum projection (detect_dog,
+# clean_up_mask and cell_statistics), on a synthetic stack in which some cells lie above each other (same x and y,
+# different depth). Also checks that the chunked detection gives the same cells as a single chunk, and shows the
+# time and the peak memory (numpy allocations, tracemalloc) for different chunk sizes.
+# Usage: python -m invasion_assay.benchmarks.detection_3d --size 512 --slices 60 --cells 150 --stacked 30
+
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from scipy.spatial import cKDTree
+
+from invasion_assay.synthetic_stacks import synthetic_cells, render_slice
+from invasion_assay.projection import project_stack
+from invasion_assay.pipeline import detect_dog, clean_up_mask, cell_statistics
+from invasion_assay.detection_3d import detect_cells_3d
+
+
+def stacked_cells(n_cells, n_stacked, size, n_slices, seed=0):
+    '''
+    Random cells, n_stacked of them get a second cell 1-3 pixels next to them and at least n_slices / 4 slices deeper
+    or higher.
+    '''
+    cells = synthetic_cells(n_cells, size, n_slices, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    partner = {key: value[:n_stacked].copy() for key, value in cells.items()}
+    dz = rng.uniform(n_slices / 4, n_slices / 2, n_stacked)
+    partner["z"] = np.where(partner["z"] + dz < n_slices - 3, partner["z"] + dz, partner["z"] - dz)
+    partner["z"] = np.clip(partner["z"], 3, n_slices - 4)
+    partner["y"] += rng.uniform(-3, 3, n_stacked)
+    partner["x"] += rng.uniform(-3, 3, n_stacked)
+    return {key: np.concatenate([cells[key], partner[key]]) for key in cells}
+
+
+def matched(cells, found, max_distance=8, z_scale=1.0):
+    '''
+    Number of true cells with a detection within max_distance (x, y and z * z_scale), each detection is matched to at
+    most one cell.
+    '''
+    if len(found["z_mean"]) == 0:
+        return 0
+    true_points = np.stack([cells["y"], cells["x"], cells["z"] * z_scale], axis=1)
+    found_points = np.stack([found["y"], found["x"], found["z_mean"] * z_scale], axis=1)
+    distance, index = cKDTree(found_points).query(true_points)
+    order = np.argsort(distance)
+    used = set()
+    n = 0
+    for i in order[distance[order] <= max_distance]:
+        if index[i] not in used:
+            used.add(index[i])
+            n += 1
+    return n
+
+
+def detect_projection(volume):
+    max_indices, min_indices, max_proj, min_proj = project_stack(iter(volume), n_frames=len(volume), dtype=np.uint16)
+    mask, detections = detect_dog(max_proj, gauss_1=1, gauss_2=2, threshold="otsu")
+    mask_clean, labeled = clean_up_mask(mask, closing_iterations=4, area_factor=1, return_labels=True)
+    return cell_statistics(labeled, max_indices)
+
+
+def timed(function, *args, **kwargs):
+    tracemalloc.start()
+    t = time.perf_counter()
+    result = function(*args, **kwargs)
+    wall = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, wall, peak
+
+
+def run(size=512, n_slices=60, n_cells=150, n_stacked=30, workers=None, seed=0):
+    cells = stacked_cells(n_cells, n_stacked, size, n_slices, seed=seed)
+    volume = np.stack([render_slice(cells, z, size) for z in range(n_slices)])
+    print("%d slices of %dx%d pixels, %d cells, %d of them above another cell\n" % (
+        n_slices, size, size, len(cells["z"]), n_stacked))
+
+    print("%-28s %6s %8s %10s %9s %14s" % ("detection", "cells", "matched", "high var.", "time [s]", "peak mem [MB]"))
+    stats, wall, peak = timed(detect_projection, volume)
+    print("%-28s %6d %8d %10d %9.2f %14.0f" % ("maximum projection", len(stats["z_mean"]), matched(cells, stats),
+                                               np.sum(stats["z_std"] >= 2), wall, peak))
+    reference = None
+    for chunk_size in [n_slices, 16, 8]:
+        stats, wall, peak = timed(detect_cells_3d, volume, chunk_size=chunk_size, workers=workers)
+        print("%-28s %6d %8d %10d %9.2f %14.0f" % ("3-D, chunks of %d slices" % chunk_size, len(stats["z_mean"]),
+                                                   matched(cells, stats), np.sum(stats["z_std"] >= 2), wall, peak))
+        if reference is None:
+            reference = stats
+        elif not all(np.allclose(reference[key], stats[key]) for key in reference):
+            print("!!! chunked detection differs from the detection in a single chunk")
+            return False
+    print("\nthe stack itself (uint16) has %.0f MB" % (volume.nbytes / 2 ** 20))
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the 3-D detection.")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--slices", type=int, default=60)
+    parser.add_argument("--cells", type=int, default=150)
+    parser.add_argument("--stacked", type=int, default=30, help="number of cells with a second cell above or below")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.size, args.slices, args.cells, args.stacked, args.workers, args.seed)
@@ -0,0 +1,45 @@
+# Benchmark of the tiled bandpass filter (detect_dog with a tile_size) against the filter of the whole projection, on a
+# noise frame and on a synthetic projection with cells. The masks and the detections of both have to be the same.
+# Usage: python -m invasion_assay.benchmarks.dog_filter --size 4096 --tile-size 1024 --workers 2
+
+import time
+import argparse
+import numpy as np
+
+from invasion_assay.pipeline import detect_dog
+from invasion_assay.synthetic_stacks import synthetic_cells, render_slice
+
+
+def timed(function, *args, **kwargs):
+    t = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - t, result
+
+
+def run(size=4096, tile_size=1024, workers=2, n_cells=400, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = {"noise": rng.integers(0, 4000, (size, size)).astype(np.uint16),
+              "cells": render_slice(synthetic_cells(n_cells, size // 2, 20, seed=seed + 1), 10, size // 2)}
+    print("%-8s %-10s %12s %12s %18s" % ("frame", "threshold", "whole [s]", "tiled [s]", "differing pixels"))
+    same = True
+    for name, frame in frames.items():
+        for threshold in ["otsu", "mean_std"]:
+            t_whole, (mask, detections) = timed(detect_dog, frame, threshold=threshold)
+            t_tiled, (mask_tiled, detections_tiled) = timed(detect_dog, frame, threshold=threshold,
+                                                            tile_size=tile_size, workers=workers)
+            print("%-8s %-10s %12.2f %12.2f %18d" % (name, threshold, t_whole, t_tiled, (mask != mask_tiled).sum()))
+            same &= np.array_equal(mask, mask_tiled) and np.array_equal(detections, detections_tiled)
+    if not same:
+        print("!!! the tiled filter differs from the filter of the whole projection")
+    return same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the tiled bandpass filter.")
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--cells", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.size, args.tile_size, args.workers, args.cells, args.seed)
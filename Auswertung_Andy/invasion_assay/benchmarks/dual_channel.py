@@ -0,0 +1,110 @@
+# Benchmark of the bright field focus that is reduced in the same pass as the fluorescence projection
+# (projection.project_stack_with_focus) against the fluorescence projection alone and against a second pass over the
+# bright field stack (project_stack, then project_focus). The slices are written as .tif files and read with
+# StackReader, as in the pipeline (the files are in the page cache after the first run, so the times show the cost of
+# opening and decoding the files, not of the disk). Each file is read once in both variants, and the single pass is
+# not faster (the slices of both layers and both sets of maps compete for the CPU cache), so the pipeline uses the two
+# passes (pipeline.cached_projection).
+# The stack contains fluorescent debris without a bright field signature next to the cells, the bright field features
+# of the detected objects (pipeline.focus_statistics) show how well they separate the two.
+# Usage: python -m invasion_assay.benchmarks.dual_channel --size 1024 --slices 60 --cells 150 --debris 50
+
+import os
+import glob
+import time
+import argparse
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+
+from invasion_assay.synthetic_stacks import synthetic_cells, render_slice, bright_field, write_tif, stack_filename, \
+    fluo_mode, bf_mode
+from invasion_assay.stack_reader import StackReader
+from invasion_assay.projection import project_stack, project_stack_with_focus, project_focus
+from invasion_assay.pipeline import detect_dog, clean_up_mask, cell_statistics, focus_statistics
+
+
+def write_stacks(folder, cells, debris, size, n_slices, seed=0):
+    '''
+    Fluorescence slices with cells and debris, bright field slices with the cells only.
+    :return: StackReader of the fluorescence and of the bright field layer
+    '''
+    rng = np.random.default_rng(seed)
+    for z in range(n_slices):
+        fluo = render_slice(cells, z, size, rng=rng)
+        speck = render_slice(debris, z, size, background=0, noise=0)
+        write_tif(os.path.join(folder, stack_filename(0, fluo_mode, z)), fluo + speck)
+        write_tif(os.path.join(folder, stack_filename(0, bf_mode, z)), bright_field(fluo, rng))
+    return [StackReader(sorted(glob.glob(os.path.join(folder, "*_%s_z*.tif" % mode)))) for mode in [fluo_mode, bf_mode]]
+
+
+def time_function(function, repeats):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t)
+    return np.min(times), result
+
+
+def nearest_kind(stats, cells, debris):
+    '''
+    :return: boolean array, True for detections that are closer to a cell than to debris
+    '''
+    found = np.stack([stats["y"], stats["x"]], axis=1)
+    d_cells = cKDTree(np.stack([cells["y"], cells["x"]], axis=1)).query(found)[0]
+    d_debris = cKDTree(np.stack([debris["y"], debris["x"]], axis=1)).query(found)[0]
+    return d_cells < d_debris
+
+
+def run(size=1024, n_slices=60, n_cells=150, n_debris=50, focus_size=5, repeats=3, seed=0):
+    cells = synthetic_cells(n_cells, size, n_slices, seed=seed)
+    debris = synthetic_cells(n_debris, size, n_slices, radius=(2, 4), brightness=(1500, 4000), seed=seed + 1)
+    with tempfile.TemporaryDirectory() as folder:
+        fluo, bf = write_stacks(folder, cells, debris, size, n_slices, seed=seed)
+        print("%d slices of %dx%d pixels per layer, %d cells, %d debris particles\n" % (
+            n_slices, size, size, n_cells, n_debris))
+
+        t_fluo, _ = time_function(lambda: project_stack(fluo.frames(), n_frames=n_slices, dtype=np.uint16), repeats)
+        t_single, single = time_function(lambda: project_stack_with_focus(
+            zip(fluo.frames(), bf.frames()), n_frames=n_slices, dtype=np.uint16, focus_size=focus_size), repeats)
+
+        def two_passes():
+            projection = project_stack(fluo.frames(), n_frames=n_slices, dtype=np.uint16)
+            return projection + project_focus(bf.frames(), projection[0], n_frames=n_slices, focus_size=focus_size)
+        t_two, two = time_function(two_passes, repeats)
+
+        print("%-36s %9s %14s" % ("", "time [s]", "slices read"))
+        print("%-36s %9.2f %14d" % ("fluorescence projection", t_fluo, n_slices))
+        print("%-36s %9.2f %14d" % ("single pass, fluorescence + BF", t_single, 2 * n_slices))
+        print("%-36s %9.2f %14d" % ("two passes (projection, then BF)", t_two, 2 * n_slices))
+        print("bright field focus costs %.2f s on top of the projection" % (t_two - t_fluo))
+        if not all(np.array_equal(a, b) for a, b in zip(single, two)):
+            print("!!! the single pass differs from the two passes")
+            return False
+
+    projection = dict(zip(["max_indices", "min_indices", "max_proj", "min_proj", "focus_indices", "focus",
+                           "focus_at_max"], single))
+    mask, detections = detect_dog(projection["max_proj"], gauss_1=1, gauss_2=2, threshold="otsu")
+    mask_clean, labeled = clean_up_mask(mask, closing_iterations=4, area_factor=1, return_labels=True)
+    stats = cell_statistics(labeled, projection["max_indices"])
+    stats.update(focus_statistics(labeled, stats["label"], projection))
+    is_cell = nearest_kind(stats, cells, debris)
+    print("\n%-12s %8s %22s %26s" % ("objects", "number", "median bf_variance", "median |bf_focus_z - z|"))
+    for name, select in [("cells", is_cell), ("debris", ~is_cell)]:
+        print("%-12s %8d %22.1f %26.1f" % (name, select.sum(), np.median(stats["bf_variance"][select]),
+                                           np.median(np.abs(stats["bf_focus_z"] - stats["z_mean"])[select])))
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the bright field focus in the projection pass.")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--slices", type=int, default=60)
+    parser.add_argument("--cells", type=int, default=150)
+    parser.add_argument("--debris", type=int, default=50)
+    parser.add_argument("--focus-size", type=int, default=5, help="window of the local variance of the bright field")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.size, args.slices, args.cells, args.debris, args.focus_size, args.repeats, args.seed)
@@ -0,0 +1,71 @@
+# Benchmark of the invasion depth curves and qq_comparison: one np.percentile call per point (previous analysis
+# scripts) against the vectorized functions in statistics.py.
+# Usage: python -m invasion_assay.benchmarks.percentiles --cells 5000
+
+import argparse
+import time
+import numpy as np
+
+from invasion_assay.statistics import invasion_depth_curve, qq_comparison, percentile
+
+
+def legacy_depth_curve(d):
+    '''
+    Invasion depth curve as calculated in 4_mutiple_conditions.py before.
+    '''
+    p = np.linspace(1, 0, len(d))
+    ps = p * 100
+    pooled_ps = np.array([percentile(d, i, method="nearest") for i in ps])
+    return p[::-1], pooled_ps
+
+
+def legacy_qq_comparison(set1, set2):
+    '''
+    qq_comparison before vectorization.
+    '''
+    l = np.max([len(set1), len(set2)])
+    percentile_range = np.linspace(0, 100, l)
+    p_set1 = []
+    p_set2 = []
+    for p in percentile_range:
+        p_set1.append(np.percentile(set1, p))
+        p_set2.append(np.percentile(set2, p))
+    return np.array(p_set1), np.array(p_set2)
+
+
+def timed(function, *args):
+    t = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - t, result
+
+
+def run(n_cells=5000, n_large=1000000):
+    rng = np.random.default_rng(0)
+    depths = -(np.round(rng.gamma(2, 10, n_cells), 2) - 100) * 5 * 1.33
+    clicked = rng.integers(0, 100, n_cells // 10)
+
+    t_legacy, legacy = timed(legacy_depth_curve, depths)
+    t_new, new = timed(invasion_depth_curve, depths)
+    if not (np.array_equal(legacy[0], new[0]) and np.array_equal(legacy[1], new[1])):
+        raise AssertionError("invasion depth curve differs from the previous implementation")
+    print("invasion depth curve, %d cells: %.3f s before, %.4f s vectorized (x%.0f)" % (
+        n_cells, t_legacy, t_new, t_legacy / t_new))
+
+    t_legacy, legacy = timed(legacy_qq_comparison, clicked, depths)
+    t_new, new = timed(qq_comparison, clicked, depths)
+    if not (np.allclose(legacy[0], new[0]) and np.allclose(legacy[1], new[1])):
+        raise AssertionError("qq_comparison differs from the previous implementation")
+    print("qq_comparison, %d cells: %.3f s before, %.4f s vectorized (x%.0f)" % (
+        n_cells, t_legacy, t_new, t_legacy / t_new))
+
+    large = rng.gamma(2, 10, n_large)
+    t_new, new = timed(invasion_depth_curve, large)
+    print("invasion depth curve, %d cells: %.3f s vectorized" % (n_large, t_new))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the percentile calculations.")
+    parser.add_argument("--cells", type=int, default=5000)
+    parser.add_argument("--large", type=int, default=1000000, help="number of cells for the large (vectorized) case")
+    args = parser.parse_args()
+    run(args.cells, args.large)
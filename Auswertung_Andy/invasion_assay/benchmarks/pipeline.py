@@ -0,0 +1,160 @@
+# Benchmark of the whole z-position pipeline on synthetic z-stacks (see synthetic_stacks.py): nuclei at known 3-D
+# positions are written as .tif files with the file names of the microscope and registered in sorted.cdb databases.
+# Every stage (create_z_stack, detect_dog, clean_up_mask, get_max_indices_and_position, fit_z_positions, write_to_db
+# and the percentile analysis) is timed, and the detected cells are compared with the true positions.
+# With --reference the detections are saved to (or, if the file exists, compared with) a reference file, to check
+# that an optimization didn't change the results.
+# Usage: python -m invasion_assay.benchmarks.pipeline --positions 4 --size 512 --slices 60 --cells 80
+#        python -m invasion_assay.benchmarks.pipeline --reference reference.npz
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import clickpoints
+from scipy.spatial import cKDTree
+
+from invasion_assay.synthetic_stacks import synthetic_cells, write_position
+from invasion_assay.database_builder import build_database
+from invasion_assay.pipeline import create_z_stack, detect_dog, clean_up_mask, get_max_indices_and_position, \
+    write_to_db, flag_variation
+from invasion_assay.focus_profile import fit_z_positions
+from invasion_assay.stack_reader import StackReader
+from invasion_assay.statistics import invasion_depth_curve, qq_comparison
+from invasion_assay.profiling import StageProfiler, print_stage_table
+from skimage.measure import label as measure_label
+
+
+def generate_plate(root, n_positions, size, n_slices, n_cells, seed=0):
+    '''
+    Writing synthetic positions to root/Ctrl/pos00, pos01, ... and building their databases.
+    :return: list of (database path, ground truth cells)
+    '''
+    positions = []
+    for pos in range(n_positions):
+        folder = os.path.join(root, "Ctrl", "pos%02d" % pos)
+        cells = synthetic_cells(n_cells, size, n_slices, seed=seed + pos)
+        write_position(folder, pos, cells, size, n_slices, seed=seed + pos)
+        np.savetxt(os.path.join(folder, "ground_truth.csv"), np.stack([cells["x"], cells["y"], cells["z"]], axis=1),
+                   delimiter=",", header="x,y,z", comments="")
+        db_path, changes = build_database(folder)
+        positions.append((db_path, cells))
+    return positions
+
+
+def evaluate_position(db_path, profiler, layer="modeFluo5"):
+    '''
+    Running the stages of process_position one by one (without the cache).
+    :return: dictionary with "x", "y", "z" (mean of the maximum indices) and "z_fit" of the detected cells
+    '''
+    db = clickpoints.DataFile(db_path, "r")
+    try:
+        with profiler.stage("create_z_stack") as record:
+            max_indices, min_indices, max_proj, min_proj = create_z_stack(db, layer, progress=False,
+                                                                          profiler=profiler)
+            record["items"] = max_indices.size
+        with profiler.stage("detect_dog", items=max_indices.size):
+            mask, detections = detect_dog(max_proj, gauss_1=1, gauss_2=2, threshold="otsu")
+        with profiler.stage("clean_up_mask", items=max_indices.size):
+            mask_clean = clean_up_mask(mask, closing_iterations=4, area_factor=1)
+        with profiler.stage("get_max_indices") as record:
+            z, index_variation, pos_list = get_max_indices_and_position(mask_clean, max_indices)
+            record["items"] = len(z)
+        with profiler.stage("fit_z_positions", items=len(z)):
+            stack = StackReader.from_database(db, layer, keep_open=True)
+            z_fit = fit_z_positions(stack, measure_label(mask_clean))
+        with profiler.stage("write_to_db", items=len(z)):
+            write_to_db(db, z, pos_list, index_variation, flag_variation(index_variation), layer=layer,
+                        marker_type_name="cell_in_focus")
+    finally:
+        db.db.close()
+    pos_list = np.asarray(pos_list).reshape(-1, 2)
+    return {"x": pos_list[:, 1], "y": pos_list[:, 0], "z": np.asarray(z, dtype=float),
+            "z_fit": np.asarray(z_fit, dtype=float)}
+
+
+def accuracy(cells, found, max_distance=8):
+    '''
+    Matching the detected cells to the true cells (nearest detection in xy within max_distance pixels).
+    :return: dictionary with "found" (fraction of true cells that were detected), "false" (fraction of detections
+    without a true cell), "z_error" and "z_fit_error" (mean absolute error of the matched cells in slices)
+    '''
+    n_true, n_found = len(cells["z"]), len(found["z"])
+    if n_true == 0 or n_found == 0:
+        return {"found": 0.0 if n_true else np.nan, "false": 1.0 if n_found else np.nan, "z_error": np.nan,
+                "z_fit_error": np.nan}
+    distance, index = cKDTree(np.stack([found["y"], found["x"]], axis=1)).query(
+        np.stack([cells["y"], cells["x"]], axis=1))
+    matched = distance <= max_distance
+    true_z, found_index = cells["z"][matched], index[matched]
+    return {"found": matched.mean(), "false": 1 - len(np.unique(found_index)) / n_found,
+            "z_error": np.mean(np.abs(found["z"][found_index] - true_z)) if matched.any() else np.nan,
+            "z_fit_error": np.nanmean(np.abs(found["z_fit"][found_index] - true_z)) if matched.any() else np.nan}
+
+
+def compare_reference(results, path):
+    '''
+    Saving the detections to path, or comparing them with the detections saved there before.
+    :return: True if the file was written or the detections are the same
+    '''
+    arrays = {"%d_%s" % (i, c): r[c] for i, r in enumerate(results) for c in ["x", "y", "z", "z_fit"]}
+    if not os.path.exists(path):
+        np.savez(path, **arrays)
+        print("reference written to %s" % path)
+        return True
+    with np.load(path) as reference:
+        differences = [k for k in set(arrays) | set(reference.files) if k not in arrays or k not in reference.files
+                       or arrays[k].shape != reference[k].shape
+                       or not np.allclose(arrays[k], reference[k], equal_nan=True)]
+    if differences:
+        print("detections differ from the reference %s: %s" % (path, ", ".join(sorted(differences))))
+        return False
+    print("detections are the same as in the reference %s" % path)
+    return True
+
+
+def run(n_positions=2, size=256, n_slices=40, n_cells=40, seed=0, folder=None, reference=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = folder or tmp
+        print("writing %d positions (%d slices of %dx%d pixels, %d cells) to %s" % (n_positions, n_slices, size, size,
+                                                                                    n_cells, root))
+        positions = generate_plate(root, n_positions, size, n_slices, n_cells, seed=seed)
+
+        profiler = StageProfiler()
+        results = []
+        print("\n%-8s %6s %6s %7s %7s %9s %11s" % ("position", "cells", "found", "found%", "false%", "z error",
+                                                   "z_fit error"))
+        for i, (db_path, cells) in enumerate(positions):
+            profiler.position = db_path
+            results.append(evaluate_position(db_path, profiler))
+            a = accuracy(cells, results[-1])
+            print("%-8s %6d %6d %7.1f %7.1f %9.2f %11.2f" % ("pos%02d" % i, len(cells["z"]), len(results[-1]["z"]),
+                                                             100 * a["found"], 100 * a["false"], a["z_error"],
+                                                             a["z_fit_error"]))
+
+        # analysis of the pooled depths, as in 4_mutiple_conditions.py
+        with profiler.stage("percentiles") as record:
+            depths = np.concatenate([r["z"] for r in results])
+            invasion_depth_curve(depths)
+            qq_comparison(np.concatenate([c["z"] for db_path, c in positions]), depths)
+            record["items"] = len(depths)
+
+        print_stage_table([{"stages": profiler.records}])
+        if reference is not None and not compare_reference(results, reference):
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the z-position pipeline on synthetic z-stacks.")
+    parser.add_argument("--positions", type=int, default=2)
+    parser.add_argument("--size", type=int, default=256, help="edge length of the slices in pixels")
+    parser.add_argument("--slices", type=int, default=40)
+    parser.add_argument("--cells", type=int, default=40, help="number of cells per position")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folder", default=None, help="keep the synthetic data in this folder")
+    parser.add_argument("--reference", default=None, help="npz file to save or compare the detections")
+    args = parser.parse_args()
+    ok = run(args.positions, args.size, args.slices, args.cells, args.seed, args.folder, args.reference)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,87 @@
+# Benchmark of the single-pass projection engine against the previous per-frame loop of create_z_stack.
+# Usage: python -m invasion_assay.benchmarks.projection --slices 200 --size 1024
+
+import argparse
+import time
+import numpy as np
+
+from invasion_assay.projection import project_stack
+
+
+def legacy_create_z_stack(frames):
+    '''
+    The loop that create_z_stack used before the projection engine, working on a list of slices instead of a database.
+    :param frames: list of 2-D np.ndarrays
+    :return: max_indices, min_indices, max_proj, min_proj
+    '''
+    im_shape = frames[0].shape
+    min_proj = np.zeros(im_shape, dtype=np.uint16) + np.inf
+    max_proj = np.zeros(im_shape, dtype=np.uint16)
+    min_indices = np.zeros(im_shape, dtype=np.uint16)
+    max_indices = np.zeros(im_shape, dtype=np.uint16)
+
+    for height, frame in enumerate(frames):
+        shot = frame.astype(float)
+        mask = shot < min_proj
+        min_proj[mask] = shot[mask]
+        min_indices[mask] = height
+
+        mask = shot > max_proj
+        max_proj[mask] = shot[mask]
+        max_indices[mask] = height
+
+    return max_indices, min_indices, max_proj, min_proj
+
+
+def synthetic_stack(n_slices, size, seed=0):
+    '''
+    Random uint16 stack with a few bright spots at random depths, similar to the range of the fluorescence images.
+    :param n_slices: number of slices
+    :param size: edge length of the (square) slices
+    :param seed: seed of the random number generator
+    :return: list of 2-D np.ndarrays
+    '''
+    rng = np.random.default_rng(seed)
+    frames = [rng.integers(90, 130, size=(size, size)).astype(np.uint16) for _ in range(n_slices)]
+    for _ in range(size // 8):
+        z, y, x = rng.integers(0, n_slices), rng.integers(0, size - 8), rng.integers(0, size - 8)
+        frames[z][y:y + 8, x:x + 8] += np.uint16(rng.integers(500, 3000))
+    return frames
+
+
+def time_function(function, repeats):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t)
+    return np.min(times), result
+
+
+def run(n_slices=200, size=1024, repeats=3, tile_rows=None):
+    frames = synthetic_stack(n_slices, size)
+    t_legacy, legacy = time_function(lambda: legacy_create_z_stack(frames), repeats)
+    t_new, new = time_function(lambda: project_stack(frames, n_frames=n_slices, dtype=np.uint16), repeats)
+    t_tiled, tiled = time_function(lambda: project_stack(frames, n_frames=n_slices, dtype=np.uint16,
+                                                         tile_rows=tile_rows or 128), repeats)
+
+    for name, result in [("single pass", new), ("tiled", tiled)]:
+        for a, b, label in zip(legacy, result, ["max_indices", "min_indices", "max_proj", "min_proj"]):
+            if not np.array_equal(a, b):
+                raise AssertionError("%s: %s differs from the previous implementation" % (name, label))
+
+    print("stack: %d slices of %dx%d pixels" % (n_slices, size, size))
+    print("previous loop:      %.3f s" % t_legacy)
+    print("single pass:        %.3f s  (x%.1f)" % (t_new, t_legacy / t_new))
+    print("single pass, tiled: %.3f s  (x%.1f)" % (t_tiled, t_legacy / t_tiled))
+    print("index map dtype: %s, projection dtype: %s" % (new[0].dtype, new[2].dtype))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the z-projection engine.")
+    parser.add_argument("--slices", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tile-rows", type=int, default=None)
+    args = parser.parse_args()
+    run(args.slices, args.size, args.repeats, args.tile_rows)
@@ -0,0 +1,97 @@
+# Benchmark of the start-up time of the entry points (the time until the first line of work runs): every entry point's
+# imports are run in a new Python process, in headless mode (default) and with the clickpoints GUI parts
+# (INVASION_ASSAY_HEADLESS=0). The imports of the numbered scripts (and their use_headless() call) are taken from the
+# scripts themselves, so this follows changes of the scripts. Modules are imported after use_headless(), as on the
+# command line and in the worker processes. Also checks that no non-plotting entry point loads matplotlib.pyplot or Qt.
+# With --output the times are appended to a JSON lines file, to track them over time.
+# Exits with 1 if an entry point is slower than --target seconds or loads pyplot in headless mode.
+# Usage: python -m invasion_assay.benchmarks.startup --repeats 5 [--output startup_times.jsonl]
+
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import numpy as np
+
+script_folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# entry points without plotting: name -> script (imports are read from it) or module
+entry_points = {"1-Move-files-in-pos-folder.py": "script", "sortLayersCoverT.py": "script",
+                "2-launch_sortLayersCoverT.py": "script", "3-finding_z_postion_of_sharp_cells.py": "script",
+                "invasion_assay.experiment": "module", "invasion_assay.watch": "module",
+                "invasion_assay.batch": "module", "invasion_assay.pipeline": "module"}
+check = "import sys; print(int('matplotlib.pyplot' in sys.modules), int(any(m.split('.')[0] in ('PyQt5', 'PyQt6', " \
+        "'PySide2', 'qtpy') for m in sys.modules)))"
+
+
+def script_imports(path):
+    '''
+    Import statements and use_headless() calls at the top level of a script (other code of the script is not run).
+    :return: string with one statement per line
+    '''
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+                     or is_headless_call(node))
+
+
+def is_headless_call(node):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and \
+        getattr(node.value.func, "id", getattr(node.value.func, "attr", None)) == "use_headless"
+
+
+def entry_point_code(name, kind):
+    if kind == "script":
+        return script_imports(os.path.join(script_folder, name))
+    return "import invasion_assay\ninvasion_assay.use_headless()\nimport " + name
+
+
+def time_start(code, headless=True):
+    '''
+    Running code in a new Python process.
+    :return: wall time in seconds, pyplot loaded, Qt loaded
+    '''
+    env = dict(os.environ, INVASION_ASSAY_HEADLESS="1" if headless else "0")
+    t = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code + "\n" + check], cwd=script_folder, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    wall = time.perf_counter() - t
+    pyplot, qt = output.split()[-2:]
+    return wall, pyplot == "1", qt == "1"
+
+
+def run(repeats=5, target=1.0, output=None):
+    baseline = np.median([time_start("pass")[0] for _ in range(repeats)])
+    print("python start without imports: %.3f s\n" % baseline)
+    print("%-40s %10s %10s %8s %10s" % ("entry point", "headless", "with GUI", "pyplot", "Qt"))
+    results = []
+    ok = True
+    for name, kind in entry_points.items():
+        code = entry_point_code(name, kind)
+        headless = [time_start(code) for _ in range(repeats)]
+        gui = [time_start(code, headless=False) for _ in range(repeats)]
+        wall = np.median([h[0] for h in headless])
+        pyplot, qt = headless[-1][1:]
+        print("%-40s %9.3fs %9.3fs %8s %10s" % (name, wall, np.median([g[0] for g in gui]), pyplot, qt))
+        results.append({"entry_point": name, "headless": wall, "gui": np.median([g[0] for g in gui]),
+                        "pyplot": pyplot, "qt": qt})
+        ok &= wall <= target and not pyplot and not qt
+    print("\n%s (target: %.1f s, no pyplot, no Qt)" % ("ok" if ok else "FAILED", target))
+    if output is not None:
+        with open(output, "a") as f:
+            f.write(json.dumps({"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                                "python": sys.version.split()[0], "baseline": baseline, "results": results},
+                               default=float) + "\n")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the start-up time of the entry points.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--target", type=float, default=1.0, help="maximal start-up time in seconds")
+    parser.add_argument("--output", default=None, help="JSON lines file that the times are appended to")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.repeats, args.target, args.output) else 1)
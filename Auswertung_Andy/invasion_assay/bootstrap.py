@@ -0,0 +1,184 @@
+# Bootstrap confidence bands for invasion depth curves (see statistics.invasion_depth_curve) and for the difference of
+# the curves of two conditions.
+#
+# A bootstrap resample of n cells is n draws from the measured depths. Its k-th smallest value is the depth at rank
+# ceil(n * U_(k)), where U_(k) is the k-th order statistic of n uniform random numbers. The order statistics at the
+# ranks needed for the curve are drawn directly (successive Beta distributed steps), so a resample costs one random
+# number per point of the curve instead of one per cell. Resamples are computed in batches of vectorized draws,
+# optionally in a pool of worker processes.
+# With groups (e.g. the position of each cell) whole positions are resampled instead of cells (cluster bootstrap),
+# which includes the variation between positions; this needs one weight per cell and resample.
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+def default_probabilities(n_points=501):
+    '''
+    :return: probabilities P(depth >= D) from 0 to 1 at which the curves are evaluated
+    '''
+    return np.linspace(0, 1, n_points)
+
+
+def curve_ranks(n, p):
+    '''
+    Index (in the ascending sorted depths) of the depth D with P(depth >= D) = p, as in invasion_depth_curve.
+    :param n: number of cells
+    :param p: array of probabilities
+    :return: array of int
+    '''
+    return np.around((1 - np.asarray(p)) * (n - 1)).astype(int)
+
+
+def uniform_order_statistics(n, ranks, size, rng):
+    '''
+    Joint draw of the order statistics U_(k) of n uniform random numbers for the given ranks.
+    :param n: number of uniform random numbers
+    :param ranks: strictly increasing 1-D array of ranks (1 to n)
+    :param size: number of draws
+    :param rng: np.random.Generator
+    :return: np.ndarray of shape (size, len(ranks))
+    '''
+    # 1 - U_(k_i) = (1 - U_(k_i-1)) * (1 - B_i) with B_i ~ Beta(k_i - k_i-1, n - k_i + 1)
+    steps = np.diff(np.concatenate([[0], ranks]))
+    b = rng.beta(steps, n - ranks + 1, size=(size, len(ranks)))
+    return 1 - np.cumprod(1 - b, axis=1)
+
+
+def _resample_cells(sorted_depths, ranks, size, seed):
+    '''
+    Depths at the given indices (see curve_ranks) for size bootstrap resamples of the cells.
+    :return: np.ndarray of shape (size, len(ranks))
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(sorted_depths)
+    unique_ranks, inverse = np.unique(ranks, return_inverse=True)
+    u = uniform_order_statistics(n, unique_ranks + 1, size, rng)
+    indices = np.minimum(np.ceil(u * n).astype(int) - 1, n - 1)
+    return sorted_depths[np.maximum(indices, 0)][:, inverse]
+
+
+def _resample_groups(sorted_depths, group_cumulative, p, size, seed):
+    '''
+    Depths at the probabilities p for size cluster bootstrap resamples: the groups (positions) are drawn with
+    replacement, every cell gets the number of draws of its group as weight.
+    :param group_cumulative: np.ndarray of shape (cells, groups); number of cells of each group up to each sorted cell
+    :return: np.ndarray of shape (size, len(p))
+    '''
+    rng = np.random.default_rng(seed)
+    n_groups = group_cumulative.shape[1]
+    counts = rng.multinomial(n_groups, np.full(n_groups, 1 / n_groups), size=size)
+    # cumulative weights of the sorted cells for every resample (exact, the values are small integers)
+    cumulative = counts.astype(float) @ group_cumulative.T
+    total = cumulative[:, -1:]
+    # index of the weighted order statistic, same rounding as curve_ranks
+    targets = np.around((1 - np.asarray(p))[None, :] * (total - 1))
+    # row-wise searchsorted: the rows are shifted so that they don't overlap
+    offset = (np.arange(size) * (cumulative[:, -1].max() + 1))[:, None]
+    indices = np.searchsorted((cumulative + offset).ravel(), (targets + offset).ravel(), side="right")
+    return sorted_depths[indices.reshape(size, -1) - np.arange(size)[:, None] * len(sorted_depths)]
+
+
+def bootstrap_curves(depths, p=None, n_resamples=10000, groups=None, batch_size=None, workers=None, seed=0):
+    '''
+    Invasion depth curves of bootstrap resamples.
+    :param depths: 1-D np.ndarray of invasion depths
+    :param p: probabilities P(depth >= D) at which the curves are evaluated (default: default_probabilities())
+    :param n_resamples: number of resamples
+    :param groups: optional 1-D array with the group (e.g. position) of each cell; groups are resampled instead of cells
+    :param batch_size: number of resamples that are drawn at once (default: about 20 million values per batch)
+    :param workers: number of worker processes; None or 1 computes all batches in this process
+    :param seed: seed of the random number generator (the result doesn't depend on the number of workers)
+    :return: np.ndarray of shape (n_resamples, len(p))
+    '''
+    p = default_probabilities() if p is None else np.asarray(p)
+    depths = np.asarray(depths, dtype=float)
+    order = np.argsort(depths, kind="stable")
+    sorted_depths = depths[order]
+    if groups is None:
+        ranks = curve_ranks(len(depths), p)
+        batch_size = batch_size or max(1, int(2e7 // len(p)))
+        job, args = _resample_cells, (sorted_depths, ranks)
+    else:
+        sorted_groups = np.unique(np.asarray(groups), return_inverse=True)[1][order]
+        group_cumulative = np.cumsum(np.eye(sorted_groups.max() + 1)[sorted_groups], axis=0)
+        batch_size = batch_size or max(1, int(2e7 // len(depths)))
+        job, args = _resample_groups, (sorted_depths, group_cumulative, p)
+
+    sizes = [min(batch_size, n_resamples - i) for i in range(0, n_resamples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers is None or workers == 1:
+        batches = [job(*args, size, s) for size, s in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            batches = list(executor.map(job, *zip(*[args + (size, s) for size, s in zip(sizes, seeds)])))
+    return np.concatenate(batches, axis=0)
+
+
+def percentile_band(curves, confidence=0.95):
+    '''
+    Pointwise confidence band (percentile method) of bootstrap curves.
+    :return: lower, upper
+    '''
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(curves, [alpha, 1 - alpha], axis=0)
+    return lower, upper
+
+
+def depth_band(depths, p=None, confidence=0.95, **kwargs):
+    '''
+    Invasion depth curve with bootstrap confidence band.
+    :param depths: 1-D np.ndarray of invasion depths
+    :param p: probabilities P(depth >= D) (default: default_probabilities())
+    :param confidence: confidence level of the band
+    :param kwargs: parameters of bootstrap_curves (n_resamples, groups, batch_size, workers, seed)
+    :return: dictionary with "p", "depth" (curve of the measured depths), "lower" and "upper"
+    '''
+    p = default_probabilities() if p is None else np.asarray(p)
+    depth = np.sort(depths)[curve_ranks(len(depths), p)]
+    lower, upper = percentile_band(bootstrap_curves(depths, p, **kwargs), confidence)
+    return {"p": p, "depth": depth, "lower": lower, "upper": upper}
+
+
+def difference_band(depths_a, depths_b, p=None, confidence=0.95, groups_a=None, groups_b=None, seed=0, **kwargs):
+    '''
+    Difference of the invasion depth curves of two conditions (a - b) with bootstrap confidence band. The conditions
+    are resampled independently.
+    :param depths_a, depths_b: 1-D np.ndarrays of invasion depths
+    :param p: probabilities P(depth >= D) (default: default_probabilities())
+    :param confidence: confidence level of the band
+    :param groups_a, groups_b: optional groups (positions) of the cells, see bootstrap_curves
+    :param seed: seed of the random number generator
+    :param kwargs: parameters of bootstrap_curves (n_resamples, batch_size, workers)
+    :return: dictionary with "p", "difference", "lower", "upper" and "significant" (the band doesn't include 0)
+    '''
+    p = default_probabilities() if p is None else np.asarray(p)
+    difference = np.sort(depths_a)[curve_ranks(len(depths_a), p)] - np.sort(depths_b)[curve_ranks(len(depths_b), p)]
+    curves = bootstrap_curves(depths_a, p, groups=groups_a, seed=[seed, 0], **kwargs) - \
+        bootstrap_curves(depths_b, p, groups=groups_b, seed=[seed, 1], **kwargs)
+    lower, upper = percentile_band(curves, confidence)
+    return {"p": p, "difference": difference, "lower": lower, "upper": upper,
+            "significant": (lower > 0) | (upper < 0)}
+
+
+def condition_bands(data, confidence=0.95, reference=None, by_position=False, **kwargs):
+    '''
+    Confidence bands for all conditions, for data in the format of 4_mutiple_conditions.py.
+    :param data: dictionary condition -> list of 1-D np.ndarrays (depths of the cells of each position)
+    :param confidence: confidence level of the bands
+    :param reference: condition that the other conditions are compared with (None: no differences)
+    :param by_position: boolean; resample whole positions (cluster bootstrap) instead of cells
+    :param kwargs: parameters of bootstrap_curves (p, n_resamples, batch_size, workers, seed)
+    :return: dictionary condition -> depth_band; dictionary condition -> difference_band to the reference
+    '''
+    pooled = {cond: np.concatenate(d) for cond, d in data.items()}
+    groups = {cond: np.repeat(np.arange(len(d)), [len(x) for x in d]) if by_position else None
+              for cond, d in data.items()}
+    bands = {cond: depth_band(pooled[cond], confidence=confidence, groups=groups[cond], **kwargs) for cond in data}
+    differences = {}
+    if reference is not None:
+        for cond in data:
+            if cond != reference:
+                differences[cond] = difference_band(pooled[cond], pooled[reference], confidence=confidence,
+                                                    groups_a=groups[cond], groups_b=groups[reference], **kwargs)
+    return bands, differences
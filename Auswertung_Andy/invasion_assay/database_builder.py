@@ -0,0 +1,212 @@
+# Building the clickpoints databases (sorted.cdb) of the position folders. The mode (BF/Fluo) of an image is used as
+# layer and the z-slice as index (frame number), see sortLayersCoverT.py. build_databases builds the databases of all
+# positions of an experiment in a pool of worker processes, so that the interpreter and clickpoints are only loaded
+# once per worker and not once per position.
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from clickpoints import DataFile
+
+from invasion_assay import use_headless
+from invasion_assay.file_router import parse_filename, pos_folder_pattern
+
+default_channels = ['modeBF', 'modeFluo5']
+
+
+def insert_many(table, rows, chunk_size=100):
+    '''
+    Inserting rows into a database table in chunks. The chunks are small enough for the default limit of 999 variables
+    per statement of SQLite (clickpoints' saveInsertMany probes this limit first, which takes seconds).
+    :param table: peewee model, e.g. db.table_marker
+    :param rows: list of dictionaries
+    :param chunk_size: number of rows per insert statement
+    :return:
+    '''
+    for i in range(0, len(rows), chunk_size):
+        table.insert_many(rows[i:i + chunk_size]).execute()
+
+
+def sort_stack_files(files, channels):
+    '''
+    Sorting the images of a position by rep and z. The file names are parsed once (see file_router.parse_filename).
+    :param files: list of file names
+    :param channels: list of mode names
+    :return: dictionary channel -> list of (frame, file name), where frame is the index of (rep, z) in the sorted list
+    of all (rep, z) of all channels, so that images of the same slice get the same frame in every channel; list of
+    files that don't follow the naming scheme
+    '''
+    parsed = {channel: [] for channel in channels}
+    unmatched = []
+    for file in files:
+        info = parse_filename(file)
+        if info is None or info["mode"] not in parsed:
+            unmatched.append(file)
+            continue
+        parsed[info["mode"]].append(((int(info["rep"]), int(info["z"])), file))
+    slices = sorted({key for images in parsed.values() for key, file in images})
+    frame = {key: i for i, key in enumerate(slices)}
+    return {channel: [(frame[key], file) for key, file in sorted(images)] for channel, images in parsed.items()}, \
+        unmatched
+
+
+def sync_images(db, files, channels):
+    '''
+    Synchronizing the images of a database with the images of the position folder, with the mode as layer and the
+    slice (rep, z) as sort_index. New files are added, images whose file is missing are deleted (with their markers)
+    and the sort_index of the other images is only changed if new slices were inserted in between. Markers and marker
+    types of the remaining images are kept. All changes are done in one transaction.
+    :param db: clickpoints Database object; the database file is in the image folder
+    :param files: list of file names
+    :param channels: list of mode names
+    :return: dictionary with the numbers of "added", "removed" and "reordered" images and "unmatched" (list of files
+    that don't follow the naming scheme)
+    '''
+    stacks, unmatched = sort_stack_files(files, channels)
+    image = db.table_image
+    with db.db.atomic():
+        path = db.setPath('.')
+        layers = {channel: db.setLayer(channel).id for channel in channels}
+        wanted = {(layers[channel], file): frame for channel in channels for frame, file in stacks[channel]}
+        existing = {(layer, file): (id, sort_index) for id, file, layer, sort_index in
+                    image.select(image.id, image.filename, image.layer, image.sort_index)
+                    .where(image.layer.in_(list(layers.values()))).tuples()}
+
+        removed = [id for key, (id, sort_index) in existing.items() if key not in wanted]
+        for i in range(0, len(removed), 500):
+            image.delete().where(image.id.in_(removed[i:i + 500])).execute()
+        reordered = [(id, wanted[key]) for key, (id, sort_index) in existing.items()
+                     if key in wanted and wanted[key] != sort_index]
+        for id, frame in reordered:
+            image.update(sort_index=frame).where(image.id == id).execute()
+        added = [{"filename": file, "ext": os.path.splitext(file)[1], "frame": 0, "sort_index": frame,
+                  "path": path.id, "layer": layer} for (layer, file), frame in sorted(wanted.items())
+                 if (layer, file) not in existing]
+        insert_many(image, added)
+    return {"added": len(added), "removed": len(removed),
+            "reordered": len(reordered), "unmatched": unmatched}
+
+
+def build_database(src_path, channels=None, db_name="sorted.cdb", sync=False):
+    '''
+    Generating the clickpoints database of one position folder with image z-stacks of BF and Fluo images. The images
+    are sorted by rep and z (read from the file names), so the frame number in the database is the slice of the
+    z-stack.
+    :param src_path: position folder with the .tif images
+    :param channels: list of the mode names, e.g. [BF, Fluo]; used as layer names
+    :param db_name: name of the database file
+    :param sync: boolean; update an existing database (see sync_images) instead of deleting it, so that markers are
+    kept and only new or missing files cost time
+    :return: path to the database; dictionary of changes from sync_images
+    '''
+    channels = channels or default_channels
+    with os.scandir(src_path) as entries:
+        files = [entry.name for entry in entries if entry.name.endswith(".tif")]
+
+    db_path = os.path.join(src_path, db_name)
+    new_database = not (sync and os.path.exists(db_path))
+    db = DataFile(db_path, 'w' if new_database else 'r+')
+    try:
+        changes = sync_images(db, files, channels)
+        if len(changes["unmatched"]) > 0:
+            print("%s: %d .tif files were not registered (unknown mode or name), e.g. %s" % (
+                src_path, len(changes["unmatched"]), changes["unmatched"][0]))
+        if new_database:
+            db.setMarkerType(name='cell_in_focus', color='#ff0000', mode=db.TYPE_Track)
+            db.setMarkerType(name='not_a_cell', color='#e2ff00', mode=db.TYPE_Track)
+    finally:
+        db.db.close()
+    return db_path, changes
+
+
+def is_up_to_date(src_path, db_name="sorted.cdb"):
+    '''
+    Checking if the database of a position folder is newer than all .tif images in the folder.
+    :return: boolean
+    '''
+    db_path = os.path.join(src_path, db_name)
+    if not os.path.exists(db_path):
+        return False
+    db_time = os.path.getmtime(db_path)
+    with os.scandir(src_path) as entries:
+        return all(entry.stat().st_mtime <= db_time for entry in entries if entry.name.endswith(".tif"))
+
+
+def find_position_folders(rootdir):
+    '''
+    :param rootdir: experiment folder (all sub folders are searched)
+    :return: sorted list of position folders
+    '''
+    return sorted(dir for dir, subdirs, files in os.walk(rootdir) if pos_folder_pattern.search(os.path.split(dir)[1]))
+
+
+def _build_position(src_path, channels, db_name, resume, sync):
+    '''
+    Building the database of one position and catching all errors, so that a bad position doesn't stop the others.
+    :return: summary dictionary of the position
+    '''
+    t_start = time.time()
+    summary = {"position": src_path, "skipped": False, "changes": None, "runtime": None, "error": None}
+    try:
+        if resume and is_up_to_date(src_path, db_name):
+            summary["skipped"] = True
+        else:
+            db_path, summary["changes"] = build_database(src_path, channels, db_name, sync=sync)
+    except Exception:
+        summary["error"] = traceback.format_exc()
+    summary["runtime"] = time.time() - t_start
+    return summary
+
+
+def build_databases(rootdir, workers=None, channels=None, db_name="sorted.cdb", resume=False, sync=False):
+    '''
+    Building the databases of all position folders in rootdir in parallel.
+    :param rootdir: experiment folder
+    :param workers: int; number of worker processes (default: number of CPUs). With 1 worker all databases are built
+    in this process.
+    :param channels: list of the two mode names [BF, Fluo]
+    :param db_name: name of the database file in each position folder
+    :param resume: boolean; skip positions whose database is newer than all of their images
+    :param sync: boolean; update existing databases instead of rebuilding them (markers are kept)
+    :return: list of summary dictionaries (keys "position", "skipped", "changes", "runtime" and "error"), sorted by
+    position
+    '''
+    folders = find_position_folders(rootdir)
+    print("%d position folders found in %s" % (len(folders), rootdir))
+    workers = workers or os.cpu_count()
+
+    summaries = []
+    if workers == 1:
+        for folder in folders:
+            summaries.append(_build_position(folder, channels, db_name, resume, sync))
+            print_build_line(summaries[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_headless) as executor:
+            futures = [executor.submit(_build_position, folder, channels, db_name, resume, sync)
+                       for folder in folders]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                print_build_line(summaries[-1])
+    return sorted(summaries, key=lambda s: s["position"])
+
+
+def print_build_line(summary):
+    if summary["error"] is not None:
+        print("%s: failed (%.1f s)\n%s" % (summary["position"], summary["runtime"], summary["error"]))
+    elif summary["skipped"]:
+        print("%s: up to date" % summary["position"])
+    else:
+        print("%s: %d images added, %d removed, %d reordered (%.1f s)" % (
+            summary["position"], summary["changes"]["added"], summary["changes"]["removed"],
+            summary["changes"]["reordered"], summary["runtime"]))
+
+
+def print_build_summary(summaries):
+    failed = [s for s in summaries if s["error"] is not None]
+    skipped = [s for s in summaries if s["skipped"]]
+    print("\n%d positions: %d built, %d up to date, %d failed, %.1f s total" % (
+        len(summaries), len(summaries) - len(failed) - len(skipped), len(skipped), len(failed),
+        sum(s["runtime"] for s in summaries)))
+    for s in failed:
+        print("failed: %s" % s["position"])
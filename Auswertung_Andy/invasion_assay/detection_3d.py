@@ -0,0 +1,182 @@
+# Detection of nuclei directly in the (z, y, x) stack, instead of in the maximum projection (pipeline.detect_dog).
+# Cells that overlap in x and y but lie at different depths are separate objects in 3-D, while they merge into one
+# object in the projection (high index_variation, see flag_variation).
+# The stack is processed in chunks of slices by a pool of threads, so only a few chunks are in memory at a time:
+# 1) every chunk is read with a margin of slices and filtered with a 3-D difference of gaussians (float32, the margin
+#    covers the gaussian kernels in z, so the chunks fit together without seams),
+# 2) the threshold (otsu or mean_std as in detect_dog) is calculated from a subsample of the filtered stack,
+# 3) every chunk is filtered again, thresholded and labeled (26-connected); only the moments of the objects (voxel
+#    count, intensity weighted sums of z, y, x and z^2) and the labels of the first and last slice are kept,
+# 4) objects that touch across the border between two chunks are joined (connected components of the touching
+#    pairs) and their moments are added, so the result is the same as labeling the whole stack at once.
+# The filtering is done twice (steps 1 and 3) to keep the memory bounded; with threshold="absolute" step 1 is skipped.
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from invasion_assay.dog_filter import dog_threshold
+
+# same kernel size as dog_filter
+truncate = 4.0
+# 26-connected neighbourhood (8-connected in each slice, like measure_label in 2-D)
+full_structure = np.ones((3, 3, 3), dtype=bool)
+# moments of each object, summed over its voxels
+moment_names = ["voxels", "weight", "z", "y", "x", "z2"]
+
+
+def get_chunks(n_slices, chunk_size):
+    '''
+    :return: list of (start, stop) of the chunks
+    '''
+    return [(z, min(z + chunk_size, n_slices)) for z in range(0, n_slices, chunk_size)]
+
+
+def _read_block(stack, start, stop):
+    '''
+    Slices start to stop of the stack as float32, integer images are scaled to [0, 1] (as in dog_filter).
+    '''
+    block = np.empty((stop - start,) + stack.shape[1:], dtype=np.float32)
+    for i, z in enumerate(range(start, stop)):
+        frame = stack[z]
+        block[i] = frame
+        if np.issubdtype(frame.dtype, np.integer):
+            block[i] /= np.iinfo(frame.dtype).max
+    return block
+
+
+def dog_filter_chunk(stack, start, stop, sigma_1, sigma_2):
+    '''
+    3-D difference of gaussians of the slices start to stop of a stack. The slices are read with a margin that covers
+    the kernels in z (cropped at the first and last slice, where the "nearest" mode applies), the gaussians are
+    applied one axis at a time and the y and x axes are only filtered for the slices of the chunk.
+    :param stack: StackReader (or (z, y, x) np.ndarray)
+    :param start, stop: slices of the chunk
+    :param sigma_1, sigma_2: (z, y, x) sigmas of the two gaussians, in slices and pixels
+    :return: np.ndarray (float32) of shape (stop - start, y, x)
+    '''
+    margin = int(truncate * max(sigma_1[0], sigma_2[0]) + 0.5)
+    z0, z1 = max(start - margin, 0), min(stop + margin, len(stack))
+    block = _read_block(stack, z0, z1)
+    result = None
+    for sigma in [sigma_1, sigma_2]:
+        filtered = ndimage.gaussian_filter1d(block, sigma[0], axis=0, mode="nearest", truncate=truncate)
+        # copy of the slices of the chunk, so that the filtered margin can be freed
+        filtered = filtered[start - z0:stop - z0].copy()
+        for axis in (1, 2):
+            ndimage.gaussian_filter1d(filtered, sigma[axis], axis=axis, mode="nearest", truncate=truncate,
+                                      output=filtered)
+        if result is None:
+            result = filtered
+        else:
+            result -= filtered
+    return result
+
+
+def _sample_chunk(stack, chunk, sigma_1, sigma_2, sample_step):
+    dog = dog_filter_chunk(stack, *chunk, sigma_1, sigma_2)
+    return dog[:, ::sample_step, ::sample_step].ravel()
+
+
+def _label_chunk(stack, chunk, sigma_1, sigma_2, threshold):
+    '''
+    Filtering, thresholding and labeling one chunk.
+    :return: number of objects, moments (array of shape (len(moment_names), n + 1), index 0 is the background), labels
+    of the first and of the last slice of the chunk
+    '''
+    start, stop = chunk
+    dog = dog_filter_chunk(stack, start, stop, sigma_1, sigma_2)
+    labeled, n = ndimage.label(dog > threshold, structure=full_structure)
+    flat = np.flatnonzero(labeled)
+    labels = labeled.ravel()[flat]
+    weight = dog.ravel()[flat].astype(np.float64)
+    z, y, x = np.unravel_index(flat, labeled.shape)
+    z = z + start
+    moments = np.stack([np.bincount(labels, weights=w, minlength=n + 1)
+                        for w in [np.ones_like(weight), weight, weight * z, weight * y, weight * x, weight * z ** 2]])
+    return n, moments, labeled[0].copy(), labeled[-1].copy()
+
+
+def touching_pairs(last, first):
+    '''
+    Pairs of labels that are 26-connected across the border between two chunks.
+    :param last: labels of the last slice of a chunk
+    :param first: labels of the first slice of the next chunk
+    :return: np.ndarray of shape (n, 2), unique pairs (label in last, label in first)
+    '''
+    rows, cols = last.shape
+    pairs = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            a = last[max(dy, 0):rows + min(dy, 0), max(dx, 0):cols + min(dx, 0)]
+            b = first[max(-dy, 0):rows + min(-dy, 0), max(-dx, 0):cols + min(-dx, 0)]
+            both = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[both], b[both]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def stitch_chunks(results):
+    '''
+    Joining the objects of all chunks.
+    :param results: list of the results of _label_chunk, in the order of the chunks
+    :return: moments of the joined objects (array of shape (len(moment_names), n_objects))
+    '''
+    counts = [r[0] for r in results]
+    # global label of local label l of chunk i: offsets[i] + l - 1
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    n_total = int(offsets[-1])
+    pairs = [touching_pairs(results[i][3], results[i + 1][2]) + offsets[[i, i + 1]] - 1
+             for i in range(len(results) - 1)]
+    pairs = np.concatenate(pairs) if len(pairs) else np.zeros((0, 2), dtype=int)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_total, n_total))
+    n_objects, component = connected_components(graph, directed=False)
+    moments = np.concatenate([r[1][:, 1:] for r in results], axis=1)
+    return np.stack([np.bincount(component, weights=m, minlength=n_objects) for m in moments])
+
+
+def detect_cells_3d(stack, gauss_1=1, gauss_2=2, gauss_z_1=1, gauss_z_2=2, threshold="otsu", threshold_factor=1,
+                    area_factor=3, chunk_size=16, sample_step=8, workers=None):
+    '''
+    Detecting nuclei in a z-stack, see the description at the top of this file.
+    :param stack: StackReader of the fluorescence layer (or (z, y, x) np.ndarray)
+    :param gauss_1, gauss_2: sizes (in pixels) of the bandpass filter in y and x, as in detect_dog
+    :param gauss_z_1, gauss_z_2: sizes (in slices) of the bandpass filter in z
+    :param threshold: Method of thresholding. Possible values are "otsu", "mean_std" and "absolute" (see detect_dog).
+    :param threshold_factor: Additional factor for the threshold.
+    :param area_factor: objects with less than mu - area_factor*std voxels are excluded (see clean_up_mask). The
+    volumes vary more than the areas in the projection, so the factor is larger than for clean_up_mask.
+    :param chunk_size: number of slices of a chunk
+    :param sample_step: every sample_step-th pixel in y and x is used to calculate the threshold
+    :param workers: number of threads (default: number of CPUs). The memory needed is about
+    workers * (3 * chunk_size + 4 * margin) slices of float32, with a margin of 4 * max(gauss_z_1, gauss_z_2) slices.
+    :return: dictionary of 1-D np.ndarrays, one entry per cell, with the keys of pipeline.cell_statistics: "label",
+    "area" (voxels), "y", "x", "z_mean" (intensity weighted centroid, in slices) and "z_std" (weighted standard
+    deviation of z)
+    '''
+    sigma_1, sigma_2 = (gauss_z_1, gauss_1, gauss_1), (gauss_z_2, gauss_2, gauss_2)
+    chunks = get_chunks(len(stack), chunk_size)
+    workers = workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if threshold == "absolute":
+            th = 1
+        else:
+            sample = np.concatenate(list(executor.map(
+                lambda chunk: _sample_chunk(stack, chunk, sigma_1, sigma_2, sample_step), chunks)))
+            th = dog_threshold(sample, threshold)
+        results = list(executor.map(lambda chunk: _label_chunk(stack, chunk, sigma_1, sigma_2,
+                                                               th * threshold_factor), chunks))
+    moments = dict(zip(moment_names, stitch_chunks(results)))
+
+    voxels = moments["voxels"]
+    keep = np.ones(len(voxels), dtype=bool)
+    if len(voxels) >= 2:
+        # same rule as in clean_up_mask, with the volume instead of the area
+        keep = voxels >= max(np.mean(voxels) - area_factor * np.std(voxels, ddof=1), 0)
+    weight = moments["weight"][keep]
+    z_mean = moments["z"][keep] / weight
+    return {"label": np.arange(1, keep.sum() + 1), "area": voxels[keep], "y": moments["y"][keep] / weight,
+            "x": moments["x"][keep] / weight, "z_mean": z_mean,
+            "z_std": np.sqrt(np.maximum(moments["z2"][keep] / weight - z_mean ** 2, 0))}
@@ -0,0 +1,96 @@
+# Difference of gaussians (bandpass) filter and thresholds used by detect_dog. Large images can be filtered in
+# overlapping tiles by a pool of threads. Each tile is filtered with a margin that covers the gaussian kernels, so the
+# tiles fit together without seams. Thresholds are always calculated for the whole image.
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+from skimage.filters import gaussian, threshold_otsu
+from skimage.util import img_as_float
+
+# same kernel size as skimage.filters.gaussian
+truncate = 4.0
+
+
+def get_tiles(shape, tile_size):
+    '''
+    Splitting an image into tiles.
+    :param shape: shape of the image
+    :param tile_size: edge length of the tiles
+    :return: list of (rows, cols) slices
+    '''
+    return [(slice(r, min(r + tile_size, shape[0])), slice(c, min(c + tile_size, shape[1])))
+            for r in range(0, shape[0], tile_size) for c in range(0, shape[1], tile_size)]
+
+
+def _filter_tile(img, out, tile, gauss_1, gauss_2, margin):
+    rows, cols = tile
+    # tile with margin, the margin is cropped at the image edges (where the "nearest" mode of the filter applies)
+    r0, r1 = max(rows.start - margin, 0), min(rows.stop + margin, img.shape[0])
+    c0, c1 = max(cols.start - margin, 0), min(cols.stop + margin, img.shape[1])
+    # float64 as in skimage.filters.gaussian, so the tiled result is the same as the result for the whole image
+    block = img_as_float(img[r0:r1, c0:c1])
+    dog = ndimage.gaussian_filter(block, gauss_1, mode="nearest", truncate=truncate) - \
+        ndimage.gaussian_filter(block, gauss_2, mode="nearest", truncate=truncate)
+    out[rows, cols] = dog[rows.start - r0:rows.stop - r0, cols.start - c0:cols.stop - c0]
+
+
+def dog_filter(img, gauss_1=1, gauss_2=2, tile_size=None, workers=None):
+    '''
+    Bandpass filter (difference of gaussians). Integer images are scaled to [0, 1] like in skimage.filters.gaussian.
+    :param img: 2-D np.ndarray
+    :param gauss_1: lower size for the bandpass filter
+    :param gauss_2: upper size for the bandpass filter
+    :param tile_size: int; If set, the image is filtered in tiles of this size in a thread pool. Otherwise the whole
+    image is filtered at once. Both give the same float64 result.
+    :param workers: int; number of threads for the tiles (default: number of CPUs)
+    :return: filtered image
+    '''
+    if tile_size is None:
+        return gaussian(img, gauss_1) - gaussian(img, gauss_2)
+    margin = int(truncate * max(gauss_1, gauss_2) + 0.5)
+    out = np.empty(img.shape, dtype=np.float64)
+    tiles = get_tiles(img.shape, tile_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda tile: _filter_tile(img, out, tile, gauss_1, gauss_2, margin), tiles))
+    return out
+
+
+def dog_threshold(img2, threshold="otsu", tile_size=None, workers=None):
+    '''
+    Threshold for the bandpass-filtered image, see detect_dog.
+    :param img2: bandpass-filtered image
+    :param threshold: Method of thresholding. Possible values are "otsu","mean_std" and "absolute".
+    :param tile_size: int; If set, the histogram (otsu) or the sums (mean_std) are calculated per tile in a thread pool
+    and combined to one global threshold.
+    :param workers: int; number of threads for the tiles (default: number of CPUs)
+    :return: threshold
+    '''
+    if threshold == "absolute":
+        return 1
+    if tile_size is None:
+        if threshold == "otsu":
+            return threshold_otsu(img2)
+        if threshold == "mean_std":
+            mu, std = np.mean(np.ravel(img2)), np.std(np.ravel(img2), ddof=1)
+            return mu + 5 * std
+        return None
+
+    tiles = get_tiles(img2.shape, tile_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if threshold == "otsu":
+            # histogram with 256 bins over the value range of the whole image, as in threshold_otsu
+            value_range = (float(img2.min()), float(img2.max()))
+            if value_range[0] == value_range[1]:
+                return value_range[0]
+            counts = sum(executor.map(lambda t: np.histogram(img2[t], bins=256, range=value_range)[0], tiles))
+            edges = np.linspace(value_range[0], value_range[1], 257)
+            return threshold_otsu(hist=(counts, (edges[:-1] + edges[1:]) / 2))
+        if threshold == "mean_std":
+            sums = np.sum(list(executor.map(lambda t: (img2[t].size, np.sum(img2[t], dtype=np.float64),
+                                                       np.sum(np.square(img2[t], dtype=np.float64))), tiles)), axis=0)
+            n, s, s2 = sums
+            mu = s / n
+            std = np.sqrt((s2 - n * mu ** 2) / (n - 1))
+            return mu + 5 * std
+    return None
@@ -0,0 +1,436 @@
+# Running the whole evaluation of an experiment from one manifest file: sorting the images into position folders
+# (file_router.py), building the databases (database_builder.py), finding the z-positions of the cells
+# (pipeline.process_position), gathering the results of each plate (results_store.collect_plate) and the analysis of
+# the invasion depths with bootstrap confidence bands (bootstrap.py).
+# The stages form a graph of tasks: route (one per condition folder) -> build -> localize (one per position) -> collect
+# -> analyze (one per plate). A task is skipped if none of its dependencies had to run and its outputs are newer than
+# its inputs (and, for localize and analyze, were computed with the same parameters), so running the manifest again
+# only redoes the missing work.
+# Positions are independent and are processed in a pool of worker processes.
+#
+# Usage: python -m invasion_assay.experiment manifest.json [--workers 4] [--force localize] [--dry-run]
+#
+# Example manifest (relative folders are relative to the manifest file; all settings except "plates" can also be
+# given for a single plate; "positions" is optional, default: all positions of the condition; the "detection" settings
+# are passed to pipeline.process_position, "focus_layer" gives the cells the bright field features, default: null):
+# {
+#   "channels": ["modeBF", "modeFluo5"],
+#   "layer": "modeFluo5",
+#   "z_slice_thickness": 6.65,
+#   "gel_surface_slice": 100,
+#   "detection": {"threshold": "otsu", "threshold_factor": 1, "closing_iterations": 4, "area_factor": 1,
+#                 "focus_layer": "modeBF"},
+#   "analysis": {"n_resamples": 10000, "confidence": 0.95, "by_position": false},
+#   "plates": [
+#     {"folder": "B01_AnWi_Invasion_2020-03-04/Platte2_HTB26", "celltype": "HTB-262",
+#      "conditions": {"Ctrl": {"label": "Ctrl"}, "Alginat": {"label": "Alg", "positions": ["pos00", "pos01"]},
+#                     "HA": {}}}
+#   ]
+# }
+
+import os
+import json
+import time
+import argparse
+import traceback
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+import invasion_assay
+if __name__ == "__main__":
+    # command line: blocking the clickpoints GUI parts before clickpoints is imported (see invasion_assay/__init__.py)
+    invasion_assay.use_headless()
+from invasion_assay.file_router import scan_folder, route_files, pos_folder_pattern
+from invasion_assay.database_builder import build_database, is_up_to_date, default_channels
+from invasion_assay.batch import run_position
+from invasion_assay.artifact_cache import ArtifactCache, make_key
+from invasion_assay.results_store import collect_plate, load_results, position_file_name
+
+stages = ["route", "build", "localize", "collect", "analyze"]
+default_settings = {"channels": default_channels, "layer": "modeFluo5", "z_slice_thickness": 5 * 1.33,
+                    "gel_surface_slice": 100, "marker_type_name": "cell_in_focus",
+                    "detection": {"threshold": "otsu", "threshold_factor": 1, "closing_iterations": 4,
+                                  "area_factor": 1, "focus_layer": None},
+                    "analysis": {"n_resamples": 10000, "confidence": 0.95, "by_position": False}}
+analysis_file_name = "invasion_depth.npz"
+
+
+def load_manifest(path):
+    '''
+    Reading a manifest file. The settings of every plate are completed with the settings of the manifest and the
+    defaults, the folders are made absolute.
+    :param path: path of the .json file
+    :return: dictionary with "path" and "plates" (list of dictionaries with "folder", "celltype", "conditions" and
+    all settings)
+    '''
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    top = {key: value for key, value in manifest.items() if key != "plates"}
+    plates = []
+    for plate in manifest["plates"]:
+        settings = {}
+        for source in [default_settings, top, plate]:
+            for key, value in source.items():
+                # parameter groups are merged key by key
+                settings[key] = dict(settings.get(key, {}), **value) if isinstance(value, dict) and \
+                    key in ("detection", "analysis") else value
+        settings["folder"] = os.path.join(base, os.path.expanduser(plate["folder"]))
+        settings.setdefault("celltype", os.path.basename(os.path.normpath(settings["folder"])))
+        settings["conditions"] = {name: dict(condition or {}) for name, condition in plate["conditions"].items()}
+        plates.append(settings)
+    return {"path": os.path.abspath(path), "plates": plates}
+
+
+def condition_positions(condition_dir, wanted=None):
+    '''
+    Position folders of a condition, including positions whose images are not sorted into a folder yet.
+    :param condition_dir: folder of the condition
+    :param wanted: optional list of position folder names (e.g. ["pos00", "pos01"])
+    :return: sorted list of position folder names
+    '''
+    if not os.path.isdir(condition_dir):
+        return []
+    index, unmatched = scan_folder(condition_dir)
+    names = {"pos" + pos for pos in index}
+    with os.scandir(condition_dir) as entries:
+        names.update(entry.name for entry in entries if entry.is_dir() and pos_folder_pattern.search(entry.name))
+    if wanted is not None:
+        missing = sorted(set(wanted) - names)
+        if missing:
+            print("%s: positions not found: %s" % (condition_dir, ", ".join(missing)))
+        names &= set(wanted)
+    return sorted(names)
+
+
+def newest_file(folder, extension=".tif"):
+    '''
+    :return: modification time of the newest file with the extension in folder, 0 if there is none
+    '''
+    with os.scandir(folder) as entries:
+        return max((entry.stat().st_mtime for entry in entries if entry.name.endswith(extension)), default=0)
+
+
+def is_newer(path, time_stamp):
+    return os.path.exists(path) and os.path.getmtime(path) >= time_stamp
+
+
+# -- tasks: the functions run in the worker processes, the checks run in the main process --
+
+def _route(condition_dir):
+    summary = route_files(condition_dir)
+    if summary["errors"]:
+        raise RuntimeError("\n".join(summary["errors"]))
+    return "%d files moved" % summary["moved"]
+
+
+def _route_done(condition_dir):
+    return not os.path.isdir(condition_dir) or len(scan_folder(condition_dir)[0]) == 0
+
+
+def _build(folder, channels):
+    db_path, changes = build_database(folder, channels, sync=True)
+    return "%d images added, %d removed, %d reordered" % (changes["added"], changes["removed"], changes["reordered"])
+
+
+def _build_done(folder):
+    return os.path.isdir(folder) and is_up_to_date(folder)
+
+
+def localize_key(kwargs):
+    return make_key("localize", kwargs)
+
+
+def _localize(folder, kwargs):
+    # same as a position of the batch runner, the image processing is only imported in the worker processes
+    summary = run_position(os.path.join(folder, "sorted.cdb"), dict(kwargs, progress=False))
+    if summary["error"] is not None:
+        raise RuntimeError(summary["error"])
+    n_cells = summary["cells"]
+    # parameters of the last run, for _localize_done
+    ArtifactCache(os.path.join(folder, "z_position_cache")).save("localize", localize_key(kwargs), {})
+    return "%d cells" % n_cells
+
+
+def _localize_done(folder, kwargs):
+    return is_newer(os.path.join(folder, position_file_name), newest_file(folder)) and \
+        ArtifactCache(os.path.join(folder, "z_position_cache")).load("localize", localize_key(kwargs)) is not None
+
+
+def _collect(plate_dir):
+    return "written to %s" % collect_plate(plate_dir)
+
+
+def _collect_done(plate_dir, position_folders):
+    newest = max((os.path.getmtime(os.path.join(folder, position_file_name)) for folder in position_folders
+                  if os.path.exists(os.path.join(folder, position_file_name))), default=0)
+    return is_newer(os.path.join(plate_dir, "results.npz"), newest)
+
+
+def analysis_settings(plate):
+    return {"conditions": {name: condition.get("label", name) for name, condition in plate["conditions"].items()},
+            "celltype": plate["celltype"], "z_slice_thickness": plate["z_slice_thickness"],
+            "gel_surface_slice": plate["gel_surface_slice"], **plate["analysis"]}
+
+
+def invasion_depths(results, conditions, z_slice_thickness, gel_surface_slice):
+    '''
+    Invasion depths in um of the cells of each condition and position, as in 4_mutiple_conditions.py: cells above the
+    gel surface are projected to the gel surface.
+    :param results: dictionary from results_store.load_results
+    :param conditions: list of condition names
+    :return: dictionary condition -> list of 1-D np.ndarrays (one per position)
+    '''
+    data = {}
+    for cond in conditions:
+        in_cond = results["condition"] == cond
+        data[cond] = [np.sort(-(np.minimum(results["z"][in_cond & (results["position"] == pos)], gel_surface_slice)
+                                - gel_surface_slice) * z_slice_thickness)
+                      for pos in np.unique(results["position"][in_cond])]
+    return data
+
+
+def _analyze(plate_dir, settings):
+    from invasion_assay.bootstrap import condition_bands
+    conditions = list(settings["conditions"])
+    results = load_results(os.path.join(plate_dir, "results.npz"), condition=conditions)
+    data = {cond: d for cond, d in invasion_depths(results, conditions, settings["z_slice_thickness"],
+                                                   settings["gel_surface_slice"]).items() if len(d)}
+    if not data:
+        raise ValueError("no cells found for the conditions %s" % ", ".join(conditions))
+    reference = conditions[0] if conditions[0] in data else None
+    bands, differences = condition_bands(data, confidence=settings["confidence"], reference=reference,
+                                         by_position=settings["by_position"], n_resamples=settings["n_resamples"])
+    arrays = {"%s_%s" % (cond, name): band[name] for cond, band in bands.items() for name in band}
+    arrays.update({"%s-%s_%s" % (cond, reference, name): diff[name] for cond, diff in differences.items()
+                   for name in diff})
+    figure_path = os.path.join(plate_dir, settings["celltype"] + "-all.png")
+    plot_bands(bands, differences, settings["conditions"], settings["celltype"], figure_path)
+    np.savez(os.path.join(plate_dir, analysis_file_name), _key=make_key(settings), **arrays)
+    return "figure written to %s" % figure_path
+
+
+def _analyze_done(plate_dir, settings):
+    path = os.path.join(plate_dir, analysis_file_name)
+    results_path = os.path.join(plate_dir, "results.npz")
+    if not os.path.exists(results_path) or not is_newer(path, os.path.getmtime(results_path)):
+        return False
+    with np.load(path) as data:
+        return str(data["_key"]) == make_key(settings)
+
+
+def plot_bands(bands, differences, labels, title, path):
+    '''
+    Invasion depth curves with confidence bands (and the differences to the reference condition in a second panel),
+    in the style of 4_mutiple_conditions.py.
+    :param bands, differences: dictionaries from bootstrap.condition_bands
+    :param labels: dictionary condition -> label
+    :param title: title of the figure
+    :param path: path of the image
+    '''
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, 2 if differences else 1, figsize=(12 if differences else 6, 4.5), squeeze=False)
+    colors = {cond: "C%d" % i for i, cond in enumerate(bands)}
+    reference = next(cond for cond in bands if cond not in differences)
+    for ax, curves, key in [(axes[0, 0], bands, "depth")] + ([(axes[0, 1], differences, "difference")]
+                                                          if differences else []):
+        for cond, band in curves.items():
+            label = labels[cond] if key == "depth" else "%s - %s" % (labels[cond], labels[reference])
+            ax.plot(band["p"], band[key], label=label, color=colors[cond])
+            ax.fill_between(band["p"], band["lower"], band["upper"], color=colors[cond], alpha=0.25)
+        ax.axhline(0, c='k', lw=1)
+        ax.grid()
+        ax.set_xlim([10 ** 0, 10 ** -4])
+        ax.set_title(title)
+        ax.spines["right"].set_visible(False)
+        ax.spines["top"].set_visible(False)
+        ax.set_xlabel('Probability of (Invasion depth$\\mathregular{\\geq}$D)')
+        ax.legend(loc='lower left')
+    axes[0, 0].invert_yaxis()
+    axes[0, 0].set_ylabel('Invasion depth D [µm]')
+    if differences:
+        axes[0, 1].set_ylabel('Difference of invasion depth D [µm]')
+    fig.tight_layout()
+    fig.savefig(path, dpi=300)
+    plt.close(fig)
+
+
+class Task:
+    '''
+    One node of the task graph.
+    '''
+
+    def __init__(self, stage, target, function, args=(), deps=(), done=None, local=False):
+        '''
+        :param stage: one of stages
+        :param target: folder that the task works on (used as the name of the task)
+        :param function: function that runs the task (must be picklable), returns a short message
+        :param args: arguments of function
+        :param deps: names of the tasks that have to be finished first
+        :param done: function without arguments that checks if the outputs of the task are up to date
+        :param local: boolean; run in the main process instead of a worker process
+        '''
+        self.stage = stage
+        self.target = target
+        self.name = (stage, target)
+        self.function = function
+        self.args = args
+        self.deps = list(deps)
+        self.done = done
+        self.local = local
+
+
+def plan_tasks(manifest):
+    '''
+    Task graph of all plates of a manifest.
+    :param manifest: dictionary from load_manifest
+    :return: list of Tasks, every task comes after its dependencies
+    '''
+    tasks = []
+    for plate in manifest["plates"]:
+        kwargs = dict(plate["detection"], layer=plate["layer"], marker_type_name=plate["marker_type_name"])
+        position_tasks = []
+        position_folders = []
+        for name, condition in plate["conditions"].items():
+            condition_dir = os.path.join(plate["folder"], name)
+            route = Task("route", condition_dir, _route, (condition_dir,), done=partial(_route_done, condition_dir),
+                         local=True)
+            tasks.append(route)
+            for pos in condition_positions(condition_dir, condition.get("positions")):
+                folder = os.path.join(condition_dir, pos)
+                build = Task("build", folder, _build, (folder, plate["channels"]), deps=[route.name],
+                             done=partial(_build_done, folder))
+                localize = Task("localize", folder, _localize, (folder, kwargs), deps=[build.name],
+                                done=partial(_localize_done, folder, kwargs))
+                tasks += [build, localize]
+                position_tasks.append(localize.name)
+                position_folders.append(folder)
+        collect = Task("collect", plate["folder"], _collect, (plate["folder"],), deps=position_tasks,
+                       done=partial(_collect_done, plate["folder"], position_folders), local=True)
+        settings = analysis_settings(plate)
+        # the bootstrap is vectorized, it runs in the main process while the workers evaluate other plates
+        analyze = Task("analyze", plate["folder"], _analyze, (plate["folder"], settings), deps=[collect.name],
+                       done=partial(_analyze_done, plate["folder"], settings), local=True)
+        tasks += [collect, analyze]
+    return tasks
+
+
+def _run_task(function, args):
+    '''
+    Running a task and catching all errors, so that a failing position doesn't stop the other positions.
+    :return: message of the task, error (traceback or None), runtime in seconds
+    '''
+    t_start = time.time()
+    try:
+        return function(*args), None, time.time() - t_start
+    except Exception:
+        return None, traceback.format_exc(), time.time() - t_start
+
+
+def run_tasks(tasks, workers=None, force=(), dry_run=False):
+    '''
+    Running a task graph. A task starts as soon as all of its dependencies are finished. It is skipped if none of its
+    dependencies had to run and its outputs are up to date (unless its stage is in force), and blocked if a dependency
+    failed.
+    :param tasks: list of Tasks (see plan_tasks)
+    :param workers: number of worker processes (default: number of CPUs); with 1 worker all tasks run in this process
+    :param force: stages that are run even if their outputs are up to date
+    :param dry_run: boolean; only print which tasks would run
+    :return: list of summary dictionaries with "stage", "target", "status" ("done", "up to date", "failed",
+    "blocked" or "would run"), "message", "runtime" and "error"
+    '''
+    workers = workers or os.cpu_count()
+    status = {}
+    summaries = []
+    waiting = list(tasks)
+    running = {}
+
+    def finish(task, message, error, runtime):
+        status[task.name] = "failed" if error is not None else "done"
+        summaries.append({"stage": task.stage, "target": task.target, "status": status[task.name],
+                          "message": message, "runtime": runtime, "error": error})
+        print_task_line(summaries[-1])
+
+    executor = None
+    if workers > 1 and not dry_run:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=invasion_assay.use_headless)
+    try:
+        while waiting or running:
+            ready = [task for task in waiting if all(dep in status for dep in task.deps)]
+            for task in ready:
+                waiting.remove(task)
+                deps = [status[dep] for dep in task.deps]
+                if any(s in ("failed", "blocked") for s in deps):
+                    status[task.name] = "blocked"
+                elif "would run" in deps:
+                    status[task.name] = "would run"
+                elif "done" not in deps and task.stage not in force and task.done is not None and task.done():
+                    status[task.name] = "up to date"
+                elif dry_run:
+                    status[task.name] = "would run"
+                elif executor is None or task.local:
+                    finish(task, *_run_task(task.function, task.args))
+                    continue
+                else:
+                    running[executor.submit(_run_task, task.function, task.args)] = task
+                    continue
+                summaries.append({"stage": task.stage, "target": task.target, "status": status[task.name],
+                                  "message": None, "runtime": 0.0, "error": None})
+                print_task_line(summaries[-1])
+            if running:
+                finished, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(running.pop(future), *future.result())
+            elif waiting and not ready:
+                raise ValueError("tasks with missing dependencies: %s" % ", ".join(t.target for t in waiting))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return summaries
+
+
+def print_task_line(summary):
+    line = "%-8s %-10s %s" % (summary["stage"], summary["status"], summary["target"])
+    if summary["status"] in ("done", "failed"):
+        line += " (%.1f s)" % summary["runtime"]
+    if summary["message"]:
+        line += ": " + summary["message"]
+    print(line)
+    if summary["error"] is not None:
+        print(summary["error"])
+
+
+def print_run_summary(summaries):
+    '''
+    Printing the number of tasks of each stage and status.
+    '''
+    print("\n%-8s %6s %10s %7s %8s %10s" % ("stage", "done", "up to date", "failed", "blocked", "would run"))
+    for stage in stages:
+        counts = [sum(s["stage"] == stage and s["status"] == status for s in summaries)
+                  for status in ["done", "up to date", "failed", "blocked", "would run"]]
+        print("%-8s %6d %10d %7d %8d %10d" % (stage, *counts))
+    print("%.1f s total processing time" % sum(s["runtime"] for s in summaries))
+
+
+def run_experiment(manifest_path, workers=None, force=(), dry_run=False):
+    '''
+    Evaluating all plates of a manifest, see run_tasks.
+    :return: list of summary dictionaries of the tasks
+    '''
+    manifest = load_manifest(manifest_path)
+    return run_tasks(plan_tasks(manifest), workers=workers, force=force, dry_run=dry_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluating an invasion assay experiment from a manifest file.")
+    parser.add_argument("manifest", help="manifest file (.json)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPUs)")
+    parser.add_argument("--force", nargs="+", default=[], choices=stages,
+                        help="run these stages even if their outputs are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only show which tasks would run")
+    args = parser.parse_args()
+    summaries = run_experiment(args.manifest, workers=args.workers, force=args.force, dry_run=args.dry_run)
+    print_run_summary(summaries)
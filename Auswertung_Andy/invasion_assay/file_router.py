@@ -0,0 +1,128 @@
+# Sorting the images of an acquisition folder into position folders (pos00, pos01, ...). The folder is scanned once,
+# every file name is parsed with one precompiled regular expression and the files are moved by renaming them (the
+# position folders are on the same volume) in a small pool of threads.
+
+import os
+import re
+import csv
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# e.g. 20200304-101010_Mic3_rep0000_pos00_x0_y0_modeFluo5_z012.tif; mode and z are None if the name doesn't contain them
+filename_pattern = re.compile(r"(?P<date>\d{8})-(?P<time>\d{6})_(?P<mic>.*)_rep(?P<rep>\d{1,6})_pos(?P<pos>\d{1,6})_"
+                              r"(?:(?:.*_)?(?P<mode>mode[^_.]+)(?:_.*)?_z(?P<z>\d+)(?:_.*)?\.tif$)?")
+# position folders ("pos" + position number, see route_files), also used to find the positions when the databases are
+# built, the positions are evaluated and the results are collected
+pos_folder_pattern = re.compile(r"pos\d{2}")
+
+
+def parse_filename(filename):
+    '''
+    Reading date, time, microscope, rep, pos, mode and z from an image file name.
+    :param filename: name of the file (without folder)
+    :return: dictionary of strings (mode and z are None if they are not in the name), None if the name doesn't match
+    '''
+    match = filename_pattern.search(filename)
+    return match.groupdict() if match else None
+
+
+def scan_folder(rootdir):
+    '''
+    Indexing all images in a folder by position with a single scan of the folder.
+    :param rootdir: folder with the .tif images
+    :return: dictionary position (e.g. "00") -> list of (filename, parsed file name); list of .tif files that don't
+    match the file name pattern
+    '''
+    index = defaultdict(list)
+    unmatched = []
+    with os.scandir(rootdir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".tif") or not entry.is_file():
+                continue
+            info = parse_filename(entry.name)
+            if info is None:
+                unmatched.append(entry.name)
+            else:
+                index[info["pos"]].append((entry.name, info))
+    return index, unmatched
+
+
+def plan_moves(rootdir, index):
+    '''
+    :param rootdir: folder with the .tif images
+    :param index: dictionary from scan_folder
+    :return: list of (source path, destination path)
+    '''
+    return [(os.path.join(rootdir, filename), os.path.join(rootdir, "pos" + pos, filename))
+            for pos in sorted(index) for filename, info in sorted(index[pos], key=lambda f: f[0])]
+
+
+def write_manifest(moves, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "destination"])
+        writer.writerows(moves)
+
+
+def _move(move):
+    source, destination = move
+    if os.path.exists(destination):
+        return "destination exists: %s" % destination
+    try:
+        os.replace(source, destination)
+    except OSError as err:
+        return "cannot move %s: %s" % (source, err)
+    return None
+
+
+def route_files(rootdir, workers=8, dry_run=False, manifest=None):
+    '''
+    Moving all images of a folder into position folders (rootdir/pos<pos>) based on their file names.
+    :param rootdir: folder with the .tif images
+    :param workers: number of threads that move files
+    :param dry_run: boolean; only plan the moves (and write the manifest), nothing is moved
+    :param manifest: path of a csv file with all planned moves (source, destination), not written if None
+    :return: dictionary with "positions" (number of files per position), "moved", "unmatched" (file names) and
+    "errors" (list of messages)
+    '''
+    index, unmatched = scan_folder(rootdir)
+    moves = plan_moves(rootdir, index)
+    summary = {"positions": {pos: len(files) for pos, files in sorted(index.items())}, "moved": 0,
+               "unmatched": unmatched, "errors": []}
+    if manifest is not None:
+        write_manifest(moves, manifest)
+    if dry_run:
+        return summary
+
+    errors = move_files(moves, workers=workers)
+    summary["moved"] = len(moves) - len(errors)
+    summary["errors"] = errors
+    return summary
+
+
+def move_files(moves, workers=8):
+    '''
+    Moving (renaming) files in a pool of threads. Missing destination folders are created, existing files are not
+    overwritten.
+    :param moves: list of (source path, destination path), see plan_moves
+    :param workers: number of threads
+    :return: list of error messages
+    '''
+    for folder in {os.path.split(destination)[0] for source, destination in moves}:
+        os.makedirs(folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [e for e in executor.map(_move, moves, chunksize=256) if e is not None]
+
+
+def print_route_summary(summary, dry_run=False):
+    for pos, n in summary["positions"].items():
+        print("pos%s: %d files" % (pos, n))
+    if dry_run:
+        print("dry run: %d files would be moved" % sum(summary["positions"].values()))
+    else:
+        print("%d files moved" % summary["moved"])
+    if summary["unmatched"]:
+        print("%d .tif files don't match the file name pattern, e.g. %s" % (len(summary["unmatched"]),
+                                                                          summary["unmatched"][0]))
+    for error in summary["errors"]:
+        print("!!! " + error)
@@ -0,0 +1,112 @@
+# Sub-slice z-localization of cells. For every cell the intensity (or sharpness) profile along z is extracted from the
+# bounding box of the cell and the z-position is found by fitting a peak to the profile. Only the voxels in the bounding
+# boxes are read from the stack (memory-mapped files); the stack is read slice by slice, so files that can't be
+# memory-mapped are decoded once for all cells.
+
+import numpy as np
+from scipy import ndimage
+
+# discrete 2-D laplace operator, applied to every slice of a (z, y, x) block
+laplace_kernel = np.array([[[0, 1, 0], [1, -4, 1], [0, 1, 0]]], dtype=np.float32)
+
+
+def cell_profile(block, cell_mask, metric="intensity"):
+    '''
+    Focus profile of one cell.
+    :param block: (z, y, x) np.ndarray; bounding box of the cell in the stack
+    :param cell_mask: (y, x) boolean np.ndarray; pixels of the cell in the bounding box
+    :param metric: "intensity" (mean intensity of the cell) or "sharpness" (mean squared laplacian of the cell)
+    :return: 1-D np.ndarray with one value per slice
+    '''
+    block = block.astype(np.float32)
+    if metric == "sharpness":
+        block = ndimage.convolve(block, laplace_kernel, mode="nearest") ** 2
+    elif metric != "intensity":
+        raise ValueError("unknown metric %s, use 'intensity' or 'sharpness'" % metric)
+    return block[:, cell_mask].mean(axis=1)
+
+
+def fit_peaks(profiles, method="parabolic"):
+    '''
+    Sub-slice position of the maximum of each profile. A parabola (or a gaussian, i.e. a parabola of the logarithm) is
+    fitted to the maximum and its two neighbours. Maxima at the first or last slice are not refined.
+    :param profiles: (n_cells, n_slices) np.ndarray
+    :param method: "parabolic" or "gaussian"
+    :return: 1-D np.ndarray; peak position of each profile in slices (0 is the first slice of the profile)
+    '''
+    profiles = np.asarray(profiles, dtype=float)
+    n_cells, n_slices = profiles.shape
+    peak = np.argmax(profiles, axis=1)
+    if n_slices < 3:
+        return peak.astype(float)
+    if method == "gaussian":
+        # shifting the profiles to positive values for the logarithm
+        profiles = np.log(profiles - profiles.min(axis=1, keepdims=True) + 1)
+    elif method != "parabolic":
+        raise ValueError("unknown method %s, use 'parabolic' or 'gaussian'" % method)
+
+    center = np.clip(peak, 1, n_slices - 2)
+    rows = np.arange(n_cells)
+    left, middle, right = profiles[rows, center - 1], profiles[rows, center], profiles[rows, center + 1]
+    curvature = left - 2 * middle + right
+    with np.errstate(invalid="ignore", divide="ignore"):
+        offset = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0)
+    offset = np.clip(np.nan_to_num(offset), -1, 1)
+    at_border = (peak == 0) | (peak == n_slices - 1)
+    return np.where(at_border, peak, center + offset)
+
+
+def fit_z_positions(stack, labeled, labels=None, metric="intensity", method="parabolic", margin=2, z_guess=None,
+                    z_range=None):
+    '''
+    Sub-slice z-position of cells from their focus profiles.
+    :param stack: StackReader (or (z, y, x) np.ndarray) of the fluorescence images
+    :param labeled: labeled segmentation of the cells (e.g. measure_label of the output of clean_up_mask)
+    :param labels: list of labels that are fitted, defaults to all labels. The result is ordered like labels.
+    :param metric: "intensity" or "sharpness", see cell_profile
+    :param method: "parabolic" or "gaussian", see fit_peaks
+    :param margin: number of pixels added around the bounding box (needed for the sharpness metric)
+    :param z_guess: list of float; position of each cell in the stack (e.g. the mean of the maximum indices). Only used
+    with z_range.
+    :param z_range: int; If set, only the slices within +- z_range of z_guess are read for each cell.
+    :return: 1-D np.ndarray; z-position of each cell in frames (sort_index of the images in the database)
+    '''
+    objects = ndimage.find_objects(labeled)
+    if labels is None:
+        labels = [i + 1 for i, o in enumerate(objects) if o is not None]
+    n_slices = len(stack)
+    windowed = z_range is not None and z_guess is not None
+    boxes = []
+    for label in labels:
+        rows, cols = objects[label - 1]
+        rows = slice(max(rows.start - margin, 0), rows.stop + margin)
+        cols = slice(max(cols.start - margin, 0), cols.stop + margin)
+        boxes.append((rows, cols, labeled[rows, cols] == label))
+    z0 = np.zeros(len(labels), dtype=int)
+    z1 = np.full(len(labels), n_slices)
+    if windowed:
+        z0 = np.clip(np.round(z_guess) - z_range, 0, n_slices - 1).astype(int)
+        z1 = np.clip(np.round(z_guess) + z_range + 1, z0 + 1, n_slices).astype(int)
+
+    # slice by slice: every slice is opened once and the boxes of all cells are taken from it (compressed files are
+    # decoded once per slice, not once per cell)
+    profiles = np.full((len(labels), n_slices), np.nan)
+    for z in range(n_slices):
+        cells = np.flatnonzero((z0 <= z) & (z < z1))
+        if len(cells) == 0:
+            continue
+        frame = stack.get_frame(z) if hasattr(stack, "get_frame") else stack[z]
+        for i in cells:
+            rows, cols, cell_mask = boxes[i]
+            profiles[i, z] = cell_profile(np.asarray(frame[rows, cols])[None], cell_mask, metric=metric)[0]
+
+    if windowed:
+        peaks = np.array([z0[i] + fit_peaks(profiles[i, z0[i]:z1[i]][None], method=method)[0]
+                          for i in range(len(labels))])
+    elif len(labels) > 0:
+        peaks = fit_peaks(profiles, method=method)
+    else:
+        peaks = np.zeros(0)
+    # converting positions in the stack to frame numbers
+    indices = getattr(stack, "indices", np.arange(n_slices))
+    return np.interp(peaks, np.arange(n_slices), indices)
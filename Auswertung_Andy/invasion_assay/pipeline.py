@@ -0,0 +1,475 @@
+# Pipeline to find the z_positions of cells in a z-stack of fluorescent images, sorted into a clickpoints-database.
+# The functions are used by 3-finding_z_postion_of_sharp_cells.py and by the batch runner (batch.py), which processes
+# many positions in parallel. Every position is processed with its own database object (see process_position).
+
+import os
+import warnings
+import numpy as np
+import clickpoints
+import peewee
+from tqdm import tqdm
+from skimage.measure import label as measure_label
+from scipy.ndimage import binary_dilation, binary_erosion
+from scipy import ndimage
+from invasion_assay.projection import project_stack, project_focus
+from invasion_assay.dog_filter import dog_filter, dog_threshold
+from invasion_assay.detection_3d import detect_cells_3d
+from invasion_assay.stack_reader import StackReader
+from invasion_assay.focus_profile import fit_z_positions
+from invasion_assay.artifact_cache import ArtifactCache, make_key, files_key
+from invasion_assay.results_store import write_position_results
+from invasion_assay.projection_store import save_projection, register_projection
+from invasion_assay.database_builder import insert_many
+from invasion_assay.profiling import StageProfiler
+
+# 4-connected neighbourhood (default structure of the scipy binary operations)
+cross_structure=ndimage.generate_binary_structure(2,1)
+
+
+def detect_dog(img,gauss_1=1,gauss_2=2,threshold="otsu", exclude_close_to_edge=False,threshold_factor=1,
+               tile_size=None,workers=None):
+    '''
+    Segmentation (=identifying the area of cells). The image is bandpass-filtered (removing large/unsharp objects
+    and small objects). Then the cell area is identified by thresholding. You can use otsus method for
+    thresholding ("otsu"), a threshodl based on the histogram of pixels ("mean_std") or use a fixed threshold ("absolute").
+    You can also increase or decrease all thresholds with a factor (threshold_factor). If you choose "absolute", the
+    threshold is set to 1 and you can only change it with the threshold_factor.
+    :param img: Np.ndarray; Image, e.g. the maximums projection.
+    :param gauss_1: lower size for the bandpass filter
+    :param gauss_2: upper size for the bandpass filter
+    :param threshold: Method of thresholding. Possible values are "otsu","mean_std" and "absolute".
+    :param exclude_close_to_edge: boolean; Choose if cells close to the image edge are ignored. (Probably not necessary)
+    :param threshold_factor: Additional factor for the threshold.
+    :param tile_size: int; If set, the image is filtered in overlapping tiles of this size by a pool of threads. The
+    threshold is still calculated from the histogram of the whole image, the mask is the same as without tiles. Useful
+    for large mosaics.
+    :param workers: int; number of threads for the tiles (default: number of CPUs)
+    :return:
+    '''
+    img2 = dog_filter(img,gauss_1,gauss_2,tile_size=tile_size,workers=workers)
+    th = dog_threshold(img2,threshold,tile_size=tile_size,workers=workers)
+
+    mask = img2 >th*threshold_factor
+    # the mask is labeled as a whole, so objects on the borders between tiles are not split
+    labeled = measure_label(mask)
+    n_labels = labeled.max()
+    if n_labels == 0:
+        return mask, np.array([])
+    centroids = np.array(ndimage.center_of_mass(img2, labeled, np.arange(1, n_labels+1)))
+    y, x = centroids[:, 0], centroids[:, 1]
+    # optional filtering all detection close to the image edge
+    close_to_edge = ~((75 < x) & (x < img.shape[1] - 75) & (75 < y) & (y < img.shape[0] - 75))
+    keep = ~close_to_edge | (not exclude_close_to_edge)
+    if not np.all(keep):
+        # removing labels from mask
+        mask &= np.concatenate([[False], keep])[labeled]
+
+    detections = np.stack([x[keep], y[keep]], axis=1)
+    return mask,detections
+
+
+def clean_up_mask(mask,closing_iterations=4,area_factor=1.5,return_labels=False):
+    '''
+    Cleaning up the segmentation of cells by:
+    1) Removing small holes. This somwwhat controlled by "closing_iterations" parameter. More
+    iterations will fill larger holes, but will ultimately cause wierd object shapes.
+    2) Excluding small objects. Objects with a size of mu - area_factor*std
+    (mu: average object area, std: standard deviation of the object area) are excluded. You can choose the area_factor;
+    a high factor will result in less objects beeing removed. Nothing is excluded if there are less than two objects.
+
+    As in the previous version, the threshold is computed from the 8-connected objects (measure_label) and the small
+    objects are removed as 4-connected objects (remove_small_objects), so a small object that touches a large one only
+    diagonally is removed. Holes are the background areas that don't touch the image border and the areas are counted
+    with np.bincount.
+
+    :param mask: mask of cells
+    :param closing_iterations: number of iterations during a binary_closing operation
+    :param area_factor: Factor defining the threshold to exclude small objects. A large area_factor
+    allows smaller objects (see above)
+    :param return_labels: boolean; also return the labeled cleaned mask (same as measure_label(mask_clean))
+    :return: cleaned mask (and labeled mask)
+    '''
+    # binary closing (dilation and erosion with the cross structure, as binary_closing with iterations)
+    mask_clean=binary_dilation(mask,structure=cross_structure,iterations=closing_iterations)
+    binary_erosion(mask_clean,structure=cross_structure,iterations=closing_iterations,output=mask_clean)
+    # filling holes: background areas (4-connected, as in binary_fill_holes) that don't touch the border
+    background,n_background=ndimage.label(~mask_clean,structure=cross_structure)
+    hole=np.ones(n_background+1,dtype=bool)
+    hole[0]=False
+    hole[np.concatenate([background[0],background[-1],background[:,0],background[:,-1]])]=False
+    mask_clean|=hole[background]
+    del background
+
+    # excluding small areas
+    labeled,n_labels=ndimage.label(mask_clean,structure=np.ones((3,3),dtype=bool))
+    if n_labels>=2:
+        # the threshold is not defined for less than two objects
+        areas=np.bincount(labeled.ravel(),minlength=n_labels+1)[1:]
+        mu=np.mean(areas)
+        std=np.std(areas,ddof=1)
+        # 4-connected parts of the objects, as in remove_small_objects
+        parts,n_parts=ndimage.label(mask_clean,structure=cross_structure)
+        keep=np.bincount(parts.ravel(),minlength=n_parts+1)>=max(mu-area_factor*std,0)
+        keep[0]=False
+        if not keep[1:].all():
+            mask_clean=keep[parts]
+            if return_labels:
+                labeled=ndimage.label(mask_clean,structure=np.ones((3,3),dtype=bool))[0]
+        del parts
+    if return_labels:
+        return mask_clean,labeled
+    return mask_clean
+
+
+
+def create_z_stack(db,layer,tile_rows=None,progress=True,stack=None,profiler=None):
+    '''
+    Creating minimum- and maximum-projections from images in database. The Images need to be sorted correctly.
+    You have to specify the layer that is used for the projection. This is optimized for minimal RAM-usage
+    :param db: clickpoints Database object
+    :param layer: string; the layer name.
+    :param tile_rows: int; process the images in blocks of this many rows (keeps temporary arrays small for wide images)
+    :param progress: boolean; show a progress bar
+    :param stack: StackReader of the layer, if it was already created
+    :param profiler: profiling.StageProfiler; the reading of the images is recorded as stage "image_load"
+    :return: max_indices, min_indices, max_proj, min_proj
+    '''
+    # the file list of the layer is resolved once, uncompressed TIFF files are read as memory maps
+    if stack is None:
+        stack=StackReader.from_database(db,layer)
+    n_frames=max(stack.indices)+1
+    frames=stack.frames() if profiler is None else profiler.iterate("image_load",stack.frames())
+    # single pass over the stack, projections are uint16, index maps uint8 for stacks with up to 256 slices
+    return project_stack(tqdm(frames,total=len(stack),disable=not progress),n_frames=n_frames,
+                         dtype=np.uint16,tile_rows=tile_rows,indices=stack.indices)
+
+def cell_statistics(labeled,max_indices):
+    '''
+    Statistics of the maximum-indices in the area of each object of a labeled image. All values are calculated with
+    label-indexed reductions (np.bincount) in one pass over the labeled pixels instead of a loop over the objects.
+    :param labeled: labeled image (0 is background, objects are labeled 1, 2, 3, ...)
+    :param max_indices: map of maximum indices
+    :return: dictionary of 1-D np.ndarrays, one entry per label: "label", "area", "y", "x" (centroid), "z_mean",
+    "z_std", "z_median", "z_mode" (most frequent maximum-index) and "mode_fraction" (fraction of pixels at z_mode)
+    '''
+    n_labels=int(labeled.max())
+    flat_indices=np.flatnonzero(labeled)
+    labels=labeled.ravel()[flat_indices]-1
+    z=max_indices.ravel()[flat_indices]
+    rows,cols=np.divmod(flat_indices,labeled.shape[1])
+
+    area=np.bincount(labels,minlength=n_labels)
+    # labels that don't occur (e.g. after removing objects) are excluded
+    valid=area>0
+    with np.errstate(invalid="ignore",divide="ignore"):
+        y=np.bincount(labels,weights=rows,minlength=n_labels)/area
+        x=np.bincount(labels,weights=cols,minlength=n_labels)/area
+        z_mean=np.bincount(labels,weights=z,minlength=n_labels)/area
+        z_std=np.sqrt(np.bincount(labels,weights=(z-z_mean[labels])**2,minlength=n_labels)/area)
+
+    # median: sorting the maximum-indices by label and value, the medians are at the middle of each label's block
+    z_sorted=z[np.lexsort((z,labels))].astype(float)
+    start=np.cumsum(area)-area
+    middle_low=start+np.maximum(area-1,0)//2
+    middle_high=start+area//2
+    z_median=np.full(n_labels,np.nan)
+    z_median[valid]=(z_sorted[middle_low[valid]]+z_sorted[middle_high[valid]])/2
+
+    # histogram of maximum-indices for each label
+    n_z=int(max_indices.max())+1
+    z_counts=np.bincount(labels*n_z+z,minlength=n_labels*n_z).reshape(n_labels,n_z)
+    z_mode=np.argmax(z_counts,axis=1)
+    with np.errstate(invalid="ignore",divide="ignore"):
+        mode_fraction=z_counts[np.arange(n_labels),z_mode]/area
+
+    stats={"label":np.arange(1,n_labels+1),"area":area,"y":y,"x":x,"z_mean":z_mean,"z_std":z_std,
+           "z_median":z_median,"z_mode":z_mode,"mode_fraction":mode_fraction}
+    return {key:value[valid] for key,value in stats.items()}
+
+def focus_statistics(labeled,labels,projection):
+    '''
+    Bright field features of each object, to tell nuclei in cells from fluorescent debris: a cell has a sharp outline
+    in the bright field images at the depth of its nucleus, debris often has none.
+    :param labeled: labeled image
+    :param labels: labels of the objects (e.g. stats["label"] from cell_statistics)
+    :param projection: dictionary from cached_projection with focus_layer
+    :return: dictionary of 1-D np.ndarrays, one entry per label: "bf_variance" (mean local variance of the bright field
+    in the slice of the fluorescence maximum) and "bf_focus_z" (mean slice of the best bright field focus)
+    '''
+    n_labels=int(labeled.max())
+    flat_indices=np.flatnonzero(labeled)
+    object_labels=labeled.ravel()[flat_indices]-1
+    area=np.bincount(object_labels,minlength=n_labels)
+    index=np.asarray(labels,dtype=int)-1
+    features={}
+    for name,values in [("bf_variance",projection["focus_at_max"]),("bf_focus_z",projection["focus_indices"])]:
+        with np.errstate(invalid="ignore",divide="ignore"):
+            features[name]=(np.bincount(object_labels,weights=values.ravel()[flat_indices],minlength=n_labels)
+                            /area)[index]
+    return features
+
+def get_max_indices_and_position(mask,max_indices):
+    '''
+    Estimating the z-position of cells from a segmentation mask. individual objects are identified by labeling, then
+    the z-position is calculated by taking the mean of the maximum-indices in the area of each objects. This also
+    returns the x-y-positions of cells by calculating the centroid of each object. Additionally it calculates the
+    standard deviation of the maximum indices. A large standard is a signe for problems. See cell_statistics for
+    further values (area, median, ...).
+    :param mask: Boolean-segmentation mask
+    :param max_indices: map of maximum indices
+    :return: max_indices_list (1-D np.ndarray), index_variation (1-D np.ndarray), pos_list (np.ndarray of shape (n, 2)
+    with the y and x position of each cell)
+    '''
+    labeled = measure_label(mask)
+    stats=cell_statistics(labeled,max_indices)
+    pos_list=np.stack([stats["y"],stats["x"]],axis=1)
+    return stats["z_mean"],stats["z_std"],pos_list
+
+def write_to_db(db,max_indices_list,pos_list,index_variation,var_flags,layer="modeFluo5",marker_type_name="cells"):
+    '''
+    Adding the cell positions as markers (of type "track) to the database. The tracks and markers of marker_type_name
+    from an earlier run are replaced, all tracks and markers are deleted and inserted in one transaction.
+    :param db: clickpoints Database object
+    :param max_indices_list: list of z-positions of cells
+    :param pos_list: list of tuples; list of xy-positions of cells
+    :param index_variation: list of standard deviations of maximum indices in the cell area
+    :param var_flags: list,str; List of strings, that are used as Annotations to the markers in the Database
+    This is used as a warning in case of high standard deviation of maximum indices.
+    :return:
+    '''
+    marker_type=db.setMarkerType(marker_type_name,color="#1fff00",mode=4)
+    frames=np.round(np.asarray(max_indices_list)).astype(int)
+    # image ids of all frames of the layer, resolved with a single query
+    image_ids={image.sort_index:image.id for image in db.getImages(layer=layer)}
+    missing=set(frames.tolist())-set(image_ids)
+    if len(missing)>0:
+        raise ValueError("no images in layer %s for frames %s" % (layer,str(sorted(missing))))
+
+    with db.db.atomic():
+        # removing the results of an earlier run (the databases are kept when they are updated)
+        old_tracks=db.table_track.select(db.table_track.id).where(db.table_track.type==marker_type.id)
+        db.table_marker.delete().where(db.table_marker.track.in_(old_tracks)|
+                                       (db.table_marker.type==marker_type.id)).execute()
+        db.table_track.delete().where(db.table_track.type==marker_type.id).execute()
+        if len(frames)==0:
+            return
+        # one new track per cell. The ids of the new tracks are the ids above the largest existing id.
+        last_id=db.table_track.select(peewee.fn.MAX(db.table_track.id)).scalar() or 0
+        insert_many(db.table_track,[{"type":marker_type.id} for i in range(len(frames))])
+        track_ids=[t.id for t in db.table_track.select(db.table_track.id).where(db.table_track.id>last_id)
+                   .order_by(db.table_track.id)]
+        # like setMarker with a track, the marker type is given by the track
+        markers=[{"image":image_ids[frame],"x":pos[1],"y":pos[0],"track":track_id,"text":var_flag}
+                 for frame,pos,var_flag,track_id in zip(frames.tolist(),pos_list,var_flags,track_ids)]
+        insert_many(db.table_marker,markers)
+
+def write_textfile(folder,max_indices_list,pos_list,z_fit=None):
+    '''
+    writing a text file with x,y and z positions of the cell
+    :param folder:
+    :param max_indices_list:
+    :param pos_list:
+    :param z_fit: optional list of z-positions from the focus profiles (see focus_profile.py), written as fourth column
+    :return:
+    '''
+    if z_fit is None:
+        xyz_array=np.round(np.array([[x,y,z] for (y,x),z in zip(pos_list,max_indices_list)]),2)
+        header="x,y,z"
+    else:
+        xyz_array=np.round(np.array([[x,y,z,zf] for (y,x),z,zf in zip(pos_list,max_indices_list,z_fit)]),2)
+        header="x,y,z,z_fit"
+    np.savetxt(os.path.join(folder,"xyz_positions.txt"),xyz_array,fmt='%1.2f',header=header)
+
+def flag_variation(index_variation,threshold=2):
+    '''
+    Identifying problematic cells (cells where the standard deviation of the maximum indices in the cell area is higher
+    the the threshold is problematic). This returns a list of annotations, that are added to the markers in the Database
+    :param index_variation: list of standard deviations of the maximum indices in the cell area
+    :param threshold: threshold of standard deviations of the maximum indices in the cell area that defines which cells are
+    problematic
+    :return:
+    '''
+    var_flags=["" if var<threshold else "\nhigh variation (%s)"%str(np.round(var,1)) for var in index_variation ]
+    return var_flags
+
+def projection_key(stack,layer):
+    '''
+    Cache key of the projection of a stack: changes if an image file is added, removed, reordered or modified.
+    :param stack: StackReader of the layer
+    :param layer: string; the layer name.
+    :return: string
+    '''
+    return make_key("projection",layer,files_key(stack.files),stack.indices)
+
+def cached_projection(db,layer,cache,progress=True,profiler=None,focus_layer=None,focus_size=5):
+    '''
+    Projections and index maps of a layer (see create_z_stack), loaded from the cache if the image files didn't change.
+    With a focus_layer, the focus of that layer is computed after the projection (projection.project_focus) and cached
+    separately (stage "focus"), so the key of the projection and of the later stages doesn't change. Each layer is read
+    once (reading both layers in the same pass is not faster, see benchmarks/dual_channel.py). If a slice of the layer
+    has no image in the focus layer, a warning is given and only the projection is returned.
+    :param db: clickpoints Database object
+    :param layer: string; the layer name.
+    :param cache: ArtifactCache of the position
+    :param progress: boolean; show a progress bar
+    :param profiler: profiling.StageProfiler, see create_z_stack
+    :param focus_layer: string; name of the bright field layer, or None
+    :param focus_size: edge length of the window of the local variance of the focus layer
+    :return: dictionary with max_indices, min_indices, max_proj and min_proj (and focus_indices, focus, focus_at_max
+    with a complete focus_layer); key of the projection stage
+    '''
+    stack=StackReader.from_database(db,layer)
+    key=projection_key(stack,layer)
+    def compute():
+        max_indices, min_indices, max_proj, min_proj=create_z_stack(db,layer=layer,progress=progress,stack=stack,
+                                                                    profiler=profiler)
+        return {"max_indices":max_indices,"min_indices":min_indices,"max_proj":max_proj,"min_proj":min_proj}
+    projection=cache.get("projection",key,compute)
+    if focus_layer is None:
+        return projection,key
+    try:
+        focus_stack=StackReader.from_database(db,focus_layer)
+        missing=set(stack.indices)-set(focus_stack.indices)
+    except peewee.DoesNotExist:
+        # the database has no focus layer
+        missing=set(stack.indices)
+    if len(missing):
+        # e.g. an acquisition without bright field images or one that was stopped early
+        warnings.warn("%s: %d of %d slices have no image in the focus layer %s, the cells get no bright field features"
+                      %(os.path.normpath(os.path.dirname(stack.files[0])),len(missing),len(stack),focus_layer))
+        return projection,key
+    focus_key=make_key(key,"focus",focus_layer,files_key(focus_stack.files),focus_stack.indices,focus_size)
+    def compute_focus():
+        frames=focus_stack.frames() if profiler is None else profiler.iterate("image_load",focus_stack.frames())
+        arrays=project_focus(tqdm(frames,total=len(focus_stack),disable=not progress),projection["max_indices"],
+                             n_frames=max(stack.indices)+1,indices=focus_stack.indices,focus_size=focus_size)
+        return dict(zip(["focus_indices","focus","focus_at_max"],arrays))
+    return dict(projection,**cache.get("focus",focus_key,compute_focus)),key
+
+def process_position(db_path,layer="modeFluo5",marker_type_name="cell_in_focus",progress=True,gauss_1=1,gauss_2=2,
+                     threshold="otsu",threshold_factor=1,closing_iterations=4,area_factor=1,use_cache=True,
+                     profiler=None,detector="projection",gauss_z_1=1,gauss_z_2=2,area_factor_3d=3,chunk_size=16,
+                     threads=None,store_projection=True,focus_layer=None,focus_size=5,tile_size=None):
+    '''
+    Full evaluation of one position: projections, segmentation, z-positions, markers in the database and the text
+    file with x,y and z positions. The database is opened and closed here, so this can run in a separate process
+    for each position.
+    Projections, the segmentation mask, the cleaned labels and the fitted z-positions are cached in the folder
+    "z_position_cache" next to the database. A stage is only recomputed if the image files or the parameters of the
+    stage (or of an earlier stage) changed, so changing e.g. the area_factor doesn't recompute the projections.
+    :param db_path: path to the sorted.cdb database of the position
+    :param layer: string; the layer name of the fluorescence images.
+    :param marker_type_name: name of the marker type that is used for the cells
+    :param progress: boolean; show progress bars
+    :param gauss_1, gauss_2, threshold, threshold_factor, tile_size: parameters of detect_dog (with a tile_size, the
+    projection is filtered in tiles by threads threads; the mask is the same as without tiles)
+    :param closing_iterations, area_factor: parameters of clean_up_mask
+    :param use_cache: boolean; Choose if cached intermediate results are used and saved
+    :param profiler: profiling.StageProfiler that records the time, memory and number of items of each stage
+    :param detector: "projection" (segmentation of the maximum projection) or "3d" (detection in the z-stack, see
+    detection_3d.detect_cells_3d; closing_iterations and area_factor are not used)
+    :param gauss_z_1, gauss_z_2, chunk_size: parameters of detect_cells_3d
+    :param area_factor_3d: area_factor of detect_cells_3d. The volumes of the nuclei vary more than their areas in
+    the projection, a factor of 1 would exclude dim nuclei (see benchmarks/detection_3d.py)
+    :param threads: number of threads of detect_cells_3d and of the tiled detect_dog (default: number of CPUs)
+    :param store_projection: boolean; save the maximum projection and the z-index map in the folder "projection" and
+    register them as layers in the database (see projection_store.py, only for the "projection" detector)
+    :param focus_layer: string; bright field layer (e.g. "modeBF") whose focus is reduced after the projection, the
+    cells get the bright field features of focus_statistics (only for the "projection" detector; without a complete
+    bright field stack, the position is evaluated with the fluorescence only and a warning)
+    :param focus_size: edge length of the window of the local variance of the focus layer
+    :return: number of cells that were found
+    '''
+    folder=os.path.split(db_path)[0]
+    profiler=profiler or StageProfiler(folder)
+    cache=ArtifactCache(os.path.join(folder,"z_position_cache"),enabled=use_cache)
+    db=clickpoints.DataFile(db_path,"r")
+    try:
+        if detector=="3d":
+            # nuclei are detected in the z-stack itself (see detection_3d.py), cells that overlap in the projection
+            # but lie at different depths are separated
+            with profiler.stage("detect_3d") as record:
+                stack=StackReader.from_database(db,layer)
+                key=make_key(projection_key(stack,layer),"3d",gauss_1,gauss_2,gauss_z_1,gauss_z_2,threshold,
+                             threshold_factor,area_factor_3d)
+                stats=cache.get("cells_3d",key,lambda: detect_cells_3d(
+                    stack,gauss_1=gauss_1,gauss_2=gauss_2,gauss_z_1=gauss_z_1,gauss_z_2=gauss_z_2,threshold=threshold,
+                    threshold_factor=threshold_factor,area_factor=area_factor_3d,chunk_size=chunk_size,workers=threads))
+                max_indices_list,index_variation=stats["z_mean"],stats["z_std"]
+                pos_list=np.stack([stats["y"],stats["x"]],axis=1)
+                record["items"]=len(max_indices_list)
+            # the z-position is already the centroid in the stack
+            z_fit=None
+        else:
+            # generating mninium, maximum projections and corresponding index-maps
+            with profiler.stage("projection") as record:
+                projection,proj_key=cached_projection(db,layer,cache,progress=progress,profiler=profiler,
+                                                      focus_layer=focus_layer,focus_size=focus_size)
+                max_indices=projection["max_indices"]
+                record["items"]=max_indices.size
+            # maximum projection and z-index map as compact images in the database, for viewing the focus map and for
+            # re-analysis without the z-stack (see projection_store.py)
+            if store_projection:
+                with profiler.stage("projection_store"):
+                    files,written=save_projection(folder,layer,projection,proj_key)
+                    register_projection(db,layer,files)
+            # finding the area of cell (nuclei?) by using the maximums projection
+            def compute_mask():
+                mask, detections = detect_dog(projection["max_proj"],gauss_1=gauss_1,gauss_2=gauss_2,
+                                              threshold=threshold,exclude_close_to_edge=False,
+                                              threshold_factor=threshold_factor,tile_size=tile_size,workers=threads)
+                return {"mask":mask}
+            with profiler.stage("detect_dog",items=max_indices.size):
+                dog_key=make_key(proj_key,gauss_1,gauss_2,threshold,threshold_factor)
+                mask=cache.get("dog_mask",dog_key,compute_mask)["mask"]
+            # filling small holes in objects and excluding small objects
+            def compute_labels():
+                mask_clean, labeled = clean_up_mask(mask,closing_iterations=closing_iterations,
+                                                    area_factor=area_factor,return_labels=True)
+                return {"labeled":labeled}
+            with profiler.stage("clean_up_mask",items=max_indices.size):
+                # "v3": labels of clean_up_mask with the 4-connected size filter, older cached labels are recomputed
+                labels_key=make_key(dog_key,"v3",closing_iterations,area_factor)
+                labeled=cache.get("labels",labels_key,compute_labels)["labeled"]
+            # calculating z-position of cell by taking the mean of maximum-indices in the area of the cell.
+            with profiler.stage("cell_stats") as record:
+                stats=cell_statistics(labeled,max_indices)
+                max_indices_list,index_variation=stats["z_mean"],stats["z_std"]
+                pos_list=np.stack([stats["y"],stats["x"]],axis=1)
+                record["items"]=len(max_indices_list)
+            # bright field features of each cell, from the focus maps of the projection stage
+            if "focus" in projection:
+                with profiler.stage("focus_stats",items=len(max_indices_list)):
+                    stats.update(focus_statistics(labeled,stats["label"],projection))
+            # sub-slice z-position from the focus profile of each cell, only the bounding boxes of the cells are read
+            # (cached, changing a later parameter doesn't read the stack again)
+            def compute_z_fit():
+                stack=StackReader.from_database(db,layer)
+                return {"z_fit":fit_z_positions(stack,labeled,labels=stats["label"],metric="intensity",
+                                                method="parabolic")}
+            with profiler.stage("z_fit",items=len(max_indices_list)):
+                z_fit_key=make_key(labels_key,"intensity","parabolic")
+                z_fit=cache.get("z_fit",z_fit_key,compute_z_fit)["z_fit"]
+        # identifying cells where the maximum-indices have a high standard deviation, these could be problematic and are
+        # annotated
+        var_flags=flag_variation(index_variation,threshold=2)
+        # adding markers (as tracks) to the database
+        with profiler.stage("db_write",items=len(max_indices_list)):
+            write_to_db(db,max_indices_list,pos_list,index_variation,var_flags,layer=layer,
+                        marker_type_name=marker_type_name)
+        with profiler.stage("text_write",items=len(max_indices_list)):
+            # writing a text file with x,y,z positions of the cells
+            write_textfile(folder,max_indices_list,pos_list,z_fit=z_fit)
+            # columnar results of the position, gathered for the whole plate by results_store.collect_plate
+            write_position_results(folder,stats,z_fit=z_fit)
+
+        # trying to set display options for tracks (does this work?)
+        try:
+            db.setOption("tracking_show_trailing", 300)
+            db.setOption("tracking_show_leading", 300)
+        except:
+            pass
+    finally:
+        # closing the database object
+        db.db.close()
+    return len(max_indices_list)
@@ -0,0 +1,301 @@
+# Per-stage timing of the z-position pipeline. process_position records wall time, CPU time, the resident memory at the
+# start and end of the stage, the peak increase of the memory during the stage and the number of processed items
+# (images, pixels, cells) for each stage. The batch runner collects the
+# records of all positions; write_report saves them as JSON or CSV and print_stage_table summarizes them.
+# Stages are exclusive: the time of a stage that runs inside another stage (e.g. image_load inside projection) is
+# subtracted from the outer stage, so the stages of a position add up to its total time.
+# The peak of a stage is measured from its own start: on Linux the high-water mark of the process is reset at the start
+# of every stage (/proc/self/clear_refs), elsewhere the memory is sampled by a background thread (psutil) that only runs
+# while a stage is open. So the peak doesn't include earlier stages or earlier positions of the same worker process.
+
+import os
+import csv
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+report_columns = ["position", "stage", "wall", "cpu", "rss_start_mb", "rss_end_mb", "peak_increase_mb", "items"]
+clear_refs_path = "/proc/self/clear_refs"
+
+
+def _proc_status_mb(field):
+    '''
+    A memory field (e.g. "VmRSS", "VmHWM") of /proc/self/status in MB, None if it isn't available.
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    '''
+    Current resident memory of this process in MB, None if it can't be determined.
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    return _proc_status_mb("VmRSS")
+
+
+class PeakTracker:
+    '''
+    Peak resident memory of the process since the last reset. On Linux the high-water mark of the kernel is reset and
+    read (exact), otherwise a background thread samples the memory with psutil every interval seconds (peaks shorter
+    than the interval can be missed) between start and stop. Without both, the peak is None.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.kernel = False
+        try:
+            with open(clear_refs_path, "w") as f:
+                f.write("5")
+            self.kernel = _proc_status_mb("VmHWM") is not None
+        except OSError:
+            pass
+        self._peak = None
+        self._thread = None
+        self._stop = threading.Event()
+        # number of callers (profilers with an open stage) that need the sampling thread
+        self._users = 0
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update()
+
+    def _update(self):
+        rss = rss_mb()
+        self._peak = rss if self._peak is None else max(self._peak, rss)
+
+    def start(self):
+        '''
+        Starting the sampling thread (only without the kernel high-water mark), if it isn't running yet.
+        '''
+        if self.kernel or psutil is None:
+            return
+        with self._lock:
+            self._users += 1
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._sample, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        '''
+        Stopping the sampling thread when the last caller of start is done.
+        '''
+        if self.kernel or psutil is None:
+            return
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._thread is not None:
+                self._stop.set()
+                self._thread.join()
+                self._thread = None
+
+    def reset(self):
+        if self.kernel:
+            with open(clear_refs_path, "w") as f:
+                f.write("5")
+        elif psutil is not None:
+            self._peak = rss_mb()
+
+    def peak(self):
+        '''
+        :return: peak resident memory in MB since the last reset, None if it can't be determined
+        '''
+        if self.kernel:
+            return _proc_status_mb("VmHWM")
+        if psutil is not None:
+            # the current memory as well, for stages that are shorter than the sampling interval
+            self._update()
+        return self._peak
+
+
+_tracker = None
+
+
+def peak_tracker():
+    '''
+    :return: the PeakTracker of this process (shared by all profilers)
+    '''
+    global _tracker
+    if _tracker is None:
+        _tracker = PeakTracker()
+    return _tracker
+
+
+def _max(a, b):
+    return a if b is None else b if a is None else max(a, b)
+
+
+class StageProfiler:
+    '''
+    Records the stages of one position. Use
+        with profiler.stage("detect_dog") as record:
+            ...
+            record["items"] = n
+    Stages can be nested, the time of inner stages is subtracted from the outer stage. The peak memory of an outer
+    stage includes its inner stages. Profilers that run at the same time in several threads of one process share the
+    high-water mark, their peaks are not separated.
+    '''
+
+    def __init__(self, position=""):
+        self.position = position
+        self.records = []
+        self._open = []
+        # peak memory of each open stage before the last reset of the tracker
+        self._peaks = []
+        self._tracker = peak_tracker()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        record = {"position": self.position, "stage": name, "wall": 0.0, "cpu": 0.0, "rss_start_mb": rss_mb(),
+                  "rss_end_mb": None, "peak_increase_mb": None, "items": items}
+        if self._peaks:
+            # the peak of the outer stage so far, before the high-water mark is reset
+            self._peaks[-1] = _max(self._peaks[-1], self._tracker.peak())
+        else:
+            self._tracker.start()
+        self._tracker.reset()
+        self._open.append(record)
+        self._peaks.append(record["rss_start_mb"])
+        t_wall, t_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            peak = _max(self._peaks.pop(), self._tracker.peak())
+            if not self._open:
+                # the sampling thread only runs while a stage is open
+                self._tracker.stop()
+            self._close(record, time.perf_counter() - t_wall, time.process_time() - t_cpu, peak)
+
+    def _close(self, record, wall, cpu, peak):
+        record["wall"] += wall
+        record["cpu"] += cpu
+        record["rss_end_mb"] = rss_mb()
+        if peak is not None and record["rss_start_mb"] is not None:
+            record["peak_increase_mb"] = max(peak - record["rss_start_mb"], 0)
+        if self._open:
+            self._open[-1]["wall"] -= wall
+            self._open[-1]["cpu"] -= cpu
+            self._peaks[-1] = _max(self._peaks[-1], peak)
+        self.records.append(record)
+
+    def iterate(self, name, iterable):
+        '''
+        Recording the time needed to produce the items of an iterable (e.g. reading the slices of a stack) as one
+        stage; the work done with each item is not included. The memory of the items is part of the peak of the stage
+        that uses them, only the resident memory at the start and the end is recorded.
+        '''
+        record = {"position": self.position, "stage": name, "wall": 0.0, "cpu": 0.0, "rss_start_mb": rss_mb(),
+                  "rss_end_mb": None, "peak_increase_mb": None, "items": 0}
+        outer = self._open[-1] if self._open else None
+        iterator = iter(iterable)
+        wall = cpu = 0.0
+        try:
+            while True:
+                t_wall, t_cpu = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    wall += time.perf_counter() - t_wall
+                    cpu += time.process_time() - t_cpu
+                record["items"] += 1
+                yield item
+        finally:
+            record["wall"], record["cpu"] = wall, cpu
+            record["rss_end_mb"] = rss_mb()
+            if outer is not None:
+                outer["wall"] -= wall
+                outer["cpu"] -= cpu
+            self.records.append(record)
+
+
+@contextmanager
+def optional_cprofile(path=None):
+    '''
+    Running the enclosed code with cProfile and saving the statistics to path (e.g. for snakeviz or pstats). Nothing
+    is profiled if path is None.
+    '''
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+
+def collect_records(summaries):
+    return [record for s in summaries for record in (s.get("stages") or [])]
+
+
+def write_report(summaries, path):
+    '''
+    Saving the stage records of all positions. A .csv file gets one row per position and stage, otherwise a JSON file
+    with the summaries (including the stages) is written.
+    :param summaries: list of summary dictionaries from batch.run_batch
+    :param path: path of the report
+    :return:
+    '''
+    if os.path.splitext(path)[1].lower() == ".csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=report_columns)
+            writer.writeheader()
+            writer.writerows(collect_records(summaries))
+    else:
+        with open(path, "w") as f:
+            json.dump(summaries, f, indent=1)
+
+
+def stage_table(records):
+    '''
+    Totals of each stage over all positions, in the order in which the stages first appear.
+    :return: list of dictionaries with "stage", "positions", "wall", "cpu", "peak_increase_mb" (largest increase of
+    the memory during the stage in any position), "items"
+    '''
+    table = {}
+    for r in records:
+        row = table.setdefault(r["stage"], {"stage": r["stage"], "positions": 0, "wall": 0.0, "cpu": 0.0,
+                                            "peak_increase_mb": None, "items": 0})
+        row["positions"] += 1
+        row["wall"] += r["wall"]
+        row["cpu"] += r["cpu"]
+        row["items"] += r["items"] or 0
+        row["peak_increase_mb"] = _max(row["peak_increase_mb"], r.get("peak_increase_mb"))
+    return list(table.values())
+
+
+def print_stage_table(summaries):
+    '''
+    Printing the time spent in each stage, summed over all positions.
+    :param summaries: list of summary dictionaries from batch.run_batch
+    :return:
+    '''
+    rows = stage_table(collect_records(summaries))
+    total = sum(r["wall"] for r in rows) or 1
+    print("\n%-16s %9s %9s %9s %6s %12s %12s" % ("stage", "wall [s]", "cpu [s]", "per pos", "%", "items",
+                                                "peak +MB"))
+    for r in rows:
+        print("%-16s %9.2f %9.2f %9.3f %6.1f %12d %12s" % (
+            r["stage"], r["wall"], r["cpu"], r["wall"] / r["positions"], 100 * r["wall"] / total, r["items"],
+            "-" if r["peak_increase_mb"] is None else "%.0f" % r["peak_increase_mb"]))
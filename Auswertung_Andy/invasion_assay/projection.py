@@ -0,0 +1,243 @@
+# Streaming minimum- and maximum-projections of z-stacks.
+# All projections and index maps are computed in a single pass over the slices. Each slice is only read once and
+# is reduced in place into the projection arrays, so no float copy of the slices is needed.
+# A second layer (the bright field images) can be reduced in the same pass: FocusProjector keeps the best focus of each
+# pixel (maximal local variance) and the local variance in the slice of the fluorescence maximum.
+
+import numpy as np
+from scipy import ndimage
+
+
+def index_dtype(n_frames):
+    '''
+    Smallest unsigned integer type that can hold the slice index of a stack with n_frames slices.
+    :param n_frames: int or None; number of slices. None (unknown number of slices) returns np.uint16.
+    :return:
+    '''
+    if n_frames is not None and n_frames <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    return np.uint16
+
+
+class ZProjector:
+    '''
+    Accumulates maximum- and minimum-projections and the corresponding index maps (slice of the maximum/minimum)
+    slice by slice. Slices can be added in any order, but the index of each slice must be given if they are not added
+    in ascending order. In case of equal values the slice that was added first is kept (for ascending order this is
+    the same as np.argmax/np.argmin).
+    '''
+
+    def __init__(self, shape, dtype=np.uint16, n_frames=None, with_min=True, tile_rows=None):
+        '''
+        :param shape: tuple; shape of a single slice.
+        :param dtype: dtype of the projections. Slices are cast to this type if necessary.
+        :param n_frames: int; number of slices, used to choose a compact type for the index maps.
+        :param with_min: boolean; Choose if the minimum-projection is calculated as well.
+        :param tile_rows: int; If set, slices are processed in blocks of this many rows. This keeps the temporary
+        arrays small for wide images and only reads one block at a time from memory-mapped slices.
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.with_min = with_min
+        self.tile_rows = tile_rows if tile_rows else self.shape[0]
+        self.n_added = 0
+        idx_dtype = index_dtype(n_frames)
+        self.max_proj = np.zeros(self.shape, dtype=self.dtype)
+        self.max_indices = np.zeros(self.shape, dtype=idx_dtype)
+        if with_min:
+            self.min_proj = np.full(self.shape, self._max_value(), dtype=self.dtype)
+            self.min_indices = np.zeros(self.shape, dtype=idx_dtype)
+        else:
+            self.min_proj = None
+            self.min_indices = None
+        # boolean buffer reused for every block
+        self._update = np.empty((self.tile_rows,) + self.shape[1:], dtype=bool)
+
+    def _max_value(self):
+        if self.dtype.kind in "ui":
+            return np.iinfo(self.dtype).max
+        return np.inf
+
+    def add(self, frame, z=None):
+        '''
+        Adding one slice to the projections.
+        :param frame: 2-D np.ndarray (or memory map) with the shape of the projection.
+        :param z: int; index of the slice. Defaults to the number of slices added before.
+        :return:
+        '''
+        if z is None:
+            z = self.n_added
+        if frame.shape != self.shape:
+            raise ValueError("slice %d has shape %s, expected %s" % (z, str(frame.shape), str(self.shape)))
+        if z > np.iinfo(self.max_indices.dtype).max:
+            raise ValueError("slice index %d does not fit into the index maps (%s)" % (z, self.max_indices.dtype))
+
+        for r0 in range(0, self.shape[0], self.tile_rows):
+            rows = slice(r0, r0 + self.tile_rows)
+            block = frame[rows]
+            if block.dtype != self.dtype:
+                block = block.astype(self.dtype)
+            update = self._update[:block.shape[0]]
+
+            if self.n_added == 0:
+                # first slice: all values are taken
+                self.max_proj[rows] = block
+                self.max_indices[rows] = z
+                if self.with_min:
+                    self.min_proj[rows] = block
+                    self.min_indices[rows] = z
+                continue
+
+            np.greater(block, self.max_proj[rows], out=update)
+            np.copyto(self.max_indices[rows], z, where=update, casting="unsafe")
+            np.maximum(self.max_proj[rows], block, out=self.max_proj[rows])
+            if self.with_min:
+                np.less(block, self.min_proj[rows], out=update)
+                np.copyto(self.min_indices[rows], z, where=update, casting="unsafe")
+                np.minimum(self.min_proj[rows], block, out=self.min_proj[rows])
+        self.n_added += 1
+
+    def result(self):
+        '''
+        :return: max_indices, min_indices, max_proj, min_proj (min_indices and min_proj are None if with_min is False)
+        '''
+        return self.max_indices, self.min_indices, self.max_proj, self.min_proj
+
+
+def project_stack(frames, n_frames=None, dtype=None, with_min=True, tile_rows=None, indices=None):
+    '''
+    Creating minimum- and maximum-projections and index maps from an iterable of slices in a single pass. The slices
+    must be ordered by their z-position.
+    :param frames: iterable of 2-D np.ndarrays (or memory maps)
+    :param n_frames: int; number of slices (or highest index + 1), used to choose a compact type for the index maps.
+    :param dtype: dtype of the projections. Defaults to the dtype of the first slice.
+    :param with_min: boolean; Choose if the minimum-projection is calculated as well.
+    :param tile_rows: int; process slices in blocks of this many rows (see ZProjector).
+    :param indices: list of int; index of each slice that is written to the index maps. Defaults to 0, 1, 2, ...
+    :return: max_indices, min_indices, max_proj, min_proj
+    '''
+    projector = None
+    for i, frame in enumerate(frames):
+        if projector is None:
+            projector = ZProjector(frame.shape, dtype=frame.dtype if dtype is None else dtype, n_frames=n_frames,
+                                   with_min=with_min, tile_rows=tile_rows)
+        projector.add(frame, i if indices is None else indices[i])
+    if projector is None:
+        raise ValueError("no slices to project")
+    return projector.result()
+
+
+def box_mean(image, size):
+    '''
+    Mean in a size x size window around each pixel, same as ndimage.uniform_filter(image, size, mode="nearest"). Along
+    the columns, shifted rows are added, which is several times faster than uniform_filter for wide images (its column
+    pass jumps through memory by the length of a row).
+    :param image: 2-D np.ndarray (float32)
+    :param size: edge length of the window
+    :return: 2-D np.ndarray
+    '''
+    rows = ndimage.uniform_filter1d(image, size, axis=1, mode="nearest")
+    half = size // 2
+    padded = np.concatenate([np.repeat(rows[:1], half, axis=0), rows, np.repeat(rows[-1:], size - 1 - half, axis=0)])
+    n = len(image)
+    mean = padded[:n].copy()
+    for i in range(1, size):
+        mean += padded[i:i + n]
+    mean /= size
+    return mean
+
+
+def local_variance(frame, size=5):
+    '''
+    Variance of the pixel values in a size x size window around each pixel. A focus measure for bright field images:
+    the edges of cells in focus give a high variance.
+    :param frame: 2-D np.ndarray
+    :param size: edge length of the window
+    :return: 2-D np.ndarray (float32)
+    '''
+    frame = np.array(frame, dtype=np.float32)
+    mean = box_mean(frame, size)
+    np.multiply(frame, frame, out=frame)
+    variance = box_mean(frame, size)
+    np.multiply(mean, mean, out=mean)
+    variance -= mean
+    return np.maximum(variance, 0, out=variance)
+
+
+class FocusProjector:
+    '''
+    Accumulates the focus (local variance) of a second layer slice by slice: the maximal local variance of each pixel,
+    its slice and the local variance in the slice in which the projected layer has its maximum.
+    '''
+
+    def __init__(self, shape, n_frames=None, size=5):
+        '''
+        :param shape: tuple; shape of a single slice.
+        :param n_frames: int; number of slices, used to choose a compact type for the index map.
+        :param size: edge length of the window of the local variance
+        '''
+        self.shape = tuple(shape)
+        self.size = size
+        self.focus = np.full(self.shape, -1, dtype=np.float32)
+        self.focus_indices = np.zeros(self.shape, dtype=index_dtype(n_frames))
+        self.focus_at_max = np.zeros(self.shape, dtype=np.float32)
+
+    def add(self, frame, z, at_max):
+        '''
+        Adding one slice.
+        :param frame: 2-D np.ndarray (or memory map) with the shape of the projection.
+        :param z: int; index of the slice.
+        :param at_max: boolean 2-D np.ndarray; pixels whose maximum in the projected layer is in this slice
+        :return:
+        '''
+        if frame.shape != self.shape:
+            raise ValueError("slice %d has shape %s, expected %s" % (z, str(frame.shape), str(self.shape)))
+        variance = local_variance(frame, self.size)
+        np.copyto(self.focus_indices, z, where=variance > self.focus, casting="unsafe")
+        np.maximum(self.focus, variance, out=self.focus)
+        np.copyto(self.focus_at_max, variance, where=at_max)
+
+    def result(self):
+        '''
+        :return: focus_indices, focus, focus_at_max
+        '''
+        return self.focus_indices, self.focus, self.focus_at_max
+
+
+def project_stack_with_focus(pairs, n_frames=None, dtype=None, with_min=True, tile_rows=None, indices=None,
+                             focus_size=5):
+    '''
+    Projections of a layer (see project_stack) and the focus of a second layer (see FocusProjector) in a single pass,
+    the slices of both layers are read together.
+    :param pairs: iterable of (slice of the projected layer, slice of the focus layer), ordered by z-position
+    :param focus_size: edge length of the window of the local variance
+    :return: max_indices, min_indices, max_proj, min_proj, focus_indices, focus, focus_at_max
+    '''
+    projector = None
+    for i, (frame, focus_frame) in enumerate(pairs):
+        z = i if indices is None else indices[i]
+        if projector is None:
+            projector = ZProjector(frame.shape, dtype=frame.dtype if dtype is None else dtype, n_frames=n_frames,
+                                   with_min=with_min, tile_rows=tile_rows)
+            focus = FocusProjector(frame.shape, n_frames=n_frames, size=focus_size)
+        projector.add(frame, z)
+        # pixels whose maximum is in this slice (earlier slices are kept for equal values, as in ZProjector)
+        focus.add(focus_frame, z, projector.max_indices == z)
+    if projector is None:
+        raise ValueError("no slices to project")
+    return projector.result() + focus.result()
+
+
+def project_focus(frames, max_indices, n_frames=None, indices=None, focus_size=5):
+    '''
+    Focus of a layer (see FocusProjector) when the projection of the other layer is already known, a single pass over
+    the focus layer.
+    :param frames: iterable of 2-D arrays of the focus layer, ordered by z-position
+    :param max_indices: index map of the maximum projection of the other layer
+    :return: focus_indices, focus, focus_at_max
+    '''
+    focus = FocusProjector(max_indices.shape, n_frames=n_frames, size=focus_size)
+    for i, frame in enumerate(frames):
+        z = i if indices is None else indices[i]
+        focus.add(frame, z, max_indices == z)
+    return focus.result()
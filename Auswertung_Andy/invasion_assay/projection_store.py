@@ -0,0 +1,107 @@
+# Maximum projection and z-index map of a position as image files. process_position writes them to the folder
+# "projection" of the position (uncompressed TIFF, so they can be opened as memory maps; uint16 projection, uint8 index
+# map for stacks with up to 256 slices) and registers them as layers "<layer>_max_projection" and "<layer>_z_index" in
+# the clickpoints database, in frame 0. The focus map can be browsed in clickpoints, and a position can be re-segmented
+# or checked (e.g. the z of each cell) without reading the z-stack.
+# The cache key of the projection (pipeline.projection_key) is stored in the description of the TIFF files, the files
+# are only rewritten if the projection changed.
+
+import os
+import numpy as np
+import tifffile
+
+from invasion_assay.stack_reader import open_image
+from invasion_assay.database_builder import insert_many
+
+projection_folder = "projection"
+# name of the array in the projection dictionary -> suffix of the file and layer name
+stored_arrays = {"max_proj": "max_projection", "max_indices": "z_index"}
+
+
+def projection_files(folder, layer):
+    '''
+    :param folder: position folder
+    :param layer: layer of the projected stack
+    :return: dictionary array name ("max_proj", "max_indices") -> path of the file
+    '''
+    return {name: os.path.join(folder, projection_folder, "%s_%s.tif" % (layer, suffix))
+            for name, suffix in stored_arrays.items()}
+
+
+def stored_key(path):
+    '''
+    :return: key stored in the description of a TIFF file, None if the file doesn't exist
+    '''
+    if not os.path.exists(path):
+        return None
+    with tifffile.TiffFile(path) as tif:
+        return tif.pages[0].description
+
+
+def save_projection(folder, layer, projection, key, compress=False):
+    '''
+    Writing the maximum projection and the z-index map of a position, if the stored files don't have the same key.
+    :param folder: position folder
+    :param layer: layer of the projected stack
+    :param projection: dictionary with "max_proj" and "max_indices" (see pipeline.cached_projection)
+    :param key: key of the projection
+    :param compress: boolean; write zlib compressed files (smaller, but they can't be opened as memory maps)
+    :return: dictionary array name -> path of the file; boolean, True if the files were written
+    '''
+    files = projection_files(folder, layer)
+    if all(stored_key(path) == key for path in files.values()):
+        return files, False
+    os.makedirs(os.path.join(folder, projection_folder), exist_ok=True)
+    for name, path in files.items():
+        # writing to a temporary file first, so that an interrupted run doesn't leave a broken file
+        tmp_path = path + ".part"
+        tifffile.imwrite(tmp_path, np.ascontiguousarray(projection[name]), description=key,
+                         compression="zlib" if compress else None, metadata=None)
+        os.replace(tmp_path, path)
+    return files, True
+
+
+def load_projection(folder, layer, key=None):
+    '''
+    Reading the stored maximum projection and z-index map of a position (as memory maps if they are uncompressed).
+    :param folder: position folder
+    :param layer: layer of the projected stack
+    :param key: if set, None is returned if the files were written for a different projection
+    :return: dictionary with "max_proj" and "max_indices", None if the files don't exist
+    '''
+    files = projection_files(folder, layer)
+    if not all(os.path.exists(path) for path in files.values()):
+        return None
+    if key is not None and any(stored_key(path) != key for path in files.values()):
+        return None
+    return {name: open_image(path) for name, path in files.items()}
+
+
+def register_projection(db, layer, files):
+    '''
+    Adding the projection files as images of the layers "<layer>_max_projection" and "<layer>_z_index" (frame 0) to
+    the database. The layers get the projected layer as base layer. Files that are already registered are skipped.
+    :param db: clickpoints Database object; the database file is in the position folder
+    :param layer: layer of the projected stack
+    :param files: dictionary from projection_files
+    :return: list of the names of the layers
+    '''
+    image = db.table_image
+    names = []
+    with db.db.atomic():
+        path = db.setPath(projection_folder)
+        base_layer = db.getLayer(layer)
+        rows = []
+        for name, file in files.items():
+            layer_name = "%s_%s" % (layer, stored_arrays[name])
+            target = db.getLayer(layer_name) or db.getLayer(layer_name, base_layer=base_layer, create=True)
+            names.append(layer_name)
+            filename = os.path.basename(file)
+            if image.select().where((image.filename == filename) & (image.path == path.id)).exists():
+                continue
+            with tifffile.TiffFile(file) as tif:
+                height, width = tif.pages[0].shape[:2]
+            rows.append({"filename": filename, "ext": os.path.splitext(filename)[1], "frame": 0, "sort_index": 0,
+                         "path": path.id, "layer": target.id, "width": width, "height": height})
+        insert_many(image, rows)
+    return names
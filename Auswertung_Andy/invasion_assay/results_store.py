@@ -0,0 +1,137 @@
+# Columnar storage of the detected cells. process_position saves the cells of each position as cells.npz in the
+# position folder. collect_plate gathers all positions of a plate into one results.npz file (one array per column,
+# one entry per cell), so that the analysis scripts can load a whole plate with a single read and select conditions
+# without walking through directories or parsing text files.
+
+import os
+import re
+import json
+import datetime
+import numpy as np
+
+from invasion_assay.file_router import pos_folder_pattern
+
+position_file_name = "cells.npz"
+# float columns of a position file
+position_columns = ["x", "y", "z", "z_fit", "index_variation", "area", "bf_variance", "bf_focus_z"]
+# columns that are only filled if the position was evaluated with a bright field layer (see
+# pipeline.focus_statistics), NaN otherwise and in files written before they existed
+optional_columns = ["bf_variance", "bf_focus_z"]
+date_pattern = re.compile(r"(?P<date>\d{8})-(?P<time>\d{6})_")
+
+
+def write_position_results(folder, stats, z_fit=None):
+    '''
+    Saving the cells of one position as cells.npz.
+    :param folder: position folder
+    :param stats: dictionary from cell_statistics (with the bright field features of focus_statistics, if available)
+    :param z_fit: optional z-positions from the focus profiles
+    :return:
+    '''
+    n = len(stats["z_mean"])
+    columns = {"x": stats["x"], "y": stats["y"], "z": stats["z_mean"], "index_variation": stats["z_std"],
+               "area": stats["area"], "z_fit": np.full(n, np.nan) if z_fit is None else z_fit}
+    for c in optional_columns:
+        columns[c] = stats.get(c, np.full(n, np.nan))
+    np.savez(os.path.join(folder, position_file_name), **{c: np.asarray(columns[c], dtype=float)
+                                                          for c in position_columns})
+
+
+def read_position_results(folder):
+    '''
+    Reading the cells of one position from cells.npz, or from xyz_positions.txt for positions that were evaluated
+    before cells.npz existed (missing columns are NaN).
+    :param folder: position folder
+    :return: dictionary of 1-D np.ndarrays, None if the position has no results
+    '''
+    path = os.path.join(folder, position_file_name)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            n = len(data["z"])
+            return {c: data[c] if c in data.files else np.full(n, np.nan) for c in position_columns}
+    path = os.path.join(folder, "xyz_positions.txt")
+    if os.path.exists(path):
+        xyz = np.loadtxt(path, ndmin=2)
+        n = xyz.shape[0]
+        columns = {c: np.full(n, np.nan) for c in position_columns}
+        for i, c in enumerate(["x", "y", "z", "z_fit"][:xyz.shape[1]]):
+            columns[c] = xyz[:, i]
+        return columns
+    return None
+
+
+def position_date(folder):
+    '''
+    Date of the acquisition, taken from the first image file name (e.g. 20200304-101010_Mic3_rep0000_pos00_...).
+    :return: string "YYYY-MM-DD" or "" if no image was found
+    '''
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            match = date_pattern.match(entry.name)
+            if match:
+                d = match.group("date")
+                return "%s-%s-%s" % (d[:4], d[4:6], d[6:])
+    return ""
+
+
+def collect_plate(plate_dir, output=None):
+    '''
+    Gathering the cells of all positions of a plate into one file. The condition of a position is its path relative
+    to plate_dir without the position folder (e.g. plate_dir/HA/pos01 -> "HA").
+    :param plate_dir: folder of the plate, containing condition folders with position folders
+    :param output: path of the results file (default: plate_dir/results.npz)
+    :return: path of the results file
+    '''
+    output = output or os.path.join(plate_dir, "results.npz")
+    columns = {c: [] for c in position_columns}
+    categories = {"condition": [], "position": [], "date": []}
+    for dir, subdirs, files in os.walk(plate_dir):
+        subdirs.sort()
+        if not pos_folder_pattern.search(os.path.split(dir)[1]):
+            continue
+        cells = read_position_results(dir)
+        if cells is None:
+            continue
+        n = len(cells["z"])
+        for c in position_columns:
+            columns[c].append(cells[c])
+        condition = os.path.relpath(os.path.split(dir)[0], plate_dir).replace("\\", "/")
+        for name, value in [("condition", condition), ("position", os.path.split(dir)[1]),
+                            ("date", position_date(dir))]:
+            categories[name].append(np.full(n, value))
+
+    arrays = {c: np.concatenate(v) if len(v) else np.zeros(0) for c, v in columns.items()}
+    metadata = {"plate": os.path.basename(os.path.normpath(plate_dir)), "plate_dir": os.path.abspath(plate_dir),
+                "created": datetime.datetime.now().isoformat(timespec="seconds"), "columns": position_columns}
+    for name, values in categories.items():
+        values = np.concatenate(values) if len(values) else np.zeros(0, dtype=str)
+        # categorical columns: the names are stored once, each cell gets a code
+        names, codes = np.unique(values, return_inverse=True)
+        arrays[name] = codes.astype(np.int32)
+        arrays[name + "_names"] = names
+    np.savez(output, _metadata=json.dumps(metadata), **arrays)
+    return output
+
+
+def load_results(path, condition=None, position=None):
+    '''
+    Loading the results of a plate.
+    :param path: path of the results file (see collect_plate)
+    :param condition: string or list of strings; only cells of these conditions are returned
+    :param position: string or list of strings; only cells of these positions (e.g. "pos01") are returned
+    :return: dictionary of 1-D np.ndarrays (x, y, z, z_fit, index_variation, area, bf_variance, bf_focus_z, condition,
+    position, date) and "metadata" (dictionary)
+    '''
+    with np.load(path) as data:
+        n = len(data["z"])
+        results = {c: data[c] if c in data.files else np.full(n, np.nan) for c in position_columns}
+        select = np.ones(len(results["z"]), dtype=bool)
+        for name, wanted in [("condition", condition), ("position", position), ("date", None)]:
+            values = data[name + "_names"][data[name]]
+            if wanted is not None:
+                select &= np.isin(values, np.atleast_1d(wanted))
+            results[name] = values
+        metadata = json.loads(str(data["_metadata"]))
+    results = {c: v[select] for c, v in results.items()}
+    results["metadata"] = metadata
+    return results
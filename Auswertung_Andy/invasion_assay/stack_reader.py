@@ -0,0 +1,141 @@
+# Lazy reader for the z-stacks of a position. The ordered list of image files of one layer is resolved once from the
+# clickpoints database (layer and sort_index, as written by sortLayersCoverT.py). Uncompressed TIFF files are opened as
+# memory maps, so only the pixels that are actually used are read from disk.
+
+import os
+import numpy as np
+import tifffile
+import imageio
+
+
+def open_image(filename, memmap=True):
+    '''
+    Opening an image file. Uncompressed TIFF files are returned as read-only memory maps, all other files are read
+    completely.
+    :param filename: path to the image
+    :param memmap: boolean; Choose if TIFF files are opened as memory maps
+    :return: 2-D np.ndarray or np.memmap
+    '''
+    if memmap and os.path.splitext(filename)[1].lower() in [".tif", ".tiff"]:
+        try:
+            return tifffile.memmap(filename, mode="r")
+        except ValueError:
+            # compressed or tiled TIFF files can't be memory-mapped
+            pass
+    if os.path.splitext(filename)[1].lower() in [".tif", ".tiff"]:
+        return tifffile.imread(filename)
+    return np.asarray(imageio.imread(filename))
+
+
+class StackReader:
+    '''
+    Ordered z-stack of image files. Slices are opened lazily when they are accessed. Indexing works like for a
+    (z, y, x) array, e.g. reader[5] returns slice 5 and reader[:, 100:150, 200:260] returns a (z, 50, 60) array. Only
+    the requested pixels are read for memory-mapped files.
+    '''
+
+    def __init__(self, files, indices=None, memmap=True, keep_open=False):
+        '''
+        :param files: list of image files, ordered by z-position
+        :param indices: list of int; frame number (sort_index in the database) of each file. Defaults to 0, 1, 2, ...
+        :param memmap: boolean; Choose if TIFF files are opened as memory maps
+        :param keep_open: boolean; Keep the memory maps open after the first access. This is faster for many small
+        reads (e.g. the bounding boxes of all cells), but pages that were read stay mapped.
+        '''
+        self.files = list(files)
+        self.indices = list(range(len(self.files))) if indices is None else list(indices)
+        self.memmap = memmap
+        self.keep_open = keep_open
+        self._memmaps = {}
+        self._shape = None
+        self._dtype = None
+
+    @classmethod
+    def from_database(cls, db, layer, memmap=True, keep_open=False):
+        '''
+        Resolving the ordered file list of one layer of a clickpoints database.
+        :param db: clickpoints Database object
+        :param layer: string; the layer name.
+        :param memmap: boolean; Choose if TIFF files are opened as memory maps
+        :param keep_open: boolean; Keep the memory maps open after the first access (see __init__)
+        :return: StackReader
+        '''
+        db_folder = os.path.dirname(db._database_filename)
+        files = []
+        indices = []
+        for image in db.getImages(layer=layer):
+            files.append(os.path.join(db_folder, image.path.path, image.filename))
+            indices.append(image.sort_index)
+        return cls(files, indices=indices, memmap=memmap, keep_open=keep_open)
+
+    def __len__(self):
+        return len(self.files)
+
+    def _read_slice_header(self):
+        frame = self.get_frame(0)
+        self._shape = frame.shape
+        self._dtype = frame.dtype
+
+    @property
+    def shape(self):
+        '''
+        Shape of the stack (z, y, x).
+        '''
+        if self._shape is None:
+            self._read_slice_header()
+        return (len(self),) + self._shape
+
+    @property
+    def dtype(self):
+        if self._dtype is None:
+            self._read_slice_header()
+        return self._dtype
+
+    def get_frame(self, z):
+        '''
+        :param z: int; position of the slice in the stack (not the sort_index)
+        :return: 2-D np.ndarray or np.memmap
+        '''
+        z = range(len(self))[z]
+        if z in self._memmaps:
+            return self._memmaps[z]
+        frame = open_image(self.files[z], memmap=self.memmap)
+        if self.keep_open and isinstance(frame, np.memmap):
+            self._memmaps[z] = frame
+        return frame
+
+    def frames(self):
+        '''
+        Iterating over all slices in z-order.
+        :return: generator of 2-D np.ndarrays or np.memmaps
+        '''
+        for z in range(len(self)):
+            yield self.get_frame(z)
+
+    def __iter__(self):
+        return self.frames()
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        z_item, yx_item = item[0], item[1:]
+        if isinstance(z_item, (int, np.integer)):
+            return np.asarray(self.get_frame(z_item)[yx_item])
+        zs = range(len(self))[z_item]
+        out = None
+        for i, z in enumerate(zs):
+            crop = self.get_frame(z)[yx_item]
+            if out is None:
+                out = np.empty((len(zs),) + crop.shape, dtype=crop.dtype)
+            out[i] = crop
+        return out
+
+    def read_crop(self, rows, cols, z=slice(None)):
+        '''
+        Reading a (z, y, x) block of the stack, e.g. the bounding box of a cell.
+        :param rows: slice; rows of the block
+        :param cols: slice; columns of the block
+        :param z: slice; slices of the block (default: all)
+        :return: 3-D np.ndarray
+        '''
+        return self[z, rows, cols]
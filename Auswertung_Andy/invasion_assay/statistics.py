@@ -0,0 +1,56 @@
+# Statistics for the analysis of invasion depths. All quantiles are calculated with one vectorized call (or directly
+# from sorted arrays) instead of one np.percentile call per quantile.
+
+import numpy as np
+
+
+def percentile(data, q, method="linear"):
+    '''
+    np.percentile for an array of percentiles, for old (interpolation=...) and new (method=...) numpy versions.
+    :param data: 1-D np.ndarray
+    :param q: percentile or array of percentiles (0 to 100)
+    :param method: e.g. "linear" or "nearest"
+    :return: np.ndarray with one value per percentile
+    '''
+    try:
+        return np.percentile(data, q, method=method)
+    except TypeError:
+        return np.percentile(data, q, interpolation=method)
+
+
+def sorted_percentile_nearest(sorted_data, q):
+    '''
+    Same as np.percentile(sorted_data, q, method="nearest"), but for data that is already sorted. No copy or partition
+    of the data is needed, so this is O(len(q)).
+    :param sorted_data: 1-D np.ndarray, sorted in ascending order
+    :param q: array of percentiles (0 to 100)
+    :return: np.ndarray with one value per percentile
+    '''
+    indices = np.around(np.asarray(q) / 100 * (len(sorted_data) - 1)).astype(int)
+    return sorted_data[indices]
+
+
+def qq_comparison(set1, set2):
+    '''
+    Calculating the quantiles used for a qq-plot comparing the data in set1 and set2
+    :param set1: 1-D np.ndarray
+    :param set2: 1-D np.ndarray
+    :return:
+    '''
+    l = np.max([len(set1), len(set2)])
+    percentile_range = np.linspace(0, 100, l)
+    return percentile(set1, percentile_range), percentile(set2, percentile_range)
+
+
+def invasion_depth_curve(depths, n_points=None):
+    '''
+    Invasion depth curve: the invasion depth D over the probability that a cell has invaded at least D (the
+    "nearest" percentiles of the depths, as plotted by 4_mutiple_conditions.py and 4_single_positions.py).
+    :param depths: 1-D np.ndarray of invasion depths
+    :param n_points: number of points of the curve, defaults to the number of cells
+    :return: p (probability, from 0 to 1), depth at each probability
+    '''
+    depths = np.sort(depths)
+    n_points = len(depths) if n_points is None else n_points
+    p = np.linspace(1, 0, n_points)
+    return p[::-1], sorted_percentile_nearest(depths, p * 100)
@@ -0,0 +1,274 @@
+# Parameter sweep for the segmentation (detect_dog -> clean_up_mask -> cell statistics). The projection of each
+# position is computed once (or loaded from the cache, see artifact_cache.py) and shared by all settings. The bandpass
+# filtered image is computed once per (gauss_1, gauss_2) pair and reused for all thresholds. The filtering of each
+# position and gauss pair and then every point of the threshold and clean-up grid are evaluated in parallel. The result
+# is a table with the number of cells and the z-distribution for every setting and, if hand-clicked heights are
+# available, the agreement with them.
+#
+# Usage: python -m invasion_assay.sweep ROOTDIR --gauss 1,2 1,3 --threshold otsu mean_std --threshold-factor 0.8 1 1.2
+#        --closing-iterations 2 4 --area-factor 1 1.5 --clicked-name clicked_heights.txt --output sweep.csv
+
+import os
+import csv
+import argparse
+import tempfile
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+import invasion_assay
+if __name__ == "__main__":
+    # command line: blocking the clickpoints GUI parts before clickpoints is imported (see invasion_assay/__init__.py)
+    invasion_assay.use_headless()
+import clickpoints
+
+from invasion_assay.pipeline import clean_up_mask, cell_statistics, cached_projection
+from invasion_assay.statistics import qq_comparison, percentile
+from invasion_assay.dog_filter import dog_filter, dog_threshold
+from invasion_assay.artifact_cache import ArtifactCache
+from invasion_assay.batch import find_positions
+
+default_grid = {"gauss": [(1, 2)], "threshold": ["otsu"], "threshold_factor": [1], "closing_iterations": [4],
+                "area_factor": [1]}
+
+columns = ["position", "gauss_1", "gauss_2", "threshold", "threshold_factor", "closing_iterations", "area_factor",
+           "cells", "z_mean", "z_p10", "z_p50", "z_p90", "z_std_median", "clicked_cells", "qq_deviation", "error"]
+
+
+def read_clicked_heights(path):
+    '''
+    Reading hand-clicked heights of cells: a text file with comma-separated integers in the first line (same format
+    as in result_comparison).
+    :param path: path to the text file
+    :return: 1-D np.ndarray
+    '''
+    with open(path, "r") as f:
+        return np.array([int(x) for x in f.readline().strip().split(",")])
+
+
+def qq_deviation(heights_clicked, heights):
+    '''
+    Agreement of two height distributions: mean absolute difference of their quantiles (see qq_comparison), in slices.
+    '''
+    if len(heights_clicked) == 0 or len(heights) == 0:
+        return np.nan
+    q_clicked, q_heights = qq_comparison(heights_clicked, heights)
+    return np.mean(np.abs(q_clicked - q_heights))
+
+
+def grid_points(grid):
+    '''
+    :param grid: dictionary with lists of "threshold", "threshold_factor", "closing_iterations" and "area_factor"
+    :return: list of dictionaries, one per combination of the settings
+    '''
+    names = ["threshold", "threshold_factor", "closing_iterations", "area_factor"]
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def filter_position(db_path, gauss, grid, layer="modeFluo5", clicked_name=None, use_cache=True, output=None,
+                    tile_size=None, threads=None):
+    '''
+    The part of the evaluation that is shared by all grid points of one position and one gauss pair: the bandpass
+    filtered projection and its thresholds.
+    :param db_path: path to the sorted.cdb database of the position
+    :param gauss: (gauss_1, gauss_2)
+    :param grid: dictionary with a list of "threshold" methods
+    :param layer: string; the layer name of the fluorescence images.
+    :param clicked_name: name of a file with hand-clicked heights in the position folder (see read_clicked_heights)
+    :param use_cache: boolean; Choose if the cached projection is used (and saved)
+    :param tile_size, threads: the projection is filtered in tiles of this size by a pool of threads (see detect_dog)
+    :param output: path without extension; if set, the filtered image and the index map are saved as .npy files and
+    only their paths are returned, so that the grid points can be evaluated in other processes (as memory maps)
+    :return: dictionary with "base" (position, gauss_1, gauss_2), "filtered" and "max_indices" (arrays or paths),
+    "thresholds" (method -> threshold) and "clicked" (hand-clicked heights or None)
+    '''
+    folder = os.path.split(db_path)[0]
+    gauss_1, gauss_2 = gauss
+    db = clickpoints.DataFile(db_path, "r")
+    try:
+        projection, key = cached_projection(db, layer, ArtifactCache(os.path.join(folder, "z_position_cache"),
+                                                                     enabled=use_cache), progress=False)
+    finally:
+        db.db.close()
+    clicked = None
+    if clicked_name is not None and os.path.exists(os.path.join(folder, clicked_name)):
+        clicked = read_clicked_heights(os.path.join(folder, clicked_name))
+
+    # the bandpass filter is shared by all thresholds
+    img2 = dog_filter(projection["max_proj"], gauss_1, gauss_2, tile_size=tile_size, workers=threads)
+    arrays = {"filtered": img2, "max_indices": projection["max_indices"]}
+    if output is not None:
+        for name in arrays:
+            np.save("%s_%s.npy" % (output, name), arrays[name])
+            arrays[name] = "%s_%s.npy" % (output, name)
+    return dict(arrays, base={"position": folder, "gauss_1": gauss_1, "gauss_2": gauss_2}, clicked=clicked,
+                thresholds={threshold: dog_threshold(img2, threshold, tile_size=tile_size, workers=threads)
+                            for threshold in grid["threshold"]})
+
+
+def evaluate_point(filtered, settings):
+    '''
+    Evaluating one threshold and clean-up setting.
+    :param filtered: dictionary from filter_position
+    :param settings: dictionary with "threshold", "threshold_factor", "closing_iterations" and "area_factor"
+    :return: result row (dictionary with the keys in columns)
+    '''
+    row = dict(filtered["base"], **settings)
+    try:
+        img2, max_indices = [np.load(a, mmap_mode="r") if isinstance(a, str) else a
+                             for a in (filtered["filtered"], filtered["max_indices"])]
+        mask = img2 > filtered["thresholds"][settings["threshold"]] * settings["threshold_factor"]
+        mask_clean, labeled = clean_up_mask(mask, closing_iterations=settings["closing_iterations"],
+                                            area_factor=settings["area_factor"], return_labels=True)
+        stats = cell_statistics(labeled, max_indices)
+    except Exception:
+        return dict(row, error=traceback.format_exc())
+    z = stats["z_mean"]
+    row["cells"] = len(z)
+    if len(z) > 0:
+        row.update(z_mean=np.mean(z), z_std_median=np.median(stats["z_std"]),
+                   **dict(zip(["z_p10", "z_p50", "z_p90"], percentile(z, [10, 50, 90]))))
+    clicked = filtered["clicked"]
+    if clicked is not None:
+        row.update(clicked_cells=len(clicked), qq_deviation=qq_deviation(clicked, z))
+    return row
+
+
+def failed_row(db_path, gauss):
+    return {"position": os.path.split(db_path)[0], "gauss_1": gauss[0], "gauss_2": gauss[1],
+            "error": traceback.format_exc()}
+
+
+def run_sweep(db_paths, grid=None, workers=None, layer="modeFluo5", clicked_name=None, use_cache=True, tile_size=None,
+              threads=None):
+    '''
+    Evaluating a grid of segmentation settings for several positions. The bandpass filter is run once per position
+    and gauss pair, then every grid point (threshold, threshold_factor, closing_iterations, area_factor) is a separate
+    job. The filtered images are passed to the workers as memory-mapped files in a temporary folder, each one is
+    deleted when its grid points are done.
+    :param db_paths: list of paths to sorted.cdb databases (see batch.find_positions)
+    :param grid: dictionary with lists of settings for "gauss" ((gauss_1, gauss_2) tuples), "threshold",
+    "threshold_factor", "closing_iterations" and "area_factor". Missing entries are taken from default_grid.
+    :param workers: int; number of worker processes (default: number of CPUs)
+    :param layer: string; the layer name of the fluorescence images.
+    :param clicked_name: name of a file with hand-clicked heights in the position folders
+    :param use_cache: boolean; Choose if cached projections are used (and saved)
+    :param tile_size, threads: tiled bandpass filter in each worker process (see filter_position)
+    :return: list of result rows, sorted by position and settings
+    '''
+    grid = dict(default_grid, **(grid or {}))
+    points = grid_points(grid)
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="sweep_") as tmp, \
+            ProcessPoolExecutor(max_workers=workers, initializer=invasion_assay.use_headless) as executor:
+        # computing missing projections first, so that the workers of one position don't compute it at the same time
+        if use_cache:
+            list(executor.map(_prepare_projection, db_paths, itertools.repeat(layer)))
+        jobs = [(db_path, gauss) for db_path in db_paths for gauss in grid["gauss"]]
+        futures = {executor.submit(filter_position, db_path, gauss, grid, layer, clicked_name, use_cache,
+                                   os.path.join(tmp, str(i)), tile_size, threads): (db_path, gauss)
+                   for i, (db_path, gauss) in enumerate(jobs)}
+        point_futures = {}
+        remaining = {}
+        for future in as_completed(futures):
+            try:
+                filtered = future.result()
+            except Exception:
+                rows.append(failed_row(*futures[future]))
+                continue
+            # the grid points of a position are started as soon as its filtered image is ready
+            files = (filtered["filtered"], filtered["max_indices"])
+            remaining[files] = len(points)
+            point_futures.update({executor.submit(evaluate_point, filtered, settings): files for settings in points})
+        for future in as_completed(point_futures):
+            rows.append(future.result())
+            files = point_futures[future]
+            remaining[files] -= 1
+            if remaining[files] == 0:
+                for file in files:
+                    os.remove(file)
+    return sorted(rows, key=_sort_key)
+
+
+def _sort_key(row):
+    # numbers are compared as numbers (gauss_1=2 before gauss_1=10), strings after them and missing settings (rows of
+    # failed jobs) last
+    key = []
+    for column in columns[:7]:
+        value = row.get(column)
+        if value is None:
+            key.append((2, 0, ""))
+        elif isinstance(value, str):
+            key.append((1, 0, value))
+        else:
+            key.append((0, value, ""))
+    return key
+
+
+def _prepare_projection(db_path, layer):
+    try:
+        db = clickpoints.DataFile(db_path, "r")
+        try:
+            cached_projection(db, layer, ArtifactCache(os.path.join(os.path.split(db_path)[0], "z_position_cache")),
+                              progress=False)
+        finally:
+            db.db.close()
+    except Exception:
+        # the position is not skipped here, filter_position runs into the error again and reports it in the table
+        print("computing the projection of %s failed:\n%s" % (db_path, traceback.format_exc()))
+
+
+def write_table(rows, path):
+    '''
+    Writing the results of run_sweep to a csv file.
+    '''
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({c: (np.round(v, 3) if isinstance(v, float) else v) for c, v in row.items()})
+
+
+def print_table(rows):
+    print("%-30s %5s %9s %6s %4s %5s %7s %7s %7s" % ("position", "gauss", "threshold", "factor", "clos", "area",
+                                                     "cells", "z_p50", "qq_dev"))
+    for r in rows:
+        if r.get("error") is not None:
+            print("%-30s failed: %s" % (r["position"][-30:], r["error"].strip().splitlines()[-1]))
+            continue
+        print("%-30s %2s,%-2s %9s %6s %4s %5s %7d %7.2f %7.2f" % (
+            r["position"][-30:], r["gauss_1"], r["gauss_2"], r["threshold"], r["threshold_factor"],
+            r["closing_iterations"], r["area_factor"], r["cells"], r.get("z_p50", np.nan),
+            r.get("qq_deviation", np.nan)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter sweep for the segmentation of cells.")
+    parser.add_argument("rootdir", help="experiment folder with position folders (pos00, pos01, ...)")
+    parser.add_argument("--gauss", nargs="+", default=["1,2"], help="gauss_1,gauss_2 pairs, e.g. 1,2 1,3")
+    parser.add_argument("--threshold", nargs="+", default=["otsu"], choices=["otsu", "mean_std", "absolute"])
+    parser.add_argument("--threshold-factor", nargs="+", type=float, default=[1])
+    parser.add_argument("--closing-iterations", nargs="+", type=int, default=[4])
+    parser.add_argument("--area-factor", nargs="+", type=float, default=[1])
+    parser.add_argument("--layer", default="modeFluo5")
+    parser.add_argument("--clicked-name", default=None,
+                        help="name of the file with hand-clicked heights in the position folders")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="filter the projections in tiles of this size (for large mosaics)")
+    parser.add_argument("--threads", type=int, default=None, help="threads per worker for the tiles")
+    parser.add_argument("--no-cache", action="store_true", help="don't use or save cached projections")
+    parser.add_argument("--output", default=None, help="csv file for the results (default: ROOTDIR/sweep.csv)")
+    args = parser.parse_args()
+
+    grid = {"gauss": [tuple(float(g) for g in pair.split(",")) for pair in args.gauss],
+            "threshold": args.threshold, "threshold_factor": args.threshold_factor,
+            "closing_iterations": args.closing_iterations, "area_factor": args.area_factor}
+    rows = run_sweep(find_positions(args.rootdir), grid, workers=args.workers, layer=args.layer,
+                     clicked_name=args.clicked_name, use_cache=not args.no_cache, tile_size=args.tile_size,
+                     threads=args.threads)
+    print_table(rows)
+    output = args.output or os.path.join(args.rootdir, "sweep.csv")
+    write_table(rows, output)
+    print("results written to %s" % output)
@@ -0,0 +1,144 @@
+# Synthetic z-stacks of invasion assays: blobby nuclei at known 3-D positions, blurred out of focus, with background
+# and noise. The slices are written as .tif files with the file names of the microscope, so they can be routed into
+# position folders (file_router.py), registered in a database (database_builder.py) and evaluated like real data.
+# fake_acquisition writes the slices one by one with a delay, like the microscope during an acquisition.
+
+import os
+import time
+import numpy as np
+import tifffile
+
+fluo_mode = "modeFluo5"
+bf_mode = "modeBF"
+
+
+def stack_filename(pos, mode, z, rep=0, timestamp="20200304-101010", mic="Mic3"):
+    '''
+    File name of a slice, e.g. 20200304-101010_Mic3_rep0000_pos00_x0_y0_modeFluo5_z012.tif
+    '''
+    return "%s_%s_rep%04d_pos%02d_x0_y0_%s_z%03d.tif" % (timestamp, mic, rep, pos, mode, z)
+
+
+def synthetic_cells(n_cells, size, n_slices, radius=(4, 8), brightness=(800, 3000), seed=0):
+    '''
+    Random nuclei in a volume of n_slices x size x size voxels. Cells are kept away from the border of the image and
+    from the first and last slices, so that their focus lies inside the stack.
+    :param n_cells: number of cells
+    :param size: edge length of the (square) slices
+    :param n_slices: number of slices
+    :param radius: range of the radii of the nuclei in pixels
+    :param brightness: range of the maximal intensities (above the background)
+    :param seed: seed of the random number generator
+    :return: dictionary of 1-D np.ndarrays: "z", "y", "x" (position of the nucleus, z in slices), "ry", "rx" (radii),
+    "brightness"
+    '''
+    rng = np.random.default_rng(seed)
+    border = radius[1] * 2
+    z_margin = min(3, n_slices // 4)
+    return {"z": rng.uniform(z_margin, n_slices - 1 - z_margin, n_cells),
+            "y": rng.uniform(border, size - border, n_cells), "x": rng.uniform(border, size - border, n_cells),
+            "ry": rng.uniform(*radius, n_cells), "rx": rng.uniform(*radius, n_cells),
+            "brightness": rng.uniform(*brightness, n_cells)}
+
+
+def render_slice(cells, z, size, background=100, noise=5, defocus=1.5, rng=None):
+    '''
+    Fluorescence image of slice z. Each nucleus is an elliptical blob whose width grows and whose peak intensity drops
+    with the distance to its focus (the integrated intensity stays the same).
+    :param cells: dictionary from synthetic_cells
+    :param z: slice index
+    :param size: edge length of the slice
+    :param background: mean background intensity
+    :param noise: standard deviation of the gaussian noise
+    :param defocus: increase of the blob width (in pixels) per slice of distance to the focus
+    :param rng: np.random.Generator for the noise
+    :return: 2-D np.ndarray (uint16)
+    '''
+    rng = np.random.default_rng(z) if rng is None else rng
+    img = np.full((size, size), float(background), dtype=np.float32)
+    if noise > 0:
+        img += rng.normal(0, noise, img.shape).astype(np.float32)
+    blur = defocus * np.abs(z - cells["z"])
+    for i in range(len(cells["z"])):
+        sy = np.hypot(cells["ry"][i] / 2, blur[i])
+        sx = np.hypot(cells["rx"][i] / 2, blur[i])
+        amplitude = cells["brightness"][i] * (cells["ry"][i] * cells["rx"][i] / 4) / (sy * sx)
+        if amplitude < noise * 0.1:
+            continue
+        half = int(np.ceil(3 * max(sy, sx)))
+        y0, x0 = int(round(cells["y"][i])), int(round(cells["x"][i]))
+        ys = slice(max(y0 - half, 0), min(y0 + half + 1, size))
+        xs = slice(max(x0 - half, 0), min(x0 + half + 1, size))
+        yy, xx = np.ogrid[ys, xs]
+        img[ys, xs] += amplitude * np.exp(-(yy - cells["y"][i]) ** 2 / (2 * sy ** 2)
+                                          - (xx - cells["x"][i]) ** 2 / (2 * sx ** 2))
+    return np.clip(img, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def bright_field(fluo, rng=None):
+    '''
+    Bright field image of a slice: the nuclei appear as dark, low-contrast objects on a bright background.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    img = 2000 - 0.2 * fluo.astype(np.float32) + rng.normal(0, 10, fluo.shape).astype(np.float32)
+    return np.clip(img, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def write_tif(path, img):
+    '''
+    Writing an image to a temporary file first and renaming it, so that a reader never sees a half written file.
+    '''
+    tifffile.imwrite(path + ".part", img)
+    os.replace(path + ".part", path)
+
+
+def write_position(folder, pos, cells, size, n_slices, with_bf=True, seed=0, **kwargs):
+    '''
+    Writing the z-stack of one position as .tif files.
+    :param folder: output folder
+    :param pos: position number (used in the file names)
+    :param cells: dictionary from synthetic_cells
+    :param size: edge length of the slices
+    :param n_slices: number of slices
+    :param with_bf: boolean; also write bright field images
+    :param seed: seed of the noise
+    :param kwargs: parameters of render_slice
+    :return: list of written files
+    '''
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for z in range(n_slices):
+        fluo = render_slice(cells, z, size, rng=rng, **kwargs)
+        images = [(fluo_mode, fluo)] + ([(bf_mode, bright_field(fluo, rng))] if with_bf else [])
+        for mode, img in images:
+            files.append(os.path.join(folder, stack_filename(pos, mode, z)))
+            write_tif(files[-1], img)
+    return files
+
+
+def fake_acquisition(folder, n_positions=2, n_slices=20, size=256, n_cells=30, interval=0.05, seed=0):
+    '''
+    Writing the slices of several positions one after the other into one folder, like the microscope during an
+    acquisition. Can be run in a thread or separate process next to watch.watch_acquisition.
+    :param folder: acquisition folder
+    :param n_positions: number of positions
+    :param n_slices: number of slices per position
+    :param size: edge length of the slices
+    :param n_cells: number of cells per position
+    :param interval: time in seconds between two slices
+    :param seed: seed of the cell positions and the noise
+    :return: list of the cell dictionaries (ground truth) of each position
+    '''
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    truth = []
+    for pos in range(n_positions):
+        cells = synthetic_cells(n_cells, size, n_slices, seed=seed + pos)
+        truth.append(cells)
+        for z in range(n_slices):
+            fluo = render_slice(cells, z, size, rng=rng)
+            write_tif(os.path.join(folder, stack_filename(pos, fluo_mode, z)), fluo)
+            write_tif(os.path.join(folder, stack_filename(pos, bf_mode, z)), bright_field(fluo, rng))
+            time.sleep(interval)
+    return truth
@@ -0,0 +1,255 @@
+# Streaming evaluation of an acquisition. The acquisition folder is polled for new .tif files while the microscope
+# writes them. The fluorescence slices of each position are added to a running projection (projection.ZProjector) as
+# they arrive. As soon as the z-stack of a position is complete, its files are moved into the position folder
+# (file_router.py), the database is built (database_builder.py), the running projection is stored in the cache of the
+# position and the position is evaluated in a worker process (pipeline.process_position). The results of the plate
+# (results_store.collect_plate) are updated after every position. Files that arrive after their position was evaluated
+# are moved into the position folder as well and the position is evaluated again.
+#
+# Usage: python -m invasion_assay.watch ACQUISITION_FOLDER --slices 100 [--plate PLATE_FOLDER] [--stop-after 600]
+#        python -m invasion_assay.watch ACQUISITION_FOLDER --slices 20 --fake 3   (test with a fake microscope)
+
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import invasion_assay
+if __name__ == "__main__":
+    # command line: blocking the clickpoints GUI parts before clickpoints is imported (see invasion_assay/__init__.py)
+    invasion_assay.use_headless()
+import clickpoints
+
+from invasion_assay.file_router import parse_filename, move_files
+from invasion_assay.database_builder import build_database, default_channels
+from invasion_assay.projection import ZProjector, index_dtype
+from invasion_assay.stack_reader import StackReader, open_image
+from invasion_assay.artifact_cache import ArtifactCache
+from invasion_assay.pipeline import projection_key
+from invasion_assay.batch import run_position, print_summary_line, print_summary
+from invasion_assay.results_store import collect_plate
+
+
+class StreamingPosition:
+    '''
+    Files and running projection of one position during the acquisition.
+    '''
+
+    def __init__(self, pos, channels, layer, n_slices=None):
+        '''
+        :param pos: position as in the file names (e.g. "00")
+        :param channels: list of mode names
+        :param layer: mode of the images that are projected
+        :param n_slices: number of slices of a complete z-stack, None if unknown
+        '''
+        self.pos = pos
+        self.layer = layer
+        self.n_slices = n_slices
+        # channel -> {(rep, z): file name}
+        self.files = {channel: {} for channel in channels}
+        self.projector = None
+        self.last_update = time.time()
+        self.submitted = False
+        # files that are already in the position folder
+        self.moved = set()
+        # the evaluation of the position in the worker process
+        self.future = None
+
+    def add(self, filename, info, path):
+        '''
+        Adding a new file. Slices of the projected layer are read once and added to the running projection, with the
+        z from the file name as index. A file of a position that was already submitted submits the position again.
+        '''
+        if info["mode"] not in self.files:
+            return
+        if self.submitted:
+            print("!!! %s arrived after pos%s was evaluated, the position is evaluated again" % (filename, self.pos))
+            self.submitted = False
+        self.files[info["mode"]][(int(info["rep"]), int(info["z"]))] = filename
+        self.last_update = time.time()
+        if info["mode"] == self.layer:
+            # read completely (no memory map), so the file can be moved later
+            frame = open_image(path, memmap=False)
+            if self.projector is None:
+                self.projector = ZProjector(frame.shape, dtype=np.uint16, n_frames=self.n_slices)
+            self.projector.add(frame, int(info["z"]))
+
+    def is_complete(self, idle_time):
+        '''
+        A position is complete if every channel has n_slices images or, if n_slices is unknown, if no new image
+        arrived for idle_time seconds.
+        '''
+        if any(len(files) == 0 for files in self.files.values()):
+            return False
+        if self.n_slices is not None:
+            return all(len(files) >= self.n_slices for files in self.files.values())
+        return time.time() - self.last_update > idle_time
+
+    def filenames(self):
+        return [file for files in self.files.values() for file in files.values()]
+
+    def is_ready(self, idle_time, now):
+        '''
+        A position is submitted if it is complete. If it was submitted before (late files), the previous evaluation
+        has to be finished and no new file of the position may have arrived since now (the last scan of the folder).
+        '''
+        if self.submitted or not self.is_complete(idle_time):
+            return False
+        return self.future is None or (self.future.done() and self.last_update < now)
+
+    def projection(self, stack):
+        '''
+        The running projection in the format of pipeline.cached_projection, if the slice index of every file agrees
+        with the frame number in the database (otherwise None and the projection is computed from the database).
+        :param stack: StackReader of the projected layer from the database
+        '''
+        if self.projector is None:
+            return None
+        z_of_file = {file: z for (rep, z), file in self.files[self.layer].items()}
+        if any(z_of_file.get(os.path.basename(file)) != index for file, index in zip(stack.files, stack.indices)):
+            return None
+        max_indices, min_indices, max_proj, min_proj = self.projector.result()
+        idx_dtype = index_dtype(max(stack.indices) + 1)
+        return {"max_indices": max_indices.astype(idx_dtype), "min_indices": min_indices.astype(idx_dtype),
+                "max_proj": max_proj, "min_proj": min_proj}
+
+
+def finish_position(acquisition_dir, position, channels, layer, use_cache=True):
+    '''
+    Moving the files of a complete position into its position folder, building the database and storing the running
+    projection in the cache of the position. If the position was finished before, only the new files are moved and
+    added to the database.
+    :return: path to the database
+    '''
+    folder = os.path.join(acquisition_dir, "pos" + position.pos)
+    files = [file for file in position.filenames() if file not in position.moved]
+    errors = move_files([(os.path.join(acquisition_dir, file), os.path.join(folder, file)) for file in files])
+    for error in errors:
+        print("!!! " + error)
+    position.moved.update(files)
+    db_path, changes = build_database(folder, channels, sync=True)
+    if use_cache:
+        db = clickpoints.DataFile(db_path, "r")
+        try:
+            stack = StackReader.from_database(db, layer)
+            projection = position.projection(stack)
+            if projection is not None:
+                ArtifactCache(os.path.join(folder, "z_position_cache")).save("projection",
+                                                                             projection_key(stack, layer), projection)
+        finally:
+            db.db.close()
+    return db_path
+
+
+def watch_acquisition(acquisition_dir, n_slices=None, channels=None, layer="modeFluo5", plate_dir=None,
+                      poll_interval=1.0, settle_time=1.0, idle_time=60, stop_after=None, workers=None,
+                      use_cache=True, **kwargs):
+    '''
+    Following an acquisition folder and evaluating each position as soon as its z-stack is complete.
+    :param acquisition_dir: folder into which the microscope writes the .tif images
+    :param n_slices: number of slices of a z-stack; if None, a position is complete if no new image arrived for
+    idle_time seconds
+    :param channels: list of mode names, e.g. ['modeBF', 'modeFluo5']
+    :param layer: mode of the fluorescence images
+    :param plate_dir: folder of the plate for results_store.collect_plate (default: the parent of acquisition_dir, with
+    acquisition_dir as the condition)
+    :param poll_interval: time in seconds between two scans of the folder
+    :param settle_time: files are only read if they weren't modified for this many seconds (still being written)
+    :param idle_time: see n_slices
+    :param stop_after: stop if no new file arrived for this many seconds and all positions are evaluated (None: run
+    until interrupted)
+    :param workers: number of worker processes for the evaluation (default: number of CPUs)
+    :param use_cache: boolean; store the running projections in the cache and use cached results
+    :param kwargs: additional arguments for process_position (marker_type_name, threshold, ...)
+    :return: list of summary dictionaries of the evaluated positions (see batch.run_batch)
+    '''
+    channels = channels or default_channels
+    plate_dir = plate_dir or os.path.dirname(os.path.abspath(acquisition_dir))
+    kwargs = dict(kwargs, layer=layer, use_cache=use_cache, progress=False)
+    positions = {}
+    seen = set()
+    unmatched = set()
+    running = []
+    summaries = []
+    last_file = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=invasion_assay.use_headless) as executor:
+        try:
+            while True:
+                now = time.time()
+                with os.scandir(acquisition_dir) as entries:
+                    new = [entry for entry in entries if entry.name.endswith(".tif") and entry.name not in seen
+                           and entry.name not in unmatched and entry.is_file()
+                           and now - entry.stat().st_mtime >= settle_time]
+                for entry in sorted(new, key=lambda e: e.name):
+                    info = parse_filename(entry.name)
+                    if info is None or info["mode"] not in channels:
+                        unmatched.add(entry.name)
+                        continue
+                    seen.add(entry.name)
+                    if info["pos"] not in positions:
+                        positions[info["pos"]] = StreamingPosition(info["pos"], channels, layer, n_slices)
+                    positions[info["pos"]].add(entry.name, info, entry.path)
+                    last_file = now
+
+                for position in positions.values():
+                    if position.is_ready(idle_time, now):
+                        position.submitted = True
+                        db_path = finish_position(acquisition_dir, position, channels, layer, use_cache=use_cache)
+                        position.future = executor.submit(run_position, db_path, kwargs)
+                        running.append(position.future)
+
+                for future in [f for f in running if f.done()]:
+                    running.remove(future)
+                    summary = future.result()
+                    # the summary of a position that is evaluated again replaces the earlier one
+                    summaries = [s for s in summaries if s["position"] != summary["position"]] + [summary]
+                    print_summary_line(summary)
+                    if summary["error"] is None:
+                        collect_plate(plate_dir)
+
+                if stop_after is not None and not running and now - last_file > stop_after \
+                        and all(p.submitted for p in positions.values()):
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("stopped, waiting for %d running positions" % len(running))
+            for future in running:
+                summary = future.result()
+                summaries = [s for s in summaries if s["position"] != summary["position"]] + [summary]
+                print_summary_line(summary)
+            if running:
+                collect_plate(plate_dir)
+    return sorted(summaries, key=lambda s: s["position"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluating positions while the microscope writes them.")
+    parser.add_argument("folder", help="acquisition folder")
+    parser.add_argument("--slices", type=int, default=None, help="number of slices of a z-stack")
+    parser.add_argument("--plate", default=None, help="plate folder for the results (default: parent of the folder)")
+    parser.add_argument("--layer", default="modeFluo5")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--settle-time", type=float, default=1.0)
+    parser.add_argument("--idle-time", type=float, default=60)
+    parser.add_argument("--stop-after", type=float, default=None, help="stop after this many seconds without new files")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--fake", type=int, default=0,
+                        help="test mode: a fake microscope writes this many synthetic positions into the folder")
+    args = parser.parse_args()
+
+    if args.fake:
+        os.makedirs(args.folder, exist_ok=True)
+        from invasion_assay.synthetic_stacks import fake_acquisition
+        writer = threading.Thread(target=fake_acquisition, args=(args.folder,),
+                                  kwargs={"n_positions": args.fake, "n_slices": args.slices or 20}, daemon=True)
+        writer.start()
+        if args.stop_after is None:
+            args.stop_after = 5
+    summaries = watch_acquisition(args.folder, n_slices=args.slices, layer=args.layer, plate_dir=args.plate,
+                                  poll_interval=args.poll_interval, settle_time=args.settle_time,
+                                  idle_time=args.idle_time, stop_after=args.stop_after, workers=args.workers,
+                                  marker_type_name="cell_in_focus")
+    print_summary(summaries)
@@ -1,60 +1,29 @@
-from clickpoints import DataFile
-import glob
-import os
-import peewee
+from invasion_assay import use_headless
+# only clickpoints.DataFile is needed, the clickpoints GUI parts are not loaded (see invasion_assay/__init__.py)
+use_headless()
+from invasion_assay.database_builder import build_database
 import sys
 
 
 # This programm is used to generate .cdb clickpoints databases. Image z-stacks with BF and Fluo images are required.
 # Der Modus (BF/Fluo) dient als Layer und die eigentliche Ebene (layer) vom z-Stack wird als Index (frame number)
 # in die Datenbank einsortiert. So können die Daten für den Invasions-Assay mit Annalena evaluiert werden in Clickpoints.
+# The database is built by invasion_assay.database_builder.build_database, 2-launch_sortLayersCoverT.py uses the same
+# function for all positions of an experiment.
 
 src_path = r'H:\Experiment_data\B01_AnWi_Invasion_2020-01-31\U87-1\pos001'
 
-if len(sys.argv) == 2:
-    src_path = sys.argv[1]
+# usage: python sortLayersCoverT.py [src_path] [--sync]
+# with --sync an existing database is updated (new images are added, missing ones removed) and its markers are kept
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+sync = "--sync" in sys.argv
+if len(args) == 1:
+    src_path = args[0]
     print("using path: %s" % src_path)
 
 
 channels = ['modeBF','modeFluo5']
 
-
-# get files
-bf_images = glob.glob(os.path.join(src_path, '*' + channels[0] + '*'))
-fluo_images = glob.glob(os.path.join(src_path, '*' + channels[1] + '*'))
-
-db_name = os.path.join(src_path, 'sorted.cdb')
-if os.path.exists(db_name):
-    os.remove(db_name)
-    db = DataFile(db_name,'w')
-else:
-    db = DataFile(db_name,'w')
-
-c0 = db.setLayer(channels[0])
-c1 = db.setLayer(channels[1])
-
-
-for im in bf_images:
-    path,file = os.path.split(im)
-
-
-    p = db.setPath('.')
-    try:
-        db.setImage(file,p,layer=c0)
-    except peewee.IntegrityError:
-        pass
-
-for id,im in enumerate(fluo_images):
-    path, file = os.path.split(im)
-
-    p = db.setPath('.')
-    try:
-        db.setImage(file, p, layer=c1, sort_index=id)
-    except peewee.IntegrityError:
-        pass
-
-
-db.setMarkerType(name='cell_in_focus', color= '#ff0000', mode=db.TYPE_Track)
-db.setMarkerType(name='not_a_cell', color= '#e2ff00', mode=db.TYPE_Track)
-
-db.db.close()
\ No newline at end of file
+if __name__ == "__main__":
+    db_path, changes = build_database(src_path, channels, sync=sync)
+    print("%d images added, %d removed, %d reordered" % (changes["added"], changes["removed"], changes["reordered"]))
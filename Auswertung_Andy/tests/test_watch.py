@@ -0,0 +1,64 @@
+# Test of watch.watch_acquisition with the fake microscope (synthetic_stacks.fake_acquisition) in a temporary folder:
+# the files are routed into the position folders, every position is evaluated and a file that arrives after its
+# position was evaluated is added to the position, which is evaluated again.
+# Usage: python -m pytest tests (in the Auswertung_Andy folder)
+
+import os
+import time
+import threading
+import numpy as np
+
+import invasion_assay
+invasion_assay.use_headless()
+import clickpoints
+
+from invasion_assay.watch import watch_acquisition
+from invasion_assay.stack_reader import StackReader
+from invasion_assay.synthetic_stacks import fake_acquisition, synthetic_cells, render_slice, write_tif, \
+    stack_filename, fluo_mode
+
+n_positions = 2
+n_slices = 8
+size = 128
+
+
+def late_acquisition(folder, delay=5):
+    '''
+    The fake acquisition, followed by one more slice of pos00 after the position was evaluated.
+    '''
+    fake_acquisition(folder, n_positions=n_positions, n_slices=n_slices, size=size, n_cells=10, interval=0.01)
+    time.sleep(delay)
+    cells = synthetic_cells(10, size, n_slices + 1)
+    write_tif(os.path.join(folder, stack_filename(0, fluo_mode, n_slices)), render_slice(cells, n_slices, size))
+
+
+def test_watch_acquisition(tmp_path):
+    acquisition_dir = str(tmp_path / "Ctrl")
+    os.makedirs(acquisition_dir)
+    writer = threading.Thread(target=late_acquisition, args=(acquisition_dir,), daemon=True)
+    writer.start()
+    summaries = watch_acquisition(acquisition_dir, n_slices=n_slices, poll_interval=0.2, settle_time=0.2,
+                                  stop_after=10, workers=1, marker_type_name="cell_in_focus")
+    writer.join()
+
+    # one summary per position, the late slice replaced the first summary of pos00
+    assert [os.path.basename(s["position"]) for s in summaries] == ["pos%02d" % pos for pos in range(n_positions)]
+    assert all(s["error"] is None and s["cells"] > 0 for s in summaries)
+    # all files are routed into the position folders
+    assert not [name for name in os.listdir(acquisition_dir) if name.endswith(".tif")]
+    for pos in range(n_positions):
+        folder = os.path.join(acquisition_dir, "pos%02d" % pos)
+        n_files = 2 * n_slices + (pos == 0)
+        assert len([name for name in os.listdir(folder) if name.endswith(".tif")]) == n_files
+        cells = np.load(os.path.join(folder, "cells.npz"))
+        assert len(cells["z"]) == summaries[pos]["cells"]
+
+    # the late slice is in the database and the cells of pos00 are evaluated with it
+    folder = os.path.join(acquisition_dir, "pos00")
+    db = clickpoints.DataFile(os.path.join(folder, "sorted.cdb"), "r")
+    try:
+        assert len(StackReader.from_database(db, fluo_mode).files) == n_slices + 1
+    finally:
+        db.db.close()
+    late_file = os.path.join(folder, stack_filename(0, fluo_mode, n_slices))
+    assert os.path.getmtime(os.path.join(folder, "cells.npz")) > os.path.getmtime(late_file)